@@ -44,12 +44,18 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'anttracker.metrics.MetricsMiddleware',
+    'anttracker.assets.StaticAssetMiddleware',
+    'anttracker.compression.CompressionMiddleware',
+    'anttracker.db_routers.ReplicaRoutingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'anttracker.throttling.LoadSheddingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'anttracker.sharding.ShardRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -81,10 +87,49 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+    },
+    # 'replica': {
+    #     'ENGINE': 'django.db.backends.postgresql',
+    #     'NAME': 'monitormybug', 'HOST': 'replica.internal',
+    #     'TEST': {'MIRROR': 'default'},
+    # },
+}
+
+# Read replicas for dashboard and list endpoints (aliases from DATABASES)
+DATABASE_ROUTERS = ['anttracker.sharding.ShardRouter', 'anttracker.db_routers.ReplicaRouter']
+DATABASE_REPLICAS = []
+REPLICA_STICKY_SECONDS = 5  # Read from the primary this long after a user's own write
+REPLICA_MAX_LAG_SECONDS = 10  # Skip PostgreSQL replicas lagging further behind
+
+# Farmer-based sharding of devices, readings, rules and alert logs.
+# Maps DATABASES aliases to shard numbers; numbers fix each shard's primary key
+# range, so never renumber a shard. Run `migrate --database <alias>` for each.
+# DATABASE_SHARDS = {'default': 0, 'shard1': 1, 'shard2': 2}
+DATABASE_SHARDS = {'default': 0}
+SHARD_MAP_TTL = 5  # Seconds a process caches a farmer's shard
+
+
+# Cache
+# Throttle buckets, the load-shedding counter and alert rule versions are shared
+# through the default cache. LocMemCache is per process, so with several worker
+# processes each one throttles and sheds on its own; use a shared backend, e.g.:
+# CACHES = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://127.0.0.1:6379'}}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
 
+# Sessions are read from the cache and written through to the database
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Resolve session users (with their farmer profile) from the cache
+AUTHENTICATION_BACKENDS = ['anttracker.authentication.CachedModelBackend']
+AUTH_CACHE_TIMEOUT = 300  # Seconds a resolved user or API token stays cached
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -120,6 +165,19 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# collectstatic writes content-hashed names plus .gz/.br copies, which
+# anttracker.assets.StaticAssetMiddleware serves with far-future cache headers
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'anttracker.assets.CompressedManifestStaticFilesStorage',
+    },
+}
+STATIC_MAX_AGE = 60  # Seconds browsers may cache assets that are not content-hashed
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -130,13 +188,25 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'anttracker.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'anttracker.renderers.ColumnarJSONRenderer',
+        'anttracker.renderers.MessagePackRenderer',
+    ],
+    'DEFAULT_CONTENT_NEGOTIATION_CLASS': 'anttracker.renderers.ContentNegotiation',
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
-    'PAGE_SIZE': 20
+    'PAGE_SIZE': 20,
+    # Token bucket capacity per period (see anttracker.throttling)
+    'DEFAULT_THROTTLE_RATES': {
+        'device': '120/min',
+        'dashboard': '60/min',
+    },
 }
 
 # CORS settings
@@ -160,3 +230,66 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
 # Ant threshold settings
 ANT_THRESHOLD_LIMIT = 50  # Default threshold for ant count alerts
+
+# Device heartbeat settings
+DEVICE_HEARTBEAT_INTERVAL = 60  # Seconds between last_seen writes per device
+DEVICE_OFFLINE_AFTER = 3600  # Seconds of silence before a device is flagged offline
+
+# Dashboard settings
+DASHBOARD_CACHE_SECONDS = 30  # Summaries shared by /api/dashboard/ and the dashboard page
+
+# Alert re-evaluation settings (jobs run by `manage.py reevaluate_alerts`)
+ALERT_REEVALUATION_WORKERS = 4  # Worker processes per job
+ALERT_REEVALUATION_CHUNK_DAYS = 30  # Days of one device's readings per checkpointed chunk
+ALERT_REEVALUATION_DAYS = 365  # How far back a threshold change re-evaluates
+
+# Regional aggregate settings (rolled up by `manage.py rollup_aggregates`)
+AGGREGATE_ROLLUP_LAG = 60  # Seconds a reading waits before it is folded in
+AGGREGATE_ROLLUP_BATCH = 50000  # Readings folded per transaction
+
+# Device provisioning settings
+DEVICE_PROVISION_MAX = 5000  # Devices per bulk provisioning request
+DEVICE_KEY_GRACE_PERIOD = 86400  # Seconds a rotated-out API key keeps working
+DEVICE_KEY_MAX_GRACE_PERIOD = 30 * 86400  # Longest grace_period_seconds a rotation request may ask for
+
+# Ingest write-behind settings
+INGEST_WRITE_BEHIND = False  # Buffer readings in-process and commit them in groups
+INGEST_BUFFER_MAX_ROWS = 10000  # Requests get 503 + Retry-After when the buffer is full
+INGEST_FLUSH_ROWS = 500  # Commit once this many rows are buffered...
+INGEST_FLUSH_INTERVAL_MS = 200  # ...or after this many milliseconds
+INGEST_SPOOL_PATH = None  # e.g. BASE_DIR / 'ingest.spool' to survive crashes before commit (one file per process)
+INGEST_SPOOL_FSYNC = False  # fsync the spool on every accepted request
+INGEST_MAX_ATTEMPTS = 5  # Flushes a row may fail with a data error before it is dead-lettered
+
+# Load shedding settings (counted across workers through the default cache)
+LOAD_SHED_MAX_IN_FLIGHT = 64  # Hard limit on concurrent API requests, including device ingest
+LOAD_SHED_LOW_PRIORITY_IN_FLIGHT = 32  # Dashboard/API requests are shed above this
+LOAD_SHED_RETRY_AFTER = 1  # Seconds suggested to shed clients
+LOAD_SHED_COUNTER_TIMEOUT = 300  # Seconds before counts leaked by a killed worker are forgotten
+
+# Server-side counting for devices that upload trap images (per worker process)
+ML_MODEL_PATH = None  # YOLO weights with 'ant' and 'mealy_bug' classes; image uploads get 501 while unset
+ML_WORKERS = 2  # Inference processes, each holding one copy of the model
+ML_WORKER_THREADS = 1  # CPU threads per inference process
+ML_BATCH_SIZE = 8  # Images per forward pass
+ML_BATCH_WAIT_MS = 500  # Send a partial batch once its oldest image has waited this long
+ML_MAX_PENDING_IMAGES = 256  # Queued images before uploads get 503
+ML_MAX_IMAGE_BYTES = 5 * 1024 * 1024  # Larger uploads get 413 before their body is read
+ML_SPOOL_DIR = BASE_DIR / 'ml_spool'  # Accepted images are kept here until counted, and replayed on start
+ML_CONFIDENCE_THRESHOLD = 0.25  # Minimum detection confidence to count an insect
+ML_IMAGE_SIZE = 640  # Model input size in pixels
+
+# Response compression settings
+COMPRESSION_MIN_SIZE = 1024  # Bytes; smaller responses are sent uncompressed
+COMPRESSION_GZIP_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5  # Used when the optional brotli package is installed
+
+# Admin changelists for large tables (SensorData, AlertLog)
+ADMIN_EXACT_COUNT_LIMIT = 10000  # Count matching rows up to this many, estimate beyond
+ADMIN_DEFAULT_DAYS = 7  # Rows shown when no date filter is selected
+
+# Metrics and profiling settings
+METRICS_TOKEN = None  # Scrapers send "Authorization: Bearer <token>"; staff can always read /metrics
+METRICS_SLOW_REQUEST_MS = None  # Log requests slower than this (e.g. 500)
+METRICS_PROFILE_DIR = None  # Write a cProfile dump for sampled slow requests into this directory
+METRICS_PROFILE_SAMPLE_RATE = 0.01  # Fraction of requests profiled when METRICS_PROFILE_DIR is set
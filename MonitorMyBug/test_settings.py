@@ -0,0 +1,29 @@
+"""
+Settings for the test suite, with the extra databases the routing tests need:
+
+    python manage.py test --settings=MonitorMyBug.test_settings
+
+``replica`` is a test mirror of ``default``; ``shard1`` and ``shard2`` are
+separate SQLite databases. Replicas and shards are only switched on by the
+tests that use them (``DATABASE_REPLICAS``, ``DATABASE_SHARDS``); with the
+plain settings those tests are skipped.
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DATABASES
+
+DATABASES = {
+    **DATABASES,
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    },
+    'shard1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db_shard1.sqlite3',
+    },
+    'shard2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db_shard2.sqlite3',
+    },
+}
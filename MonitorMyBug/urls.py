@@ -18,6 +18,7 @@ from django.contrib import admin
 from django.urls import path, include
 from django.http import JsonResponse
 from django.shortcuts import redirect
+from anttracker.metrics import metrics_view
 
 def api_root(request):
     """API root endpoint with available endpoints"""
@@ -36,14 +37,27 @@ def api_root(request):
             'devices': {
                 'list_devices': '/api/devices/',
                 'device_detail': '/api/devices/{id}/',
+                'device_health': '/api/devices/health/',
+                'bulk_provision': '/api/devices/bulk/',
+                'rotate_keys': '/api/devices/rotate-keys/',
                 'device_data_submission': '/api/device-data/{device_id}/',
+                'device_sensor_data': '/api/device-sensor-data/',
+                'api_status': '/api/api-status/',
             },
             'dashboard': {
                 'dashboard': '/api/dashboard/',
                 'sensor_data': '/api/sensor-data/',
                 'alerts': '/api/alerts/',
             },
+            'alert_rules': {
+                'list_rules': '/api/alert-rules/',
+                'rule_detail': '/api/alert-rules/{id}/',
+            },
+            'fleet': {
+                'regional_aggregates': '/api/fleet/regions/',
+            },
             'admin': '/admin/',
+            'metrics': '/metrics',
         }
     })
 
@@ -55,6 +69,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('anttracker.urls')),
     path('api-docs/', api_root, name='api-root'),  # Move API docs to /api-docs/
+    path('metrics', metrics_view, name='metrics'),
     path('', home_redirect, name='home'),  # Redirect root to dashboard
 ]
 
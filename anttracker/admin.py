@@ -1,7 +1,183 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import PAGE_VAR
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
-from .models import Farmer, Device, SensorData, AlertLog
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils import timezone
+from django.utils.functional import cached_property
+from .models import Farmer, Device, SensorData, AlertLog, AlertRule, AlertReevaluation
+
+
+def table_row_estimate(model, using):
+    """Planner statistics row count for a table, None when the backend has none"""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                "SELECT table_rows FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name = %s", [table]
+            )
+        else:
+            return None
+        row = cursor.fetchone()
+    # reltuples is -1 for a table that was never analyzed
+    return int(row[0]) if row and row[0] is not None and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that never runs an unbounded COUNT(*) over a large table"""
+
+    @cached_property
+    def count(self):
+        limit = getattr(settings, 'ADMIN_EXACT_COUNT_LIMIT', 10000)
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = table_row_estimate(queryset.model, queryset.db)
+            if estimate is not None and estimate > limit:
+                return estimate
+        # Stop counting after limit + 1 rows; a result of limit + 1 reads as "more than limit"
+        return queryset.order_by()[:limit + 1].count()
+
+
+class InputFilter(admin.SimpleListFilter):
+    """Exact-match text filter, for relations too large to list as choices"""
+    template = 'admin/anttracker/input_filter.html'
+    lookup = None
+
+    def lookups(self, request, model_admin):
+        # Must be non-empty for the filter to be shown
+        return ((),)
+
+    def choices(self, changelist):
+        # Only used to carry the other active filters through the form
+        yield {
+            'query_parts': [
+                (key, value) for key, value in changelist.params.items()
+                if key not in (self.parameter_name, PAGE_VAR)
+            ],
+        }
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{self.lookup: self.value().strip()})
+        return queryset
+
+
+class BoundedDateFilter(admin.SimpleListFilter):
+    """
+    Date filter with calendar-based choices instead of a date hierarchy.
+
+    The choices need no query (the date hierarchy runs DISTINCT date scans),
+    every choice is a range on an indexed column, and without a choice only
+    the last ADMIN_DEFAULT_DAYS days are shown. Values that are not one of
+    the choices are rejected like any other bad changelist parameter.
+    """
+    title = 'date'
+    parameter_name = 'period'
+    field_name = None
+    ALL = 'all'
+
+    def lookups(self, request, model_admin):
+        days = getattr(settings, 'ADMIN_DEFAULT_DAYS', 7)
+        today = timezone.localdate()
+        choices = [('today', 'Today'), (None, f'Past {days} days'), ('30d', 'Past 30 days')]
+        month = today.replace(day=1)
+        for _ in range(12):
+            choices.append((month.strftime('%Y-%m'), month.strftime('%B %Y')))
+            month = (month - timedelta(days=1)).replace(day=1)
+        choices.append((self.ALL, 'All time'))
+        return choices
+
+    def choices(self, changelist):
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': self.value() == lookup,
+                'query_string': changelist.get_query_string(
+                    {self.parameter_name: lookup} if lookup else {}, [self.parameter_name]
+                ),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        if value is not None and value not in {lookup for lookup, _ in self.lookup_choices}:
+            raise IncorrectLookupParameters(f'Unknown {self.parameter_name} {value!r}')
+        if value == self.ALL:
+            return queryset
+        now = timezone.localtime()
+        start_of_today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        if value == 'today':
+            return queryset.filter(**{f'{self.field_name}__gte': start_of_today})
+        if value == '30d':
+            return queryset.filter(**{f'{self.field_name}__gte': now - timedelta(days=30)})
+        if value:
+            year, month = (int(part) for part in value.split('-'))
+            start = start_of_today.replace(year=year, month=month, day=1)
+            end = (start + timedelta(days=32)).replace(day=1)
+            return queryset.filter(**{f'{self.field_name}__gte': start, f'{self.field_name}__lt': end})
+        days = getattr(settings, 'ADMIN_DEFAULT_DAYS', 7)
+        return queryset.filter(**{f'{self.field_name}__gte': now - timedelta(days=days)})
+
+
+class SensorDataDateFilter(BoundedDateFilter):
+    field_name = 'timestamp'
+
+
+class AlertLogDateFilter(BoundedDateFilter):
+    field_name = 'sent_at'
+
+
+class FarmerUsernameFilter(InputFilter):
+    title = 'farmer username'
+    parameter_name = 'farmer'
+    lookup = 'device__farmer__user__username'
+
+
+class DeviceIdFilter(InputFilter):
+    title = 'device ID'
+    parameter_name = 'device_id'
+    lookup = 'device__device_id'
+
+
+class AlertFarmerUsernameFilter(FarmerUsernameFilter):
+    lookup = 'device__farmer__user__username'
+
+
+class AlertDeviceIdFilter(DeviceIdFilter):
+    lookup = 'device__device_id'
+
+
+class AlertTypeFilter(admin.SimpleListFilter):
+    """Alert types from the rule table and built-in alerts, not a DISTINCT over all logs"""
+    title = 'alert type'
+    parameter_name = 'alert_type'
+
+    def lookups(self, request, model_admin):
+        from .heartbeat import DEVICE_OFFLINE_ALERT, DEVICE_ONLINE_ALERT
+        from .rules import ANT_THRESHOLD_ALERT
+        types = {ANT_THRESHOLD_ALERT, DEVICE_OFFLINE_ALERT, DEVICE_ONLINE_ALERT}
+        types.update(AlertRule.objects.order_by().values_list('alert_type', flat=True).distinct())
+        return [(alert_type, alert_type) for alert_type in sorted(types)]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(alert_type=self.value())
+        return queryset
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelist settings for tables with millions of rows"""
+    paginator = EstimatedCountPaginator
+    # Skip the second, unfiltered COUNT(*) behind "(N total)"
+    show_full_result_count = False
 
 
 class FarmerInline(admin.StackedInline):
@@ -18,10 +194,11 @@ class ExtendedUserAdmin(UserAdmin):
 
 class DeviceAdmin(admin.ModelAdmin):
     """Admin configuration for Device model"""
-    list_display = ['device_name', 'device_id', 'farmer', 'location', 'is_active', 'created_at']
-    list_filter = ['is_active', 'created_at', 'farmer']
+    list_display = ['device_name', 'device_id', 'farmer', 'location', 'is_active', 'health_state', 'last_seen', 'created_at']
+    list_select_related = ['farmer__user']
+    list_filter = ['is_active', 'health_state', 'created_at', 'farmer']
     search_fields = ['device_name', 'device_id', 'location']
-    readonly_fields = ['api_key', 'created_at', 'updated_at']
+    readonly_fields = ['api_key', 'last_seen', 'health_state', 'health_changed_at', 'created_at', 'updated_at']
     
     fieldsets = (
         ('Basic Information', {
@@ -30,6 +207,9 @@ class DeviceAdmin(admin.ModelAdmin):
         ('Status & Security', {
             'fields': ('is_active', 'api_key')
         }),
+        ('Health', {
+            'fields': ('last_seen', 'health_state', 'health_changed_at')
+        }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
             'classes': ('collapse',)
@@ -37,13 +217,15 @@ class DeviceAdmin(admin.ModelAdmin):
     )
 
 
-class SensorDataAdmin(admin.ModelAdmin):
+class SensorDataAdmin(LargeTableAdmin):
     """Admin configuration for SensorData model"""
     list_display = ['device', 'timestamp', 'temperature', 'humidity', 'ant_count', 'mealy_bugs_count']
-    list_filter = ['timestamp', 'device__farmer', 'is_rainfall', 'is_irrigation']
-    search_fields = ['device__device_name', 'device__device_id']
+    list_select_related = ['device']
+    list_filter = [SensorDataDateFilter, FarmerUsernameFilter, DeviceIdFilter, 'is_rainfall', 'is_irrigation']
+    # Exact / prefix matches can use indexes, unlike the default icontains
+    search_fields = ['=device__device_id', '^device__device_name']
     readonly_fields = ['created_at']
-    date_hierarchy = 'timestamp'
+    autocomplete_fields = ['device']
     
     fieldsets = (
         ('Device Information', {
@@ -65,13 +247,32 @@ class SensorDataAdmin(admin.ModelAdmin):
     )
 
 
-class AlertLogAdmin(admin.ModelAdmin):
+class AlertLogAdmin(LargeTableAdmin):
     """Admin configuration for AlertLog model"""
-    list_display = ['sensor_data', 'alert_type', 'sent_to', 'sent_at']
-    list_filter = ['alert_type', 'sent_at', 'sensor_data__device__farmer']
-    search_fields = ['sensor_data__device__device_name', 'sent_to']
+    list_display = ['device', 'sensor_data', 'alert_type', 'sent_to', 'sent_at', 'reevaluated']
+    list_select_related = ['device', 'sensor_data__device']
+    list_filter = [AlertLogDateFilter, AlertTypeFilter, AlertFarmerUsernameFilter, AlertDeviceIdFilter]
+    search_fields = ['=device__device_id', '^device__device_name', '=sent_to']
     readonly_fields = ['sent_at']
-    date_hierarchy = 'sent_at'
+    raw_id_fields = ['device', 'sensor_data']
+
+
+class AlertRuleAdmin(admin.ModelAdmin):
+    """Admin configuration for AlertRule model"""
+    list_display = ['name', 'farmer', 'device', 'alert_type', 'consecutive_readings', 'is_active']
+    list_filter = ['is_active', 'alert_type']
+    search_fields = ['name', 'farmer__user__username', 'device__device_id']
+    readonly_fields = ['created_at', 'updated_at']
+
+
+class AlertReevaluationAdmin(admin.ModelAdmin):
+    """Admin configuration for AlertReevaluation jobs, for following their progress"""
+    list_display = ['id', 'farmer', 'reason', 'status', 'chunks_done', 'chunks_total', 'readings_checked',
+                    'alerts_written', 'created_at', 'finished_at']
+    list_filter = ['status']
+    search_fields = ['farmer__user__username', 'reason']
+    readonly_fields = ['chunks_total', 'chunks_done', 'readings_checked', 'alerts_written', 'created_at',
+                       'started_at', 'finished_at']
 
 
 class FarmerAdmin(admin.ModelAdmin):
@@ -107,6 +308,8 @@ admin.site.register(Farmer, FarmerAdmin)
 admin.site.register(Device, DeviceAdmin)
 admin.site.register(SensorData, SensorDataAdmin)
 admin.site.register(AlertLog, AlertLogAdmin)
+admin.site.register(AlertRule, AlertRuleAdmin)
+admin.site.register(AlertReevaluation, AlertReevaluationAdmin)
 
 # Customize admin site header
 admin.site.site_header = "MonitorMyBug Administration"
@@ -0,0 +1,248 @@
+"""
+Fleet-wide pest statistics per farm location and day.
+
+``RegionDailyAggregate`` keeps, for every ``Farmer.farm_location`` (the
+region) and day: the number of readings, the devices that reported, and
+sum, maximum and a fixed-bucket histogram of ant and mealy bug counts. All
+of these merge by addition or union. Rows from several shards and from
+successive rollups therefore fold into the same aggregate, and any range of
+days and regions is answered from aggregate rows alone.
+
+``rollup`` folds new ``SensorData`` rows of one database into the
+aggregates (the ``rollup_aggregates`` command runs it for every shard). It
+remembers the last primary key folded per database in
+``AggregateWatermark``, so each reading is counted once. The watermark and
+the aggregates are updated in one transaction. Rows newer than
+``AGGREGATE_ROLLUP_LAG`` seconds are left for the next run, so inserts that
+commit out of primary key order are not skipped. Readings count towards
+the region their farmer had at rollup time.
+
+``regional_summary`` merges aggregate rows into the payload of the
+staff-only ``/api/fleet/regions/`` endpoint; percentiles are estimated from
+the histograms.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Case, Count, IntegerField, Max, Min, Sum, Value, When
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import AggregateWatermark, Device, RegionDailyAggregate, SensorData
+from .sharding import shard_id_range
+
+
+# Lower edges of the count histogram buckets; the last bucket is open-ended
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000)
+
+# Pest counts kept per aggregate: SensorData field -> aggregate field prefix
+PEST_COUNTS = {
+    'ant_count': 'ant',
+    'mealy_bugs_count': 'mealy_bugs',
+}
+
+QUANTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+
+def rollup_lag():
+    """Seconds a new reading waits before a rollup may fold it in"""
+    return getattr(settings, 'AGGREGATE_ROLLUP_LAG', 60)
+
+
+def rollup_batch_size():
+    return getattr(settings, 'AGGREGATE_ROLLUP_BATCH', 50000)
+
+
+def region_name(location):
+    """Region key of a farm location: the location with whitespace collapsed"""
+    return ' '.join((location or '').split())
+
+
+def bucket_expression(field):
+    """Index of the COUNT_BUCKETS bucket a count falls into"""
+    return Case(
+        *[When(**{f'{field}__lt': upper}, then=Value(i)) for i, upper in enumerate(COUNT_BUCKETS[1:])],
+        default=Value(len(COUNT_BUCKETS) - 1),
+        output_field=IntegerField(),
+    )
+
+
+def _empty_aggregate():
+    aggregate = {'readings': 0, 'devices': set()}
+    for prefix in PEST_COUNTS.values():
+        aggregate.update({
+            f'{prefix}_sum': 0, f'{prefix}_max': 0, f'{prefix}_histogram': [0] * len(COUNT_BUCKETS),
+        })
+    return aggregate
+
+
+def _merge(aggregate, other):
+    """Add other (an aggregate dict or RegionDailyAggregate) into aggregate"""
+    get = other.get if isinstance(other, dict) else lambda name: getattr(other, name)
+    aggregate['readings'] += get('readings')
+    aggregate['devices'].update(get('devices'))
+    for prefix in PEST_COUNTS.values():
+        aggregate[f'{prefix}_sum'] += get(f'{prefix}_sum')
+        aggregate[f'{prefix}_max'] = max(aggregate[f'{prefix}_max'], get(f'{prefix}_max'))
+        histogram = aggregate[f'{prefix}_histogram']
+        for i, count in enumerate(get(f'{prefix}_histogram')):
+            histogram[i] += count
+
+
+def _group_readings(readings):
+    """Per (region, day) aggregates of a SensorData queryset, computed by the database"""
+    groups = list(
+        readings.order_by().values(
+            'device_id', day=TruncDate('timestamp'),
+            **{f'{prefix}_bucket': bucket_expression(field) for field, prefix in PEST_COUNTS.items()},
+        ).annotate(
+            readings=Count('id'),
+            **{f'{prefix}_sum': Sum(field) for field, prefix in PEST_COUNTS.items()},
+            **{f'{prefix}_max': Max(field) for field, prefix in PEST_COUNTS.items()},
+        )
+    )
+    locations = dict(
+        Device.objects.using(readings.db).filter(pk__in={g['device_id'] for g in groups})
+        .values_list('pk', 'farmer__farm_location')
+    )
+    aggregates = {}
+    for group in groups:
+        key = (region_name(locations.get(group['device_id'])), group['day'])
+        aggregate = aggregates.setdefault(key, _empty_aggregate())
+        aggregate['readings'] += group['readings']
+        aggregate['devices'].add(group['device_id'])
+        for prefix in PEST_COUNTS.values():
+            aggregate[f'{prefix}_sum'] += group[f'{prefix}_sum'] or 0
+            aggregate[f'{prefix}_max'] = max(aggregate[f'{prefix}_max'], group[f'{prefix}_max'] or 0)
+            aggregate[f'{prefix}_histogram'][group[f'{prefix}_bucket']] += group['readings']
+    return aggregates
+
+
+def _store(aggregates):
+    """Merge per (region, day) aggregates into RegionDailyAggregate rows"""
+    existing = {
+        (row.region, row.day): row
+        for row in RegionDailyAggregate.objects.using(DEFAULT_DB_ALIAS).select_for_update().filter(
+            region__in={region for region, _ in aggregates}, day__in={day for _, day in aggregates},
+        )
+    }
+    created, updated = [], []
+    for (region, day), aggregate in aggregates.items():
+        row = existing.get((region, day))
+        if row is None:
+            row = RegionDailyAggregate(region=region, day=day)
+            merged = _empty_aggregate()
+            created.append(row)
+        else:
+            merged = _empty_aggregate()
+            _merge(merged, row)
+            updated.append(row)
+        _merge(merged, aggregate)
+        merged['devices'] = sorted(merged['devices'])
+        for name, value in merged.items():
+            setattr(row, name, value)
+    fields = list(_empty_aggregate())
+    RegionDailyAggregate.objects.using(DEFAULT_DB_ALIAS).bulk_create(created, batch_size=500)
+    RegionDailyAggregate.objects.using(DEFAULT_DB_ALIAS).bulk_update(updated, fields, batch_size=500)
+
+
+def rollup(alias=DEFAULT_DB_ALIAS, batch_size=None, now=None):
+    """Fold readings of one database stored since the last rollup into the aggregates
+
+    Returns the number of readings folded. Only readings with primary keys
+    in the database's own range are counted, so rows copied in by a shard
+    move are not counted twice.
+    """
+    batch_size = batch_size or rollup_batch_size()
+    cutoff = (now or timezone.now()) - timedelta(seconds=rollup_lag())
+    low, high = shard_id_range(alias)
+    watermark, _ = AggregateWatermark.objects.using(DEFAULT_DB_ALIAS).get_or_create(database=alias)
+    last = max(watermark.last_id, low - 1)
+
+    readings = SensorData.objects.using(alias).filter(pk__lt=high)
+    upper = readings.filter(pk__gt=last, created_at__lt=cutoff).order_by('-pk').values_list('pk', flat=True).first()
+    folded = 0
+    while upper is not None and last < upper:
+        pending = readings.filter(pk__gt=last, pk__lte=upper)
+        boundary = pending.order_by('pk').values_list('pk', flat=True)[batch_size - 1:batch_size].first() or upper
+        batch = pending.filter(pk__lte=boundary)
+        aggregates = _group_readings(batch)
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            watermark = AggregateWatermark.objects.using(DEFAULT_DB_ALIAS).select_for_update().get(database=alias)
+            if max(watermark.last_id, low - 1) != last:
+                # Another rollup of this database got here first
+                break
+            _store(aggregates)
+            watermark.last_id = boundary
+            watermark.save(using=DEFAULT_DB_ALIAS)
+        folded += sum(aggregate['readings'] for aggregate in aggregates.values())
+        last = boundary
+    AggregateWatermark.objects.using(DEFAULT_DB_ALIAS).filter(database=alias).update(updated_at=timezone.now())
+    return folded
+
+
+def rebuild():
+    """Drop every aggregate and watermark so the next rollups start from scratch"""
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        RegionDailyAggregate.objects.using(DEFAULT_DB_ALIAS).all().delete()
+        AggregateWatermark.objects.using(DEFAULT_DB_ALIAS).all().delete()
+
+
+def histogram_quantile(histogram, quantile, maximum):
+    """Estimate a quantile from bucket counts, interpolating within the bucket"""
+    total = sum(histogram)
+    if not total:
+        return None
+    target = quantile * total
+    seen = 0
+    for i, count in enumerate(histogram):
+        if count and seen + count >= target:
+            lower = COUNT_BUCKETS[i]
+            upper = COUNT_BUCKETS[i + 1] if i + 1 < len(COUNT_BUCKETS) else max(maximum, lower)
+            estimate = lower + (target - seen) / count * (upper - lower)
+            return round(min(estimate, maximum), 1)
+        seen += count
+    return maximum
+
+
+def _summary(aggregate):
+    summary = {'readings': aggregate['readings'], 'devices': len(aggregate['devices'])}
+    for prefix in PEST_COUNTS.values():
+        maximum = aggregate[f'{prefix}_max']
+        histogram = aggregate[f'{prefix}_histogram']
+        summary[prefix] = {
+            'mean': round(aggregate[f'{prefix}_sum'] / aggregate['readings'], 2) if aggregate['readings'] else None,
+            'max': maximum,
+            **{name: histogram_quantile(histogram, q, maximum) for name, q in QUANTILES},
+            'histogram': histogram,
+        }
+    return summary
+
+
+def regional_summary(start, end, region=None, by_day=False):
+    """Merged aggregates per region (and day) between two dates, inclusive"""
+    rows = RegionDailyAggregate.objects.filter(day__gte=start, day__lte=end)
+    if region is not None:
+        rows = rows.filter(region=region_name(region))
+    merged = {}
+    for row in rows.order_by('region', 'day'):
+        key = (row.region, row.day) if by_day else (row.region,)
+        _merge(merged.setdefault(key, _empty_aggregate()), row)
+
+    results = []
+    for key, aggregate in merged.items():
+        result = {'region': key[0] or None}
+        if by_day:
+            result['day'] = key[1]
+        result.update(_summary(aggregate))
+        results.append(result)
+    return {
+        'start': start,
+        'end': end,
+        'interval': 'day' if by_day else 'total',
+        'buckets': COUNT_BUCKETS,
+        # Oldest last rollup over all databases; newer readings may be missing
+        'rolled_up_at': AggregateWatermark.objects.aggregate(oldest=Min('updated_at'))['oldest'],
+        'regions': results,
+    }
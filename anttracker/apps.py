@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class AnttrackerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'anttracker'
+
+    def ready(self):
+        # Register alert rule and authentication cache invalidation signals
+        from . import rules  # noqa: F401
+        from . import authentication  # noqa: F401
+        # Register shard replication, device directory and ID range signals
+        from . import sharding  # noqa: F401
+        # Queue alert re-evaluation when alert rules change
+        from . import reevaluation  # noqa: F401
@@ -0,0 +1,183 @@
+"""
+Static asset pipeline for the dashboard pages.
+
+``collectstatic`` writes every asset under a content-hashed name (Django's
+manifest storage) and, next to each compressible file, a ``.gz`` and, when
+the optional ``brotli`` package is installed, a ``.br`` copy compressed at
+the highest level once at build time. Assets that have not been collected
+(the test runner, or ``DEBUG = False`` before ``collectstatic``) are linked
+by their plain name instead of failing the page.
+
+``StaticAssetMiddleware`` serves ``STATIC_ROOT`` from the app process
+without going through URL routing or views: it picks the best precompressed
+variant for the client's ``Accept-Encoding``, answers conditional requests
+with 304, and marks hashed names as immutable for a year so repeat visits
+load nothing from the network. Unhashed names get ``STATIC_MAX_AGE``.
+"""
+import gzip
+import json
+import mimetypes
+import os
+from email.utils import formatdate
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+
+from .compression import is_compressible, parse_accept_encoding
+
+try:
+    import brotli
+except ImportError:  # Optional dependency
+    brotli = None
+
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Encodings in order of preference, with the suffix of their precompressed file
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Files too small to be worth a compressed copy, and the saving a copy must reach
+MIN_COMPRESS_SIZE = 256
+MIN_COMPRESS_RATIO = 0.95
+
+
+def content_type_for(name):
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if is_compressible(content_type):
+        content_type += '; charset=utf-8'
+    return content_type
+
+
+def compress_file(path):
+    """Write .gz (and .br) copies of a file, keeping only those that save space"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return []
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+    written = []
+    for suffix, body in variants:
+        if len(body) < len(data) * MIN_COMPRESS_RATIO:
+            with open(path + suffix, 'wb') as f:
+                f.write(body)
+            written.append(path + suffix)
+    return written
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Manifest storage that also precompresses every collected text asset"""
+
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            # Not collected, so there is no hashed copy to link to
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        # Original and hashed names are both served, so compress both
+        names = set(paths) | set(self.hashed_files.values())
+        for name in sorted(names):
+            if is_compressible(content_type_for(name)) and self.exists(name):
+                compress_file(self.path(name))
+
+
+class StaticAsset:
+    __slots__ = ('content_type', 'immutable', 'variants')
+
+    def __init__(self, content_type, immutable, variants):
+        self.content_type = content_type
+        self.immutable = immutable
+        # encoding (None for identity) -> (path, size, mtime)
+        self.variants = variants
+
+
+def build_index(root, manifest_name='staticfiles.json'):
+    """Map each URL-relative file name under root to its servable variants"""
+    hashed_names = set()
+    try:
+        with open(os.path.join(root, manifest_name)) as f:
+            hashed_names = set(json.load(f).get('paths', {}).values())
+    except (OSError, ValueError):
+        pass
+
+    suffixes = {suffix for _, suffix in ENCODINGS}
+    index = {}
+    for directory, _, files in os.walk(root):
+        for filename in files:
+            if os.path.splitext(filename)[1] in suffixes:
+                continue
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            variants = {}
+            for encoding, suffix in ((None, ''),) + ENCODINGS:
+                try:
+                    stat = os.stat(path + suffix)
+                except OSError:
+                    continue
+                variants[encoding] = (path + suffix, stat.st_size, stat.st_mtime)
+            index[name] = StaticAsset(content_type_for(name), name in hashed_names, variants)
+    return index
+
+
+class StaticAssetMiddleware:
+    """Serve collected static files, precompressed and with long-lived cache headers"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        root = settings.STATIC_ROOT
+        # In development runserver serves assets straight from the apps
+        if settings.DEBUG or not root or not os.path.isdir(root):
+            raise MiddlewareNotUsed
+        self.prefix = urlparse(settings.STATIC_URL).path
+        self.max_age = getattr(settings, 'STATIC_MAX_AGE', 60)
+        self.index = build_index(str(root))
+
+    def __call__(self, request):
+        if request.method in ('GET', 'HEAD') and request.path_info.startswith(self.prefix):
+            asset = self.index.get(request.path_info[len(self.prefix):])
+            if asset is not None:
+                return self.serve(request, asset)
+        return self.get_response(request)
+
+    def choose_encoding(self, request, asset):
+        accepted = parse_accept_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        wildcard = accepted.get('*', 0)
+        for encoding, _ in ENCODINGS:
+            if encoding in asset.variants and accepted.get(encoding, wildcard) > 0:
+                return encoding
+        return None
+
+    def serve(self, request, asset):
+        encoding = self.choose_encoding(request, asset)
+        path, size, mtime = asset.variants[encoding]
+        etag = f'"{int(mtime):x}-{size:x}{"-" + encoding if encoding else ""}"'
+
+        if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            response = HttpResponseNotModified()
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=asset.content_type)
+            # FileResponse names the file for downloads; these are served inline
+            del response['Content-Disposition']
+            if encoding:
+                response['Content-Encoding'] = encoding
+        response['ETag'] = etag
+        response['Last-Modified'] = formatdate(mtime, usegmt=True)
+        if asset.immutable:
+            response['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        else:
+            response['Cache-Control'] = f'public, max-age={self.max_age}'
+        if len(asset.variants) > 1:
+            patch_vary_headers(response, ('Accept-Encoding',))
+        return response
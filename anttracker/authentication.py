@@ -0,0 +1,108 @@
+"""
+Cached user resolution for session and token authenticated requests.
+
+Session requests resolve the user through ``CachedModelBackend.get_user``
+and token requests through ``CachedTokenAuthentication``. Both load the
+user together with its farmer profile in one query and keep the result in
+the default cache for ``AUTH_CACHE_TIMEOUT`` seconds, so ``request.user``
+and ``request.user.farmer`` cost no queries on a warm cache. Together with
+the ``cached_db`` session engine a dashboard request reaches the view
+without touching the session, token, user or farmer tables.
+
+Entries are dropped when the user, its farmer profile or a token is saved
+or deleted, and on logout; password changes go through ``User.save``.
+"""
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.signals import user_logged_out
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .models import Farmer
+
+
+User = get_user_model()
+
+
+def auth_cache_timeout():
+    """Seconds a resolved user or token stays cached"""
+    return getattr(settings, 'AUTH_CACHE_TIMEOUT', 300)
+
+
+def _user_key(user_id):
+    return f'auth_user:{user_id}'
+
+
+def _token_key(key):
+    # Never use the raw credential as a cache key
+    return f'auth_token:{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+def invalidate_user(user_id):
+    """Forget the cached user and every cached token of that user"""
+    keys = [_user_key(user_id)]
+    keys += [_token_key(key) for key in Token.objects.filter(user_id=user_id).values_list('key', flat=True)]
+    cache.delete_many(keys)
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend whose get_user (run on every session request) is served from the cache"""
+
+    def get_user(self, user_id):
+        user = cache.get(_user_key(user_id))
+        if user is None:
+            try:
+                # Reverse one-to-one: caches the farmer, or its absence, on the user
+                user = User._default_manager.select_related('farmer').get(pk=user_id)
+            except User.DoesNotExist:
+                return None
+            cache.set(_user_key(user_id), user, auth_cache_timeout())
+        return user if self.user_can_authenticate(user) else None
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that keeps token -> user (with farmer) in the cache"""
+
+    def authenticate_credentials(self, key):
+        token = cache.get(_token_key(key))
+        if token is None:
+            try:
+                token = Token.objects.select_related('user__farmer').get(key=key)
+            except Token.DoesNotExist:
+                raise exceptions.AuthenticationFailed('Invalid token.')
+            cache.set(_token_key(key), token, auth_cache_timeout())
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        return (token.user, token)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def _user_changed(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=Farmer)
+@receiver(post_delete, sender=Farmer)
+def _farmer_changed(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def _token_changed(sender, instance, **kwargs):
+    cache.delete(_token_key(instance.key))
+
+
+@receiver(user_logged_out)
+def _user_logged_out(sender, request, user, **kwargs):
+    if user is not None:
+        invalidate_user(user.pk)
@@ -0,0 +1,196 @@
+"""
+Encoding helpers for the compact sensor data layout (``CompactSensorData``).
+
+The compact table stores readings in fixed-point ``smallint`` columns
+instead of 8-byte floats, both boolean flags as bits of one ``smallint``
+and ``created_at`` as a 4-byte delay in seconds after ``timestamp``.
+Counts keep ``SensorData``'s ``integer`` range so every reading can be
+copied. The model exposes the usual reading names (``temperature``,
+``is_rainfall``, ``created_at``, ...) as properties, so
+``SensorDataSerializer``'s fields and keyword construction keep working.
+
+The queryset translates lookups and ``order_by`` on those names into
+lookups on the stored columns, at the stored resolution, in keyword
+arguments and ``Q`` objects alike:
+
+    CompactSensorData.objects.filter(temperature__gte=30, is_rainfall=True)
+    CompactSensorData.objects.filter(Q(temperature__gte=30) | Q(humidity__lt=20))
+
+The layout is not used by the API; ``benchmark_storage`` measures it
+against ``SensorData``.
+
+Use ``decoded(name)`` in annotations and aggregates.
+"""
+from copy import copy
+from datetime import timedelta
+
+from django.db import models
+from django.db.models import ExpressionWrapper, F, FloatField, Q, Value
+from django.utils import timezone
+
+
+SMALLINT_MIN, SMALLINT_MAX = -32768, 32767
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+# Reading name -> (stored column, scale); the stored value is round(value * scale)
+SCALED_FIELDS = {
+    'temperature': ('temperature_centi', 100),
+    'humidity': ('humidity_centi', 100),
+    'moisture': ('moisture_centi', 100),
+    'ml_confidence': ('ml_confidence_e4', 10000),
+}
+
+# Reading name -> bit in the flags column
+FLAG_BITS = {
+    'is_rainfall': 1,
+    'is_irrigation': 2,
+}
+
+def value_range(name):
+    """Smallest and largest value a scaled reading can store"""
+    scale = SCALED_FIELDS[name][1]
+    return SMALLINT_MIN / scale, SMALLINT_MAX / scale
+
+
+def encode(name, value):
+    if value is None:
+        return None
+    stored = round(value * SCALED_FIELDS[name][1])
+    if not SMALLINT_MIN <= stored <= SMALLINT_MAX:
+        low, high = value_range(name)
+        raise ValueError(f"{name} {value} is outside the compact range {low}..{high}")
+    return stored
+
+
+def decode(name, stored):
+    if stored is None:
+        return None
+    return stored / SCALED_FIELDS[name][1]
+
+
+def decoded(name):
+    """Expression for a scaled reading in its original unit"""
+    column, scale = SCALED_FIELDS[name]
+    return ExpressionWrapper(F(column) / Value(float(scale)), output_field=FloatField())
+
+
+def scaled_property(name):
+    column = SCALED_FIELDS[name][0]
+
+    def getter(self):
+        return decode(name, getattr(self, column))
+
+    def setter(self, value):
+        setattr(self, column, encode(name, value))
+
+    return property(getter, setter)
+
+
+def flag_property(name):
+    bit = FLAG_BITS[name]
+
+    def getter(self):
+        return bool(self.flags & bit)
+
+    def setter(self, value):
+        self.flags = (self.flags | bit) if value else (self.flags & ~bit)
+
+    return property(getter, setter)
+
+
+def created_at_property():
+    def getter(self):
+        if self.received_delay is None or self.timestamp is None:
+            return None
+        return self.timestamp + timedelta(seconds=self.received_delay)
+
+    def setter(self, value):
+        self.received_delay = None if value is None else receipt_delay(self.timestamp, value)
+
+    return property(getter, setter)
+
+
+def receipt_delay(timestamp, created_at):
+    """Whole seconds between recording and storing a reading, clamped to the column"""
+    seconds = round((created_at - timestamp).total_seconds())
+    return max(INT_MIN, min(INT_MAX, seconds))
+
+
+def _translate_lookup(key, value):
+    name, _, lookup = key.partition('__')
+    if name in SCALED_FIELDS:
+        column = SCALED_FIELDS[name][0]
+        if lookup in ('', 'exact', 'gt', 'gte', 'lt', 'lte'):
+            value = encode(name, value)
+        elif lookup in ('in', 'range'):
+            value = [encode(name, item) for item in value]
+        elif lookup != 'isnull':
+            raise ValueError(f"Lookup '{lookup}' is not supported on compact {name}")
+        return f'{column}__{lookup}' if lookup else column, value
+    if name in FLAG_BITS:
+        if lookup not in ('', 'exact'):
+            raise ValueError(f"Lookup '{lookup}' is not supported on compact {name}")
+        bit = FLAG_BITS[name]
+        combinations = range(2 ** len(FLAG_BITS))
+        # A handful of flag combinations, so a plain IN keeps the lookup index-friendly
+        return 'flags__in', [flags for flags in combinations if bool(flags & bit) == bool(value)]
+    return key, value
+
+
+def _translate_q(q):
+    """Copy of a Q tree with every lookup translated"""
+    translated = copy(q)
+    translated.children = [
+        _translate_q(child) if isinstance(child, Q) else _translate_lookup(*child)
+        for child in q.children
+    ]
+    return translated
+
+
+class CompactSensorDataQuerySet(models.QuerySet):
+    """QuerySet that accepts reading names in lookups and order_by"""
+
+    def _filter_or_exclude(self, negate, args, kwargs):
+        args = tuple(_translate_q(arg) if isinstance(arg, Q) else arg for arg in args)
+        kwargs = dict(_translate_lookup(key, value) for key, value in kwargs.items())
+        return super()._filter_or_exclude(negate, args, kwargs)
+
+    def order_by(self, *field_names):
+        translated = []
+        for field_name in field_names:
+            if isinstance(field_name, str):
+                descending = field_name.startswith('-')
+                name = field_name.lstrip('-')
+                if name in SCALED_FIELDS:
+                    field_name = ('-' if descending else '') + SCALED_FIELDS[name][0]
+            translated.append(field_name)
+        return super().order_by(*translated)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        now = timezone.now()
+        for obj in objs:
+            if obj.received_delay is None:
+                obj.received_delay = receipt_delay(obj.timestamp, now)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def copy_from(self, readings, batch_size=5000):
+        """Copy SensorData rows into the compact table, returning the number copied"""
+        names = ['device_id', 'timestamp', 'seq', 'created_at', 'ant_count', 'mealy_bugs_count',
+                 *SCALED_FIELDS, *FLAG_BITS]
+        copied = 0
+        batch = []
+        for row in readings.order_by().values(*names).iterator(chunk_size=batch_size):
+            batch.append(self.model(
+                device_id=row['device_id'], timestamp=row['timestamp'], seq=row['seq'],
+                received_delay=receipt_delay(row['timestamp'], row['created_at']),
+                ant_count=row['ant_count'], mealy_bugs_count=row['mealy_bugs_count'],
+                flags=sum(bit for name, bit in FLAG_BITS.items() if row[name]),
+                **{column: encode(name, row[name]) for name, (column, _) in SCALED_FIELDS.items()},
+            ))
+            if len(batch) >= batch_size:
+                copied += len(self.bulk_create(batch))
+                batch = []
+        if batch:
+            copied += len(self.bulk_create(batch))
+        return copied
@@ -0,0 +1,106 @@
+"""
+Response compression for API and page responses.
+
+Responses at least ``COMPRESSION_MIN_SIZE`` bytes long with a compressible
+content type are encoded with Brotli when the client accepts it and the
+optional ``brotli`` package is installed, otherwise with gzip. Smaller
+responses are sent as-is since the framing overhead would outweigh the gain.
+
+HTML is never compressed: pages carry CSRF tokens and session data next
+to text an attacker can influence, which compression would expose to
+BREACH-style length attacks.
+"""
+import gzip
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # Optional dependency
+    brotli = None
+
+
+COMPRESSIBLE_TYPES = (
+    'application/json', 'application/javascript', 'application/msgpack',
+    'application/xml', 'image/svg+xml',
+)
+
+
+# Left uncompressed; see the module docstring
+UNCOMPRESSED_TYPES = ('text/html',)
+
+
+def is_compressible(content_type):
+    content_type = content_type.split(';')[0].strip().lower()
+    if content_type in UNCOMPRESSED_TYPES:
+        return False
+    return content_type.startswith('text/') or content_type.endswith('+json') \
+        or content_type in COMPRESSIBLE_TYPES
+
+
+def parse_accept_encoding(header):
+    """Return {coding: q} for an Accept-Encoding header"""
+    accepted = {}
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+class CompressionMiddleware:
+    """Brotli/gzip-encode responses above a minimum size"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.min_size = getattr(settings, 'COMPRESSION_MIN_SIZE', 1024)
+        self.gzip_level = getattr(settings, 'COMPRESSION_GZIP_LEVEL', 6)
+        self.brotli_quality = getattr(settings, 'COMPRESSION_BROTLI_QUALITY', 5)
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.streaming or response.has_header('Content-Encoding') \
+                or not is_compressible(response.get('Content-Type', '')):
+            return response
+        # The body depends on Accept-Encoding from here on, even when left uncompressed
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if len(response.content) < self.min_size:
+            return response
+
+        encoding = self.choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding == 'br':
+            body = brotli.compress(response.content, quality=self.brotli_quality)
+        elif encoding == 'gzip':
+            body = gzip.compress(response.content, compresslevel=self.gzip_level, mtime=0)
+        else:
+            return response
+        if len(body) >= len(response.content):
+            return response
+
+        response.content = body
+        response['Content-Length'] = str(len(body))
+        response['Content-Encoding'] = encoding
+        # The encoded body is a different byte sequence from what a strong ETag names
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
+
+    def choose_encoding(self, header):
+        accepted = parse_accept_encoding(header)
+        wildcard = accepted.get('*', 0)
+        if brotli is not None and accepted.get('br', wildcard) > 0:
+            return 'br'
+        if accepted.get('gzip', wildcard) > 0:
+            return 'gzip'
+        return None
@@ -0,0 +1,143 @@
+"""
+Payload builders shared by the dashboard API views and the dashboard page.
+
+``/api/profile/``, ``/api/dashboard/`` and ``/api/sensor-data/`` build their
+responses here, and ``template_views.dashboard_page`` embeds the same
+payloads in the page so the browser can draw the first chart without any
+API round trip. Dashboard summaries are cached per farmer, ant threshold and
+date filter for ``DASHBOARD_CACHE_SECONDS`` so the page and the API share
+one result.
+
+Both sensor-data payloads accept ``since``, a timestamp: only newer readings
+are returned, which is how the page fetches deltas after bootstrapping.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Avg, Max, OuterRef, Subquery
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Device, SensorData
+from .serializers import FarmerSerializer, SensorDataSerializer
+
+
+# Readings sent with a dashboard payload, for the charts
+DASHBOARD_READINGS = 100
+
+
+def dashboard_cache_seconds():
+    return getattr(settings, 'DASHBOARD_CACHE_SECONDS', 30)
+
+
+def parse_since(value):
+    """Parse a ``since`` query parameter, None when missing or invalid"""
+    if not value:
+        return None
+    since = parse_datetime(value)
+    if since is not None and timezone.is_naive(since):
+        since = timezone.make_aware(since, timezone.utc)
+    return since
+
+
+def profile_payload(farmer):
+    return FarmerSerializer(farmer).data
+
+
+def sensor_data_queryset(farmer, device_id=None, start_date=None, end_date=None, since=None):
+    """Sensor data for a farmer's devices, newest first"""
+    queryset = SensorData.objects.filter(device__farmer=farmer).select_related('device__farmer__user')
+
+    # Filter by device if specified
+    if device_id:
+        queryset = queryset.filter(device__device_id=device_id)
+
+    # Filter by date range if specified
+    if start_date:
+        queryset = queryset.filter(timestamp__date__gte=start_date)
+    if end_date:
+        queryset = queryset.filter(timestamp__date__lte=end_date)
+    if since:
+        queryset = queryset.filter(timestamp__gt=since)
+
+    return queryset.order_by('-timestamp')
+
+
+def dashboard_queryset(farmer, start_date=None, end_date=None):
+    """Sensor data in the dashboard's period: the date filter, or the last 24 hours"""
+    queryset = sensor_data_queryset(farmer, start_date=start_date, end_date=end_date)
+
+    # If no date filter, get data from last 24 hours by default
+    if not start_date and not end_date:
+        yesterday = timezone.now() - timedelta(hours=24)
+        queryset = queryset.filter(timestamp__gte=yesterday)
+    return queryset
+
+
+def dashboard_summary(farmer, queryset):
+    """Summary statistics over the dashboard period"""
+    devices = Device.objects.filter(farmer=farmer)
+    total_devices = devices.count()
+
+    # Active devices = devices that have sent data in last 24 hours
+    yesterday = timezone.now() - timedelta(hours=24)
+    active_devices = devices.filter(last_seen__gte=yesterday).count()
+
+    # Averages over the current queryset (respects date filter)
+    stats = queryset.aggregate(
+        avg_temp=Avg('temperature'), avg_hum=Avg('humidity'), max_ants=Max('ant_count')
+    )
+
+    # Recent alerts = sensor readings with ant count above threshold in current period
+    recent_alerts = queryset.filter(
+        ant_count__gt=farmer.ant_threshold_limit
+    ).count()
+
+    # Get latest data for each device, in one query over the device/timestamp index
+    latest_ids = devices.annotate(latest_id=Subquery(
+        SensorData.objects.filter(device=OuterRef('pk')).order_by('-timestamp').values('pk')[:1]
+    )).values('latest_id')
+    latest_data = {}
+    for latest_sensor_data in SensorData.objects.filter(pk__in=latest_ids).select_related('device'):
+        latest_data[latest_sensor_data.device.device_name] = {
+            'timestamp': latest_sensor_data.timestamp,
+            'ant_count': latest_sensor_data.ant_count,
+            'temperature': latest_sensor_data.temperature,
+            'humidity': latest_sensor_data.humidity
+        }
+
+    return {
+        'total_devices': total_devices,
+        'active_devices': active_devices,
+        'recent_alerts': recent_alerts,
+        'avg_temperature': round(stats['avg_temp'] or 0, 1),
+        'avg_humidity': round(stats['avg_hum'] or 0, 1),
+        'max_ant_count': stats['max_ants'] or 0,
+        'latest_data': latest_data
+    }
+
+
+def dashboard_payload(farmer, start_date=None, end_date=None, since=None):
+    """Recent readings for the charts plus summary statistics, as served by /api/dashboard/"""
+    # The threshold decides recent_alerts, so a changed threshold misses the cache
+    key = f'dashboard:{farmer.pk}:{farmer.ant_threshold_limit}:{start_date or ""}:{end_date or ""}'
+    payload = cache.get(key)
+    if payload is None:
+        queryset = dashboard_queryset(farmer, start_date, end_date)
+        payload = {
+            'sensor_data': SensorDataSerializer(queryset[:DASHBOARD_READINGS], many=True).data,
+            'summary': dashboard_summary(farmer, queryset),
+        }
+        cache.set(key, payload, dashboard_cache_seconds())
+    if since:
+        payload = dict(payload, sensor_data=[
+            row for row in payload['sensor_data'] if parse_since(row['timestamp']) > since
+        ])
+    return payload
+
+
+def sensor_data_page(farmer, size, since=None):
+    """The first page of /api/sensor-data/ without filters"""
+    queryset = sensor_data_queryset(farmer, since=since)[:size]
+    return SensorDataSerializer(queryset, many=True).data
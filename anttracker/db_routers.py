@@ -0,0 +1,137 @@
+"""
+Read-replica routing for read-only API views.
+
+Everything goes to ``default`` unless a view opts in with
+``ReplicaReadMixin``: reads made while such a view handles a safe request
+go to one of ``DATABASE_REPLICAS``. Writes always go to ``default``, so
+ingest and every write path stay on the primary.
+
+A request that writes pins its user to the primary for
+``REPLICA_STICKY_SECONDS`` so they read their own writes despite
+replication lag. On PostgreSQL, replicas lagging more than
+``REPLICA_MAX_LAG_SECONDS`` are skipped until they catch up. Replicas get
+their schema through replication, so migrations never run on them.
+"""
+import contextvars
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+
+_routing = contextvars.ContextVar('db_routing', default=None)
+
+# alias -> (checked at, lag in seconds or None)
+_lag_checks = {}
+LAG_CHECK_INTERVAL = 5
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def _pin_key(user_id):
+    return f'db_primary_pin:{user_id}'
+
+
+def replica_lag(alias):
+    """Replication lag of a replica in seconds, None when it cannot be measured"""
+    checked_at, lag = _lag_checks.get(alias, (0, None))
+    if time.monotonic() - checked_at < LAG_CHECK_INTERVAL:
+        return lag
+    lag = None
+    connection = connections[alias]
+    if connection.vendor == 'postgresql':
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+                )
+                row = cursor.fetchone()
+                lag = float(row[0]) if row and row[0] is not None else None
+        except DatabaseError:
+            # An unreachable replica is treated as infinitely behind
+            lag = float('inf')
+    _lag_checks[alias] = (time.monotonic(), lag)
+    return lag
+
+
+def healthy_replicas():
+    max_lag = getattr(settings, 'REPLICA_MAX_LAG_SECONDS', 10)
+    return [alias for alias in replicas() if (replica_lag(alias) or 0) <= max_lag]
+
+
+def read_from_replica(request):
+    """Route the rest of this request's reads to a replica, unless its user is pinned"""
+    state = _routing.get()
+    if state is None or request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        return None
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated and cache.get(_pin_key(user.pk)):
+        return None
+    candidates = healthy_replicas()
+    if candidates:
+        state['replica'] = random.choice(candidates)
+    return state['replica']
+
+
+class ReplicaRouter:
+    """Send opted-in reads to a replica and every write to the primary"""
+
+    def db_for_read(self, model, **hints):
+        state = _routing.get()
+        if state is None or state['replica'] is None:
+            return None
+        # Reads inside a transaction on the primary must see that transaction
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return state['replica']
+
+    def db_for_write(self, model, **hints):
+        state = _routing.get()
+        if state is not None:
+            state['wrote'] = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replicas():
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    """Track each request's routing state and pin users to the primary after they write"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _routing.set({'replica': None, 'wrote': False})
+        try:
+            response = self.get_response(request)
+            state = _routing.get()
+            user = getattr(request, 'user', None)
+            if state['wrote'] and user is not None and user.is_authenticated:
+                cache.set(_pin_key(user.pk), True, getattr(settings, 'REPLICA_STICKY_SECONDS', 5))
+            return response
+        finally:
+            _routing.reset(token)
+
+
+class ReplicaReadMixin:
+    """Serve a DRF view's safe requests from a read replica"""
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # After authentication, so pinned users are recognised
+        read_from_replica(request)
@@ -0,0 +1,194 @@
+"""
+Device heartbeat tracking and offline detection.
+
+Ingest records when a device was last seen, coalesced to at most one write
+per device per heartbeat interval. A scheduled checker (the
+``check_device_health`` management command) compares ``Device.last_seen``
+against the offline window and emits offline/online alerts on transitions.
+Both only touch the ``Device`` table, so fleet health costs O(devices).
+Only accepted submissions count as a heartbeat. A device coming back online
+at ingest is emailed about once the state change commits. Status alerts are
+logged against the device, with its latest reading when it has one.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import send_mail
+from django.db import transaction
+from django.utils import timezone
+
+from .metrics import time_alert_send
+from .models import Device, AlertLog
+from .sharding import shards, using_shard
+
+
+logger = logging.getLogger(__name__)
+
+
+DEVICE_OFFLINE_ALERT = 'device_offline'
+DEVICE_ONLINE_ALERT = 'device_online'
+
+
+def heartbeat_interval():
+    """Minimum number of seconds between two last_seen writes for one device"""
+    return getattr(settings, 'DEVICE_HEARTBEAT_INTERVAL', 60)
+
+
+def offline_after():
+    """Silence after which a device is considered offline"""
+    return timedelta(seconds=getattr(settings, 'DEVICE_OFFLINE_AFTER', 3600))
+
+
+def record_heartbeat(device, now=None):
+    """Note that a device reported, writing last_seen at most once per interval"""
+    now = now or timezone.now()
+    interval = heartbeat_interval()
+
+    if device.last_seen and (now - device.last_seen).total_seconds() < interval \
+            and device.health_state == Device.HEALTH_ONLINE:
+        return False
+    # Coalesce concurrent requests that loaded the same stale device row
+    if not cache.add(f'device_heartbeat:{device.pk}', True, interval):
+        return False
+
+    Device.objects.filter(pk=device.pk).update(last_seen=now)
+    device.last_seen = now
+
+    # Flip back online straight away instead of waiting for the next check
+    if device.health_state != Device.HEALTH_ONLINE:
+        previous_state = device.health_state
+        with transaction.atomic(using=device._state.db):
+            updated = Device.objects.filter(pk=device.pk).exclude(
+                health_state=Device.HEALTH_ONLINE
+            ).update(health_state=Device.HEALTH_ONLINE, health_changed_at=now)
+            device.health_state = Device.HEALTH_ONLINE
+            device.health_changed_at = now
+            if updated and previous_state == Device.HEALTH_OFFLINE:
+                transaction.on_commit(
+                    lambda: send_device_status_alert(device, DEVICE_ONLINE_ALERT), using=device._state.db
+                )
+    return True
+
+
+def check_device_health(now=None, notify=True):
+    """Flag devices that stopped reporting and recover those that came back, on every shard"""
+    now = now or timezone.now()
+    result = {'offline': [], 'online': []}
+    for alias in shards():
+        with using_shard(alias):
+            shard_result = _check_shard_health(now, notify)
+        result['offline'] += shard_result['offline']
+        result['online'] += shard_result['online']
+    return result
+
+
+def _check_shard_health(now, notify):
+    """check_device_health for the devices of the active shard"""
+    cutoff = now - offline_after()
+    devices = Device.objects.filter(is_active=True).select_related('farmer__user')
+
+    went_offline = list(devices.filter(last_seen__lt=cutoff).exclude(health_state=Device.HEALTH_OFFLINE))
+    came_online = list(devices.filter(last_seen__gte=cutoff).exclude(health_state=Device.HEALTH_ONLINE))
+
+    if went_offline:
+        Device.objects.filter(pk__in=[d.pk for d in went_offline]).update(
+            health_state=Device.HEALTH_OFFLINE, health_changed_at=now
+        )
+    if came_online:
+        Device.objects.filter(pk__in=[d.pk for d in came_online]).update(
+            health_state=Device.HEALTH_ONLINE, health_changed_at=now
+        )
+
+    for device in went_offline:
+        previous_state, device.health_state = device.health_state, Device.HEALTH_OFFLINE
+        if previous_state == Device.HEALTH_ONLINE:
+            send_device_status_alert(device, DEVICE_OFFLINE_ALERT, notify=notify)
+    for device in came_online:
+        previous_state, device.health_state = device.health_state, Device.HEALTH_ONLINE
+        if previous_state == Device.HEALTH_OFFLINE:
+            send_device_status_alert(device, DEVICE_ONLINE_ALERT, notify=notify)
+
+    return {'offline': went_offline, 'online': came_online}
+
+
+def fleet_health(devices, now=None):
+    """Summarise reporting state for a device queryset from Device columns only"""
+    now = now or timezone.now()
+    cutoff = now - offline_after()
+    summary = {
+        'total': 0,
+        Device.HEALTH_ONLINE: 0,
+        Device.HEALTH_OFFLINE: 0,
+        Device.HEALTH_UNKNOWN: 0,
+        'devices': [],
+    }
+    for device in devices.only('id', 'device_id', 'device_name', 'last_seen', 'health_state'):
+        # Derive the state from last_seen so the view is right between checker runs
+        if device.last_seen is None:
+            state = Device.HEALTH_UNKNOWN
+        elif device.last_seen >= cutoff:
+            state = Device.HEALTH_ONLINE
+        else:
+            state = Device.HEALTH_OFFLINE
+        summary['total'] += 1
+        summary[state] += 1
+        summary['devices'].append({
+            'id': device.id,
+            'device_id': device.device_id,
+            'device_name': device.device_name,
+            'last_seen': device.last_seen,
+            'health_state': state,
+        })
+    return summary
+
+
+def send_device_status_alert(device, alert_type, notify=True):
+    """Email the farmer about a device going offline or coming back online"""
+    # Linked to the device's latest reading when there is one
+    latest_reading = device.sensor_data.order_by('-timestamp').first()
+    user = device.farmer.user
+    if alert_type == DEVICE_OFFLINE_ALERT:
+        subject = f"Device Offline: {device.device_name}"
+        summary = f'Device "{device.device_name}" has not reported since {device.last_seen:%Y-%m-%d %H:%M:%S}.'
+    else:
+        subject = f"Device Back Online: {device.device_name}"
+        summary = f'Device "{device.device_name}" is reporting again.'
+
+    def send():
+        try:
+            send_mail(
+                subject,
+                f"""
+Dear {user.first_name or user.username},
+
+{summary}
+
+Device Details:
+- Device: {device.device_name} ({device.device_id})
+- Location: {device.location or 'Not specified'}
+
+Best regards,
+MonitorMyBug System
+                """,
+                getattr(settings, 'DEFAULT_FROM_EMAIL', None) or 'noreply@monitormybug.com',
+                [user.email],
+                fail_silently=False,
+            )
+            return True
+        except Exception:
+            # Log the error but keep checking the rest of the fleet
+            logger.exception("Failed to send device status email")
+            return False
+
+    if notify and user.email:
+        time_alert_send(alert_type, send)
+
+    AlertLog.objects.create(
+        device=device,
+        sensor_data=latest_reading,
+        alert_type=alert_type,
+        message=summary,
+        sent_to=user.email or '',
+    )
@@ -0,0 +1,107 @@
+"""
+Duplicate detection for device readings carrying a client sequence number.
+
+Devices may send a per-device ``seq`` with each reading so that retried
+POSTs are acknowledged without writing a second row. The unique index on
+``(device, seq)`` is the source of truth; an in-memory high-water mark per
+device lets the common case (a sequence above anything this process has
+stored) skip the lookup entirely.
+
+Readings replayed from a write-behind spool may already have been committed
+before a crash; ``drop_replayed_rows`` recognises those by sequence number,
+or by device and timestamp for readings sent without one.
+"""
+import threading
+
+from django.db.models import Max
+from rest_framework import exceptions
+
+from .models import SensorData
+
+
+_high_water = {}
+_lock = threading.Lock()
+
+
+class SequenceConflict(exceptions.APIException):
+    status_code = 409
+    default_detail = 'A submission with this sequence number is in progress; retry shortly.'
+    default_code = 'sequence_conflict'
+
+
+def high_water_mark(device_id):
+    """Highest sequence number known to be stored for a device"""
+    if device_id not in _high_water:
+        latest = SensorData.objects.filter(device_id=device_id).aggregate(latest=Max('seq'))['latest']
+        with _lock:
+            _high_water.setdefault(device_id, latest)
+    return _high_water[device_id]
+
+
+def record_sequences(device_id, seqs):
+    """Raise the device's high-water mark after storing readings"""
+    seqs = [seq for seq in seqs if seq is not None]
+    if not seqs:
+        return
+    with _lock:
+        current = _high_water.get(device_id)
+        _high_water[device_id] = max(seqs) if current is None else max(current, max(seqs))
+
+
+def stored_sequences(device_id, seqs, check_all=False):
+    """Return the subset of seqs already stored for the device"""
+    seqs = {seq for seq in seqs if seq is not None}
+    if not seqs:
+        return set()
+    if not check_all:
+        hwm = high_water_mark(device_id)
+        if hwm is None:
+            return set()
+        seqs = {seq for seq in seqs if seq <= hwm}
+        if not seqs:
+            return set()
+    return set(
+        SensorData.objects.filter(device_id=device_id, seq__in=seqs).values_list('seq', flat=True)
+    )
+
+
+def drop_duplicates(device_id, items, seq_of, check_all=False):
+    """Split items into (new items, duplicate count), also collapsing repeats within items"""
+    stored = stored_sequences(device_id, [seq_of(item) for item in items], check_all=check_all)
+    fresh, seen, duplicates = [], set(), 0
+    for item in items:
+        seq = seq_of(item)
+        if seq is not None:
+            if seq in stored or seq in seen:
+                duplicates += 1
+                continue
+            seen.add(seq)
+        fresh.append(item)
+    return fresh, duplicates
+
+
+def drop_stored_rows(rows):
+    """Drop unsaved SensorData rows (of any devices) whose sequence is already stored"""
+    by_device = {}
+    for row in rows:
+        by_device.setdefault(row.device_id, []).append(row)
+    fresh = []
+    for device_id, device_rows in by_device.items():
+        device_rows, _ = drop_duplicates(device_id, device_rows, lambda row: row.seq, check_all=True)
+        fresh.extend(device_rows)
+    return fresh
+
+
+def drop_replayed_rows(rows):
+    """Drop unsaved SensorData rows that are already stored, by sequence or by exact timestamp"""
+    fresh = drop_stored_rows([row for row in rows if row.seq is not None])
+    by_device = {}
+    for row in rows:
+        if row.seq is None:
+            by_device.setdefault(row.device_id, []).append(row)
+    for device_id, device_rows in by_device.items():
+        stored = set(SensorData.objects.filter(
+            device_id=device_id, seq__isnull=True, timestamp__in={row.timestamp for row in device_rows},
+        ).values_list('timestamp', flat=True))
+        fresh.extend(row for row in device_rows if row.timestamp not in stored)
+    return fresh
@@ -0,0 +1,73 @@
+"""
+Ant and mealy-bug counting on trap images.
+
+This module runs inside the inference process pool, so it must not import
+Django. ``init_worker`` loads the detection model once per worker process
+and ``count_batch`` runs one batched forward pass over a micro-batch of
+encoded images.
+"""
+import io
+
+
+ANT_CLASSES = {'ant', 'ants'}
+MEALY_BUG_CLASSES = {'mealy_bug', 'mealybug', 'mealy bug', 'mealy_bugs', 'mealybugs', 'mealy bugs'}
+
+_model = None
+_options = {}
+
+
+def init_worker(model_path, confidence, image_size, threads):
+    """Process pool initializer: load the model once and pin the thread count"""
+    global _model
+    try:
+        import torch
+        # Several workers share the CPU; one BLAS/OpenMP pool each would oversubscribe it
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    from ultralytics import YOLO
+
+    _model = YOLO(model_path)
+    _options.update(conf=confidence, imgsz=image_size)
+
+
+def count_batch(images):
+    """Count ants and mealy bugs in each encoded image of a micro-batch"""
+    from PIL import Image
+
+    results = [None] * len(images)
+    frames, positions = [], []
+    for position, data in enumerate(images):
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                frames.append(image.convert('RGB'))
+            positions.append(position)
+        except Exception as e:
+            results[position] = {'error': f"Unreadable image: {e}"}
+
+    if frames:
+        predictions = _model.predict(frames, verbose=False, **_options)
+        for position, prediction in zip(positions, predictions):
+            results[position] = _count_detections(prediction)
+    return results
+
+
+def _count_detections(prediction):
+    names = prediction.names
+    ants = mealy_bugs = 0
+    scores = []
+    for cls, score in zip(prediction.boxes.cls.tolist(), prediction.boxes.conf.tolist()):
+        name = names[int(cls)].lower()
+        if name in ANT_CLASSES:
+            ants += 1
+        elif name in MEALY_BUG_CLASSES:
+            mealy_bugs += 1
+        else:
+            continue
+        scores.append(score)
+    return {
+        'ant_count': ants,
+        'mealy_bugs_count': mealy_bugs,
+        # Mean detection confidence; nothing detected leaves it unknown
+        'ml_confidence': round(sum(scores) / len(scores), 3) if scores else None,
+    }
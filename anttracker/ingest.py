@@ -0,0 +1,419 @@
+"""
+Write-behind buffer for device readings.
+
+When ``INGEST_WRITE_BEHIND`` is enabled, accepted readings are queued in a
+bounded in-process buffer and written with one ``bulk_create`` per group
+instead of one transaction per request. A group is committed every
+``INGEST_FLUSH_ROWS`` rows or ``INGEST_FLUSH_INTERVAL_MS`` milliseconds,
+whichever comes first. If ``INGEST_SPOOL_PATH`` is set, every accepted
+reading is appended to a local spool file first and replayed on start-up,
+so a crash between accept and commit does not lose data.
+
+Each process spools to its own ``<INGEST_SPOOL_PATH>.<pid>`` files and
+holds a lock on ``<INGEST_SPOOL_PATH>.<pid>.lock`` while it runs. A new
+process replays the spools of processes whose lock is free, skipping
+readings that are already stored, so a replay never inserts a row twice.
+Only rows still waiting for a commit stay spooled after a flush.
+
+A row that keeps failing with a data error is moved to the dead-letter file
+``<INGEST_SPOOL_PATH>.dead`` (or logged without a spool) after
+``INGEST_MAX_ATTEMPTS`` flushes, so it cannot hold back the rest of the
+buffer. Connection errors do not count as attempts. A flush that fails as a
+whole puts its rows back into the buffer and the flusher keeps running.
+
+Sequence numbers of buffered readings are recorded as stored only once
+their rows commit, so a retry of a reading that was later dead-lettered is
+not acknowledged as a duplicate.
+
+With several shards each flush writes one group per shard (``store_readings``).
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, InterfaceError, OperationalError, close_old_connections, transaction
+from django.utils.dateparse import parse_datetime
+
+from .idempotency import drop_replayed_rows, drop_stored_rows, record_sequences
+from .models import SensorData
+from .rules import evaluate_and_alert
+from .sharding import load_devices, readings_by_shard, using_shard
+
+
+logger = logging.getLogger(__name__)
+
+
+# Reading fields persisted to the spool file
+SPOOL_FIELDS = (
+    'temperature', 'humidity', 'moisture', 'ant_count', 'mealy_bugs_count',
+    'is_rainfall', 'is_irrigation', 'ml_confidence', 'seq',
+)
+
+
+# Errors that say nothing about the row itself; they do not count as attempts
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+class IngestBufferFull(Exception):
+    """Raised when the buffer is at capacity and the client should retry later"""
+
+
+class WriteBehindBuffer:
+    """Bounded buffer of unsaved SensorData rows committed in groups by a flusher thread"""
+
+    def __init__(self, max_rows=10000, flush_rows=500, flush_interval_ms=200,
+                 spool_path=None, spool_fsync=False, max_attempts=5):
+        self.max_rows = max_rows
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval_ms / 1000
+        self.spool_base = str(spool_path) if spool_path else None
+        self.spool_path = f'{self.spool_base}.{os.getpid()}' if spool_path else None
+        self.spool_fsync = spool_fsync
+        self.max_attempts = max_attempts
+
+        self._rows = []
+        self._in_flight = 0
+        self._lock = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._spool = None
+        self._segments = []
+        self._thread = None
+        self._stopped = False
+
+        self.stats = {'accepted': 0, 'rejected': 0, 'flushed': 0, 'flushes': 0, 'failures': 0, 'dead_lettered': 0}
+
+        if self.spool_path:
+            # Held for the life of the process; a free lock marks an orphaned spool
+            self._spool_lock = open(f'{self.spool_path}.lock', 'a')
+            fcntl.flock(self._spool_lock, fcntl.LOCK_EX)
+            self._replay_spool()
+            self._spool = open(self.spool_path, 'a', encoding='utf-8')
+
+    def __len__(self):
+        return len(self._rows) + self._in_flight
+
+    def start(self):
+        """Start the background flusher thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ingest-write-behind', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the flusher and commit whatever is still buffered"""
+        with self._lock:
+            self._stopped = True
+            self._lock.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self._spool is not None:
+            # Rows that still failed stay spooled for the next process to replay
+            self._spool.close()
+            self._spool = None
+            self._spool_lock.close()
+
+    def submit(self, readings):
+        """Queue unsaved readings, raising IngestBufferFull when over capacity"""
+        with self._lock:
+            if len(self) + len(readings) > self.max_rows:
+                self.stats['rejected'] += len(readings)
+                raise IngestBufferFull(f"Ingest buffer full ({self.max_rows} rows)")
+            if self._spool is not None:
+                self._spool.write(''.join(json.dumps(_to_spool_record(r)) + '\n' for r in readings))
+                self._spool.flush()
+                if self.spool_fsync:
+                    os.fsync(self._spool.fileno())
+            self._rows.extend(readings)
+            self.stats['accepted'] += len(readings)
+            if len(self._rows) >= self.flush_rows:
+                self._lock.notify()
+
+    def flush(self):
+        """Commit all buffered rows with a single bulk insert"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                self._in_flight = len(rows)
+                if rows:
+                    self._rotate_spool()
+                segments = list(self._segments)
+            if not rows:
+                return 0
+            saved, retry = [], rows
+            try:
+                try:
+                    saved, failed = store_readings(rows)
+                except Exception as e:
+                    # Such as the shard lookup failing: no row was stored
+                    logger.exception("Failed to store %d buffered reading(s)", len(rows))
+                    for row in rows:
+                        row._ingest_error = e
+                    failed = rows
+                # Every failed row is retried if dead-lettering goes wrong
+                retry = failed
+                retry = self._retry_or_dead_letter(failed)
+            finally:
+                with self._lock:
+                    if retry:
+                        # Keep the rows for the next attempt
+                        self._rows[:0] = retry
+                        self.stats['failures'] += 1
+                    else:
+                        self.stats['flushes'] += 1
+                    self._in_flight = 0
+                    self.stats['flushed'] += len(saved)
+                    if self._spool is not None:
+                        self._trim_spool(segments, retry)
+            self._record_sequences(saved)
+            self._alert(saved)
+            return len(saved)
+
+    def _trim_spool(self, segments, retry):
+        """Replace the flushed segments by one holding only the rows still pending"""
+        try:
+            pending = [self._write_segment(retry)] if retry else []
+        except OSError:
+            # The old segments still hold every pending row; a replay skips the saved ones
+            logger.exception("Failed to rewrite the ingest spool")
+            return
+        for path in segments:
+            os.remove(path)
+        self._segments = pending + self._segments[len(segments):]
+
+    def _record_sequences(self, saved):
+        by_device = {}
+        for row in saved:
+            by_device.setdefault(row.device_id, []).append(row.seq)
+        for device_id, seqs in by_device.items():
+            record_sequences(device_id, seqs)
+
+    def _retry_or_dead_letter(self, failed):
+        """Rows to retry; rows that failed with data errors max_attempts times are dead-lettered"""
+        retry, dead = [], []
+        for row in failed:
+            if not isinstance(getattr(row, '_ingest_error', None), TRANSIENT_ERRORS):
+                row._ingest_attempts = getattr(row, '_ingest_attempts', 0) + 1
+            if getattr(row, '_ingest_attempts', 0) >= self.max_attempts:
+                dead.append(row)
+            else:
+                retry.append(row)
+        if dead:
+            self._dead_letter(dead)
+        return retry
+
+    def _dead_letter(self, rows):
+        records = [
+            {**_to_spool_record(row), 'error': repr(getattr(row, '_ingest_error', None))}
+            for row in rows
+        ]
+        with self._lock:
+            self.stats['dead_lettered'] += len(rows)
+        if self.spool_base:
+            logger.error("Moved %d reading(s) that failed %d times to %s.dead",
+                         len(rows), self.max_attempts, self.spool_base)
+            try:
+                with open(f'{self.spool_base}.dead', 'a', encoding='utf-8') as dead:
+                    for record in records:
+                        dead.write(json.dumps(record) + '\n')
+                return
+            except OSError:
+                logger.exception("Failed to write the dead-letter file")
+        logger.error("Dropped %d reading(s) that failed %d times: %s",
+                     len(rows), self.max_attempts, json.dumps(records))
+
+    def _alert(self, saved):
+        try:
+            evaluate_and_alert(saved)
+        except Exception:
+            # Rows are committed; never re-insert them because alerting failed
+            logger.exception("Failed to evaluate alerts for flushed readings")
+
+    def _run(self):
+        while True:
+            with self._lock:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._stopped and len(self._rows) < self.flush_rows:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+                if self._stopped:
+                    return
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                # The rows are back in the buffer; one bad flush must not stop the flusher
+                logger.exception("Write-behind flush failed")
+                time.sleep(self.flush_interval)
+
+    def _rotate_spool(self):
+        """Move the current spool aside so new rows go to a fresh file"""
+        if self._spool is None:
+            return
+        self._spool.close()
+        flushing_path = f'{self.spool_path}.{time.time_ns()}.flushing'
+        os.replace(self.spool_path, flushing_path)
+        self._segments.append(flushing_path)
+        self._spool = open(self.spool_path, 'a', encoding='utf-8')
+
+    def _write_segment(self, rows):
+        """Spool rows that are still pending to a new segment"""
+        path = f'{self.spool_path}.{time.time_ns()}.flushing'
+        with open(path, 'w', encoding='utf-8') as segment:
+            segment.write(''.join(json.dumps(_to_spool_record(r)) + '\n' for r in rows))
+            segment.flush()
+            if self.spool_fsync:
+                os.fsync(segment.fileno())
+        return path
+
+    def _orphaned_spools(self):
+        """Spool files of this process and of processes that no longer hold their lock"""
+        directory = os.path.dirname(self.spool_base) or '.'
+        prefix = os.path.basename(self.spool_base) + '.'
+        by_pid = {}
+        for name in os.listdir(directory):
+            pid = name[len(prefix):].split('.')[0] if name.startswith(prefix) else ''
+            if pid.isdigit():
+                by_pid.setdefault(int(pid), []).append(os.path.join(directory, name))
+        orphans, locks = [], []
+        for pid, paths in by_pid.items():
+            if pid != os.getpid():
+                lock = open(f'{self.spool_base}.{pid}.lock', 'a')
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # The owner is still running
+                    lock.close()
+                    continue
+                locks.append(lock)
+            orphans += [path for path in paths if not path.endswith('.lock')]
+        return sorted(orphans), locks
+
+    def _replay_spool(self):
+        """Re-queue rows left in spool files by this or a previous process"""
+        leftovers, locks = self._orphaned_spools()
+        records = []
+        for path in leftovers:
+            try:
+                spool = open(path, encoding='utf-8')
+            except FileNotFoundError:
+                # Another process replayed it first
+                continue
+            with spool:
+                for line in spool:
+                    line = line.strip()
+                    if line:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            # A torn final line from a crash mid-write
+                            continue
+        if records:
+            # Rows committed before the crash are skipped
+            self._rows = drop_replayed_rows(_from_spool_records(records))
+            if self._rows:
+                self.flush()
+            # Rows that failed to flush are written back to the live spool
+            with open(self.spool_path + '.replay', 'w', encoding='utf-8') as spool:
+                spool.write(''.join(json.dumps(_to_spool_record(r)) + '\n' for r in self._rows))
+        for path in leftovers:
+            if path != self.spool_path and os.path.exists(path):
+                os.remove(path)
+        if records:
+            os.replace(self.spool_path + '.replay', self.spool_path)
+        for lock in locks:
+            os.remove(lock.name)
+            lock.close()
+
+
+def _insert_readings(alias, rows):
+    try:
+        with transaction.atomic(using=alias):
+            return SensorData.objects.bulk_create(rows)
+    except IntegrityError:
+        # A retried sequence number got in twice; drop the stored ones and retry
+        rows = drop_stored_rows(rows)
+        with transaction.atomic(using=alias):
+            return SensorData.objects.bulk_create(rows)
+
+
+def store_readings(rows):
+    """Insert new readings with one bulk insert per shard, returning (saved, failed rows)
+
+    When a group fails its rows are inserted one by one, so only the rows at
+    fault fail; each failed row keeps its error in ``_ingest_error``.
+    """
+    saved, failed = [], []
+    for alias, group in readings_by_shard(rows):
+        with using_shard(alias):
+            try:
+                saved += _insert_readings(alias, group)
+                continue
+            except Exception:
+                logger.exception("Failed to store %d reading(s) on '%s'", len(group), alias)
+            for row in group:
+                try:
+                    saved += _insert_readings(alias, [row])
+                except Exception as e:
+                    row._ingest_error = e
+                    failed.append(row)
+    return saved, failed
+
+
+def _to_spool_record(reading):
+    record = {field: getattr(reading, field) for field in SPOOL_FIELDS}
+    record['device_id'] = reading.device_id
+    record['timestamp'] = reading.timestamp.isoformat()
+    if getattr(reading, '_ingest_attempts', 0):
+        record['attempts'] = reading._ingest_attempts
+    return record
+
+
+def _from_spool_records(records):
+    devices = load_devices({r['device_id'] for r in records})
+    readings = []
+    for record in records:
+        device = devices.get(record.pop('device_id'))
+        if device is None:
+            continue
+        record['timestamp'] = parse_datetime(record['timestamp'])
+        attempts = record.pop('attempts', 0)
+        reading = SensorData(device=device, **record)
+        if attempts:
+            reading._ingest_attempts = attempts
+        readings.append(reading)
+    return readings
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def write_behind_enabled():
+    return getattr(settings, 'INGEST_WRITE_BEHIND', False)
+
+
+def get_buffer():
+    """Return the process-wide write-behind buffer, starting it on first use"""
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = WriteBehindBuffer(
+                    max_rows=getattr(settings, 'INGEST_BUFFER_MAX_ROWS', 10000),
+                    flush_rows=getattr(settings, 'INGEST_FLUSH_ROWS', 500),
+                    flush_interval_ms=getattr(settings, 'INGEST_FLUSH_INTERVAL_MS', 200),
+                    spool_path=getattr(settings, 'INGEST_SPOOL_PATH', None),
+                    spool_fsync=getattr(settings, 'INGEST_SPOOL_FSYNC', False),
+                    max_attempts=getattr(settings, 'INGEST_MAX_ATTEMPTS', 5),
+                )
+                _buffer.start()
+    return _buffer
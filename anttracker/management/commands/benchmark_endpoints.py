@@ -0,0 +1,191 @@
+import json
+import statistics
+import time
+import tracemalloc
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, \
+    teardown_test_environment
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from anttracker.models import Farmer, Device
+from anttracker.sharding import bulk_create_devices
+from anttracker.synthetic import populate_devices
+
+
+# name -> (total readings, devices per farmer)
+SCENARIOS = {
+    'tiny': (500, 2),
+    'small': (10_000, 1),
+    'medium': (100_000, 50),
+    'large': (1_000_000, 200),
+    'xlarge': (10_000_000, 500),
+}
+
+DEFAULT_BASELINE = Path(settings.BASE_DIR) / 'benchmarks' / 'baselines.json'
+
+
+class Command(BaseCommand):
+    help = "Benchmark API endpoints on synthetic datasets and compare against stored baselines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default='small,medium',
+                            help=f"Comma separated scenarios to run ({', '.join(SCENARIOS)})")
+        parser.add_argument('--iterations', type=int, default=5, help="Timed requests per endpoint")
+        parser.add_argument('--baseline', default=str(DEFAULT_BASELINE), help="Baseline JSON file")
+        parser.add_argument('--update-baseline', action='store_true',
+                            help="Write the measured results as the new baseline instead of comparing")
+        parser.add_argument('--time-tolerance', type=float, default=0.5,
+                            help="Allowed relative slowdown in wall time before failing")
+        parser.add_argument('--memory-tolerance', type=float, default=0.5,
+                            help="Allowed relative growth in peak memory before failing")
+        parser.add_argument('--keepdb', action='store_true', help="Keep the benchmark database between runs")
+
+    def handle(self, *args, **options):
+        scenarios = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = [name for name in scenarios if name not in SCENARIOS]
+        if unknown:
+            raise CommandError(f"Unknown scenario(s): {', '.join(unknown)}")
+
+        # Run against a throwaway test database, never the configured one
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, keepdb=options['keepdb'])
+        old_config = runner.setup_databases()
+        try:
+            # Throttling would otherwise cut the measurement short, and cached
+            # dashboards would measure cache hits instead of the queries
+            rest_framework = dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES={})
+            with override_settings(REST_FRAMEWORK=rest_framework, DASHBOARD_CACHE_SECONDS=0):
+                results = {name: self.run_scenario(name, options['iterations']) for name in scenarios}
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+
+        self.print_results(results)
+        baseline_path = Path(options['baseline'])
+        if options['update_baseline']:
+            baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+            baseline.update(results)
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+            self.stdout.write(f"Baseline written to {baseline_path}")
+            return
+
+        if not baseline_path.exists():
+            raise CommandError(f"No baseline at {baseline_path}; run with --update-baseline to create one")
+        regressions = self.compare(results, json.loads(baseline_path.read_text()), options)
+        if regressions:
+            for regression in regressions:
+                self.stderr.write(regression)
+            raise CommandError(f"{len(regressions)} performance regression(s) against {baseline_path}")
+        self.stdout.write(self.style.SUCCESS("All endpoints within their baselines"))
+
+    def run_scenario(self, name, iterations):
+        total_readings, devices_per_farmer = SCENARIOS[name]
+        self.stdout.write(f"Seeding '{name}': {total_readings} readings over {devices_per_farmer} device(s)...")
+        farmer, devices = self.seed(name, total_readings, devices_per_farmer)
+
+        # Authenticate like real clients so auth queries count against the budget
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=farmer.user).key}')
+        device_client = APIClient()
+        device = devices[0]
+        seq = iter(range(1, 10 ** 9))
+
+        def submit():
+            return device_client.post(
+                f'/api/device-data/{device.device_id}/',
+                {'temperature': 24.5, 'humidity': 61.0, 'ant_count': 3, 'mealy_bugs_count': 1,
+                 'seq': next(seq) + total_readings},
+                format='json',
+                HTTP_AUTHORIZATION=device.api_key,
+            )
+
+        endpoints = {
+            'device_data_submission': submit,
+            'dashboard': lambda: client.get('/api/dashboard/'),
+            'sensor_data_list': lambda: client.get('/api/sensor-data/'),
+            'alert_log_list': lambda: client.get('/api/alerts/'),
+            'device_list': lambda: client.get('/api/devices/'),
+        }
+        try:
+            return {endpoint: self.measure(call, iterations) for endpoint, call in endpoints.items()}
+        finally:
+            farmer.user.delete()
+
+    def seed(self, name, total_readings, devices_per_farmer):
+        user = User.objects.create_user(username=f'benchmark-{name}', email=f'benchmark-{name}@example.invalid')
+        farmer = Farmer.objects.create(user=user, ant_threshold_limit=50)
+        now = timezone.now()
+        devices = bulk_create_devices([
+            Device(farmer=farmer, device_id=f'benchmark-{name}-{i}', device_name=f'Benchmark {i}',
+                   api_key=f'benchmark-{name}-key-{i}', last_seen=now)
+            for i in range(devices_per_farmer)
+        ])
+
+        # Spread readings over 30 days so the default 24h dashboard window sees ~1/30 of them
+        span = timedelta(days=30)
+        per_device = max(1, total_readings // devices_per_farmer)
+        interval = max(1, int(span.total_seconds() // per_device))
+        populate_devices(devices, now - span, now, interval, seed=0, alert_logs=True)
+        return farmer, devices
+
+    def measure(self, call, iterations):
+        call()  # warm-up
+        timings, queries = [], []
+        for _ in range(iterations):
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = call()
+                timings.append(time.perf_counter() - started)
+            queries.append(len(captured))
+            if response.status_code >= 400:
+                raise CommandError(f"Benchmark request failed with HTTP {response.status_code}")
+
+        # Memory is traced in a separate request so tracing overhead stays out of the timings
+        tracemalloc.start()
+        try:
+            call()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return {
+            'wall_ms': round(statistics.median(timings) * 1000, 2),
+            'queries': max(queries),
+            'peak_kb': round(peak / 1024, 1),
+        }
+
+    def print_results(self, results):
+        self.stdout.write(f"{'scenario':<10} {'endpoint':<24} {'wall ms':>10} {'queries':>8} {'peak KB':>10}")
+        for scenario, endpoints in results.items():
+            for endpoint, result in endpoints.items():
+                self.stdout.write(
+                    f"{scenario:<10} {endpoint:<24} {result['wall_ms']:>10.2f} "
+                    f"{result['queries']:>8} {result['peak_kb']:>10.1f}"
+                )
+
+    def compare(self, results, baseline, options):
+        regressions = []
+        for scenario, endpoints in results.items():
+            for endpoint, result in endpoints.items():
+                label = f"{scenario}/{endpoint}"
+                expected = baseline.get(scenario, {}).get(endpoint)
+                if expected is None:
+                    # An unrecorded endpoint has no budget, so it could regress unnoticed
+                    regressions.append(f"{label}: no baseline, run with --update-baseline to record one")
+                    continue
+                if result['queries'] > expected['queries']:
+                    regressions.append(f"{label}: {result['queries']} queries, budget {expected['queries']}")
+                if result['wall_ms'] > expected['wall_ms'] * (1 + options['time_tolerance']):
+                    regressions.append(f"{label}: {result['wall_ms']} ms, baseline {expected['wall_ms']} ms")
+                if result['peak_kb'] > expected['peak_kb'] * (1 + options['memory_tolerance']):
+                    regressions.append(f"{label}: {result['peak_kb']} KB peak, baseline {expected['peak_kb']} KB")
+        return regressions
@@ -0,0 +1,120 @@
+import random
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils.crypto import get_random_string
+from rest_framework.test import APIRequestFactory
+
+from anttracker import ingest
+from anttracker.models import Farmer, Device, SensorData
+from anttracker.views import device_data_submission
+
+
+class Command(BaseCommand):
+    help = "Compare device ingest throughput with per-request commits and the write-behind buffer"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help="Requests per mode")
+        parser.add_argument('--concurrency', type=int, default=4, help="Concurrent simulated devices")
+        parser.add_argument('--devices', type=int, default=50, help="Devices to spread requests over")
+        parser.add_argument('--batch-size', type=int, default=1, help="Readings per request")
+        parser.add_argument('--flush-rows', type=int, default=500, help="INGEST_FLUSH_ROWS for write-behind mode")
+        parser.add_argument('--flush-interval-ms', type=int, default=200,
+                            help="INGEST_FLUSH_INTERVAL_MS for write-behind mode")
+
+    def handle(self, *args, **options):
+        user = User.objects.create_user(username=f"bench-ingest-{get_random_string(8)}")
+        try:
+            # Keep alert emails out of the measurement
+            farmer = Farmer.objects.create(user=user, ant_threshold_limit=10 ** 9)
+            devices = [
+                Device.objects.create(
+                    farmer=farmer,
+                    device_id=f"{user.username}-{i}",
+                    device_name=f"Benchmark device {i}",
+                    api_key=get_random_string(32),
+                )
+                for i in range(options['devices'])
+            ]
+
+            results = []
+            with override_settings(INGEST_WRITE_BEHIND=False):
+                results.append(('per-request commit', self.run_mode(devices, options)))
+            with override_settings(
+                INGEST_WRITE_BEHIND=True,
+                INGEST_FLUSH_ROWS=options['flush_rows'],
+                INGEST_FLUSH_INTERVAL_MS=options['flush_interval_ms'],
+                INGEST_BUFFER_MAX_ROWS=max(10000, options['requests'] * options['batch_size']),
+                INGEST_SPOOL_PATH=None,
+            ):
+                ingest._buffer = None
+                try:
+                    results.append(('write-behind', self.run_mode(devices, options, ingest.get_buffer())))
+                finally:
+                    ingest._buffer.stop()
+                    ingest._buffer = None
+
+            self.stdout.write(f"{'mode':<20} {'requests/s':>12} {'rows/s':>12} {'errors':>8} {'rows':>8}")
+            for name, result in results:
+                self.stdout.write(
+                    f"{name:<20} {result['requests_per_s']:>12.1f} {result['rows_per_s']:>12.1f} "
+                    f"{result['errors']:>8} {result['rows']:>8}"
+                )
+        finally:
+            user.delete()
+
+    def run_mode(self, devices, options, buffer=None):
+        factory = APIRequestFactory()
+        requests_total = options['requests']
+        concurrency = options['concurrency']
+        batch_size = options['batch_size']
+        errors = []
+        rows_before = SensorData.objects.filter(device__in=devices).count()
+
+        def worker(worker_index):
+            try:
+                for i in range(worker_index, requests_total, concurrency):
+                    device = devices[i % len(devices)]
+                    readings = [
+                        {
+                            'temperature': round(random.uniform(15, 35), 1),
+                            'humidity': round(random.uniform(30, 90), 1),
+                            'ant_count': random.randint(0, 40),
+                            'mealy_bugs_count': random.randint(0, 10),
+                        }
+                        for _ in range(batch_size)
+                    ]
+                    request = factory.post(
+                        f'/api/device-data/{device.device_id}/',
+                        readings if batch_size > 1 else readings[0],
+                        format='json',
+                        HTTP_AUTHORIZATION=device.api_key,
+                    )
+                    response = device_data_submission(request, device_id=device.device_id)
+                    if response.status_code >= 400:
+                        errors.append(response.status_code)
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if buffer is not None:
+            # Throughput only counts once the rows are durable in the database
+            buffer.flush()
+        elapsed = time.perf_counter() - started
+
+        rows = SensorData.objects.filter(device__in=devices).count() - rows_before
+        return {
+            'requests_per_s': requests_total / elapsed,
+            'rows_per_s': rows / elapsed,
+            'errors': len(errors),
+            'rows': rows,
+        }
@@ -0,0 +1,134 @@
+import statistics
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+from django.db.models import Avg, Count, Max
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from anttracker.compact import decoded
+from anttracker.models import CompactSensorData, Device, Farmer, SensorData
+from anttracker.synthetic import populate_devices
+
+
+def table_sizes(model):
+    """(table bytes, index bytes) of a model's table, None where the backend cannot tell"""
+    table = model._meta.db_table
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT pg_table_size(%s), pg_indexes_size(%s)", [table, table])
+                return cursor.fetchone()
+            if connection.vendor == 'mysql':
+                cursor.execute(
+                    "SELECT data_length, index_length FROM information_schema.tables "
+                    "WHERE table_schema = DATABASE() AND table_name = %s", [table]
+                )
+                return cursor.fetchone()
+            if connection.vendor == 'sqlite':
+                # Needs SQLite built with the dbstat virtual table
+                cursor.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = %s", [table])
+                table_bytes = cursor.fetchone()[0]
+                cursor.execute(
+                    "SELECT SUM(pgsize) FROM dbstat WHERE name IN "
+                    "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s)", [table]
+                )
+                return table_bytes, cursor.fetchone()[0] or 0
+    except DatabaseError:
+        pass
+    return None, None
+
+
+class Command(BaseCommand):
+    help = "Compare bytes per row, index size and scan speed of the SensorData and CompactSensorData layouts"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readings', type=int, default=100_000, help="Readings to generate")
+        parser.add_argument('--devices', type=int, default=20, help="Devices the readings are spread over")
+        parser.add_argument('--iterations', type=int, default=5, help="Timed runs per scan")
+        parser.add_argument('--keepdb', action='store_true', help="Keep the benchmark database between runs")
+
+    def handle(self, *args, **options):
+        # Run against a throwaway test database, never the configured one
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, keepdb=options['keepdb'])
+        old_config = runner.setup_databases()
+        try:
+            devices = self.seed(options['readings'], options['devices'])
+            started = time.perf_counter()
+            copied = CompactSensorData.objects.copy_from(SensorData.objects.all())
+            self.stdout.write(f"Copied {copied} readings to the compact table in {time.perf_counter() - started:.1f}s")
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('VACUUM ANALYZE')
+            results = {
+                'wide': self.measure(SensorData, 'temperature', devices[0], options['iterations']),
+                'compact': self.measure(CompactSensorData, decoded('temperature'), devices[0],
+                                        options['iterations']),
+            }
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+        self.print_results(results)
+
+    def seed(self, readings, device_count):
+        user = User.objects.create_user(username='benchmark-storage', email='benchmark-storage@example.invalid')
+        farmer = Farmer.objects.create(user=user, ant_threshold_limit=50)
+        devices = Device.objects.bulk_create([
+            Device(farmer=farmer, device_id=f'benchmark-storage-{i}', device_name=f'Benchmark {i}',
+                   api_key=f'benchmark-storage-key-{i}')
+            for i in range(device_count)
+        ])
+        span = timedelta(days=30)
+        per_device = max(1, readings // device_count)
+        interval = max(1, int(span.total_seconds() // per_device))
+        now = timezone.now()
+        self.stdout.write(f"Seeding {readings} readings over {device_count} device(s)...")
+        populate_devices(devices, now - span, now, interval, seed=0)
+        return devices
+
+    def measure(self, model, temperature, device, iterations):
+        rows = model.objects.count()
+        table_bytes, index_bytes = table_sizes(model)
+        since = timezone.now() - timedelta(days=1)
+        scans = {
+            # Sequential scan over every row
+            'full_scan': lambda: model.objects.aggregate(
+                count=Count('id'), avg_temp=Avg(temperature), max_ants=Max('ant_count')
+            ),
+            # Index range scan, as the dashboard does for one device's last day
+            'device_day': lambda: len(list(
+                model.objects.filter(device=device, timestamp__gte=since).order_by('-timestamp')
+            )),
+        }
+        result = {
+            'rows': rows,
+            'bytes_per_row': round(table_bytes / rows, 1) if table_bytes and rows else None,
+            'table_kb': round(table_bytes / 1024, 1) if table_bytes is not None else None,
+            'index_kb': round(index_bytes / 1024, 1) if index_bytes is not None else None,
+        }
+        for name, scan in scans.items():
+            scan()  # warm-up
+            timings = []
+            for _ in range(iterations):
+                started = time.perf_counter()
+                scan()
+                timings.append(time.perf_counter() - started)
+            result[f'{name}_ms'] = round(statistics.median(timings) * 1000, 2)
+        return result
+
+    def print_results(self, results):
+        metrics = ['rows', 'bytes_per_row', 'table_kb', 'index_kb', 'full_scan_ms', 'device_day_ms']
+        wide, compact = results['wide'], results['compact']
+        self.stdout.write(f"{'metric':<16} {'wide':>12} {'compact':>12} {'change':>8}")
+        for metric in metrics:
+            before, after = wide[metric], compact[metric]
+            change = f"{(after - before) / before:+.0%}" if before and after is not None else ''
+            self.stdout.write(
+                f"{metric:<16} {'n/a' if before is None else before:>12} "
+                f"{'n/a' if after is None else after:>12} {change:>8}"
+            )
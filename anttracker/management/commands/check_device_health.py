@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from anttracker.heartbeat import check_device_health
+
+
+class Command(BaseCommand):
+    help = "Flag devices that stopped reporting and emit offline/online alerts"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=int, default=0,
+                            help="Re-run every N seconds instead of exiting after one check")
+        parser.add_argument('--no-notify', action='store_true',
+                            help="Record state changes and alert logs without sending email")
+
+    def handle(self, *args, **options):
+        while True:
+            changes = check_device_health(notify=not options['no_notify'])
+            self.stdout.write(
+                f"{len(changes['offline'])} device(s) went offline, "
+                f"{len(changes['online'])} came back online"
+            )
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -0,0 +1,69 @@
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from anttracker.models import Farmer, Device
+from anttracker.sharding import bulk_create_devices
+from anttracker.synthetic import populate_devices
+
+
+class Command(BaseCommand):
+    help = "Generate farmers, devices and correlated synthetic sensor time series (no alerts are sent)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--farmers', type=int, default=10, help="Farmers to create")
+        parser.add_argument('--devices-per-farmer', type=int, default=5, help="Devices per farmer")
+        parser.add_argument('--days', type=float, default=365, help="Days of history per device")
+        parser.add_argument('--interval-minutes', type=float, default=10, help="Minutes between readings")
+        parser.add_argument('--threshold', type=int, default=50, help="Ant threshold for generated farmers")
+        parser.add_argument('--prefix', default='synthetic', help="Prefix for generated usernames and device IDs")
+        parser.add_argument('--seed', type=int, default=None, help="Random seed for reproducible data")
+        parser.add_argument('--alert-logs', action='store_true',
+                            help="Also record AlertLog rows for threshold breaches (no email is sent)")
+
+    def handle(self, *args, **options):
+        run_id = get_random_string(6).lower()
+        prefix = f"{options['prefix']}-{run_id}"
+        end = timezone.now()
+        start = end - timedelta(days=options['days'])
+        interval = max(1, int(options['interval_minutes'] * 60))
+
+        users = User.objects.bulk_create([
+            User(username=f'{prefix}-{i}', email=f'{prefix}-{i}@example.invalid', password='!')
+            for i in range(options['farmers'])
+        ])
+        users = list(User.objects.filter(username__startswith=f'{prefix}-').order_by('id'))
+        # One at a time, so each farmer is placed on a shard and copied there
+        farmers = [
+            Farmer.objects.create(user=user, farm_name=f'Synthetic farm {i}', farm_location=f'Region {i % 10}',
+                                  ant_threshold_limit=options['threshold'])
+            for i, user in enumerate(users)
+        ]
+        devices = bulk_create_devices([
+            Device(farmer=farmer, device_id=f'{prefix}-{f}-{d}', device_name=f'Synthetic Pi {f}-{d}',
+                   api_key=get_random_string(32))
+            for f, farmer in enumerate(farmers)
+            for d in range(options['devices_per_farmer'])
+        ])
+
+        started = time.perf_counter()
+
+        def progress(device, total):
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"\r{total} readings loaded ({total / max(elapsed, 1e-9):,.0f} rows/s)", ending='')
+            self.stdout.flush()
+
+        total = populate_devices(
+            devices, start, end, interval, seed=options['seed'],
+            alert_logs=options['alert_logs'], progress=progress,
+        )
+        elapsed = time.perf_counter() - started
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {len(farmers)} farmers, {len(devices)} devices and {total} readings in {elapsed:.1f}s "
+            f"({total / max(elapsed, 1e-9) * 60:,.0f} rows/min), usernames prefixed '{prefix}-'"
+        ))
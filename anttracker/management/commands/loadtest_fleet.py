@@ -0,0 +1,238 @@
+import heapq
+import json
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+
+class Recorder:
+    """Thread-safe latency and status collector per endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+        self.readings = 0
+
+    def record(self, endpoint, status, elapsed, readings=0):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            counts = self.statuses.setdefault(endpoint, {})
+            counts[status] = counts.get(status, 0) + 1
+            if 200 <= status < 300:
+                self.readings += readings
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class SimulatedDevice:
+    """A Raspberry Pi that reports periodically, sometimes drops offline and replays its backlog"""
+    MAX_BACKLOG = 500
+
+    def __init__(self, device_id, api_key, interval, offline_probability, breach_probability, threshold):
+        self.device_id = device_id
+        self.api_key = api_key
+        self.interval = interval
+        self.offline_probability = offline_probability
+        self.breach_probability = breach_probability
+        self.threshold = threshold
+        self.seq = 0
+        self.backlog = []
+        self.offline_until = 0
+        self.base_temperature = random.uniform(18, 28)
+
+    def next_reading(self):
+        self.seq += 1
+        hour = timezone.now().hour
+        ants = int(random.expovariate(1 / max(self.threshold * 0.3, 1)))
+        if random.random() < self.breach_probability:
+            ants = self.threshold + random.randint(1, self.threshold)
+        return {
+            'timestamp': timezone.now().isoformat(),
+            'temperature': round(self.base_temperature + 6 * math.sin((hour - 8) / 24 * 2 * math.pi)
+                                 + random.gauss(0, 0.5), 1),
+            'humidity': round(min(100, max(0, random.gauss(65, 10))), 1),
+            'ant_count': ants,
+            'mealy_bugs_count': int(random.expovariate(0.3)),
+            'is_rainfall': random.random() < 0.05,
+            'is_irrigation': random.random() < 0.1,
+            'seq': self.seq,
+        }
+
+    def tick(self, now):
+        """Return the payload to send now, or None while offline"""
+        # Devices keep a bounded local backlog while they cannot reach the server
+        self.backlog = self.backlog[-(self.MAX_BACKLOG - 1):] + [self.next_reading()]
+        if now < self.offline_until:
+            return None
+        if random.random() < self.offline_probability:
+            # Drop off the network for 5-30 reporting intervals
+            self.offline_until = now + self.interval * random.randint(5, 30)
+            return None
+        return self.backlog if len(self.backlog) > 1 else self.backlog[0]
+
+
+class Command(BaseCommand):
+    help = "Simulate a fleet of Raspberry Pi devices and polling farmers against a running server"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000', help="Server to load")
+        parser.add_argument('--farmers', type=int, default=50, help="Farmers to register")
+        parser.add_argument('--devices', type=int, default=1000, help="Devices to register in total")
+        parser.add_argument('--duration', type=int, default=60, help="Seconds to generate load")
+        parser.add_argument('--workers', type=int, default=32, help="Concurrent device sender threads")
+        parser.add_argument('--interval', type=float, default=10.0, help="Seconds between readings per device")
+        parser.add_argument('--pollers', type=int, default=10, help="Farmers polling the dashboard concurrently")
+        parser.add_argument('--poll-interval', type=float, default=5.0, help="Seconds between dashboard polls")
+        parser.add_argument('--offline-probability', type=float, default=0.01,
+                            help="Chance per reading that a device goes offline for a while")
+        parser.add_argument('--breach-probability', type=float, default=0.02,
+                            help="Chance per reading of an ant count above the threshold")
+        parser.add_argument('--threshold', type=int, default=50, help="Ant threshold for simulated farmers")
+        parser.add_argument('--timeout', type=float, default=10.0, help="HTTP timeout in seconds")
+
+    def handle(self, *args, **options):
+        self.base_url = options['base_url'].rstrip('/')
+        self.timeout = options['timeout']
+        self.recorder = Recorder()
+        run_id = get_random_string(6).lower()
+
+        self.stdout.write(f"Registering {options['farmers']} farmers and {options['devices']} devices...")
+        farmers = self.register_farmers(run_id, options)
+        devices = self.register_devices(run_id, farmers, options)
+        self.stdout.write(f"Registered {len(farmers)} farmers and {len(devices)} devices, generating load...")
+
+        self.recorder = Recorder()
+        stop_at = time.monotonic() + options['duration']
+        started = time.monotonic()
+        threads = [
+            threading.Thread(target=self.device_worker, args=(devices[i::options['workers']], stop_at, options))
+            for i in range(options['workers'])
+        ]
+        threads += [
+            threading.Thread(target=self.dashboard_worker, args=(farmers[i % len(farmers)], stop_at, options))
+            for i in range(options['pollers'])
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.report(time.monotonic() - started)
+
+    def request(self, method, path, payload=None, headers=None, endpoint=None, readings=0):
+        """Send one request and record its latency; returns (status, parsed body)"""
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = urllib.request.Request(f'{self.base_url}{path}', data=data, method=method)
+        request.add_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            request.add_header(name, value)
+
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+        except (urllib.error.URLError, OSError):
+            status, body = 0, b''
+        self.recorder.record(endpoint or path, status, time.perf_counter() - started, readings)
+        try:
+            return status, json.loads(body) if body else None
+        except ValueError:
+            return status, None
+
+    def register_farmers(self, run_id, options):
+        farmers = []
+        for i in range(options['farmers']):
+            username = f'load-{run_id}-{i}'
+            status, body = self.request('POST', '/api/register/', {
+                'username': username,
+                'email': f'{username}@loadtest.invalid',
+                'password': 'loadtest-password',
+                'password_confirm': 'loadtest-password',
+                'farm_name': f'Load test farm {i}',
+                'ant_threshold_limit': options['threshold'],
+            }, endpoint='register')
+            if status != 201:
+                raise CommandError(f"Farmer registration failed with HTTP {status}: {body}")
+            farmers.append({'farmer_id': body['farmer_id'], 'token': body['token']})
+        return farmers
+
+    def register_devices(self, run_id, farmers, options):
+        devices = []
+        for i in range(options['devices']):
+            farmer = farmers[i % len(farmers)]
+            status, body = self.request('POST', '/api/devices/', {
+                'device_id': f'load-{run_id}-pi-{i}',
+                'device_name': f'Load test Pi {i}',
+                'farmer': farmer['farmer_id'],
+            }, headers={'Authorization': f"Token {farmer['token']}"}, endpoint='create device')
+            if status != 201:
+                raise CommandError(f"Device registration failed with HTTP {status}: {body}")
+            devices.append(SimulatedDevice(
+                body['device_id'], body['api_key'], options['interval'],
+                options['offline_probability'], options['breach_probability'], options['threshold'],
+            ))
+        return devices
+
+    def device_worker(self, devices, stop_at, options):
+        # Stagger first reports so the fleet does not fire in lockstep
+        now = time.monotonic()
+        schedule = [(now + random.uniform(0, options['interval']), i) for i in range(len(devices))]
+        heapq.heapify(schedule)
+        while schedule:
+            due, index = heapq.heappop(schedule)
+            if due >= stop_at:
+                break
+            time.sleep(max(0, due - time.monotonic()))
+            device = devices[index]
+            payload = device.tick(time.monotonic())
+            if payload is not None:
+                count = len(payload) if isinstance(payload, list) else 1
+                status, _ = self.request(
+                    'POST', f'/api/device-data/{device.device_id}/', payload,
+                    headers={'Authorization': device.api_key},
+                    endpoint='device data' if count == 1 else 'device data (backlog)',
+                    readings=count,
+                )
+                if 200 <= status < 300:
+                    device.backlog = []
+            heapq.heappush(schedule, (due + device.interval, index))
+
+    def dashboard_worker(self, farmer, stop_at, options):
+        headers = {'Authorization': f"Token {farmer['token']}"}
+        time.sleep(random.uniform(0, options['poll_interval']))
+        while time.monotonic() < stop_at:
+            self.request('GET', '/api/dashboard/', headers=headers, endpoint='dashboard')
+            time.sleep(options['poll_interval'])
+
+    def report(self, elapsed):
+        recorder = self.recorder
+        self.stdout.write('')
+        self.stdout.write(f"Load ran for {elapsed:.1f}s, {recorder.readings} readings accepted "
+                          f"({recorder.readings / elapsed:.1f} readings/s)")
+        self.stdout.write(f"{'endpoint':<24} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+                          f"{'p99 ms':>8} {'errors':>7} {'429s':>6}")
+        for endpoint in sorted(recorder.latencies):
+            latencies = recorder.latencies[endpoint]
+            statuses = recorder.statuses[endpoint]
+            throttled = statuses.get(429, 0)
+            errors = sum(count for status, count in statuses.items() if status == 0 or status >= 400) - throttled
+            self.stdout.write(
+                f"{endpoint:<24} {len(latencies):>9} {len(latencies) / elapsed:>8.1f} "
+                f"{percentile(latencies, 50) * 1000:>8.1f} {percentile(latencies, 95) * 1000:>8.1f} "
+                f"{percentile(latencies, 99) * 1000:>8.1f} {errors / len(latencies):>7.1%} {throttled:>6}"
+            )
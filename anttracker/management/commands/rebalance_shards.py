@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Count
+
+from anttracker.models import Device, Farmer
+from anttracker.sharding import move_farmer, shards, using_shard
+
+
+class Command(BaseCommand):
+    help = "Show how farmers are spread over the shards, or move one farmer to another shard online"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--farmer', type=int, help="Primary key of the farmer to move")
+        parser.add_argument('--to', help="Database alias of the target shard")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows copied or deleted per query")
+        parser.add_argument('--drain-seconds', type=float,
+                            help="Wait for other processes to see each shard map change "
+                                 "(default: SHARD_MAP_TTL + 1)")
+
+    def handle(self, *args, **options):
+        if options['farmer'] is None and options['to'] is None:
+            self.print_distribution()
+            return
+        if options['farmer'] is None or options['to'] is None:
+            raise CommandError("--farmer and --to go together")
+
+        try:
+            farmer = Farmer.objects.using(DEFAULT_DB_ALIAS).get(pk=options['farmer'])
+        except Farmer.DoesNotExist:
+            raise CommandError(f"Farmer {options['farmer']} does not exist")
+        if farmer.shard_moving:
+            raise CommandError(f"Farmer {farmer.pk} is already moving; finish or clear shard_moving first")
+
+        self.stdout.write(f"Moving farmer {farmer.pk} from '{farmer.shard or DEFAULT_DB_ALIAS}' to '{options['to']}'")
+        try:
+            move_farmer(farmer, options['to'], batch_size=options['batch_size'],
+                        drain_seconds=options['drain_seconds'], log=self.stdout.write)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Farmer {farmer.pk} is now on '{options['to']}'"))
+
+    def print_distribution(self):
+        farmers = dict(
+            Farmer.objects.using(DEFAULT_DB_ALIAS).values_list('shard').annotate(farmers=Count('id')).order_by()
+        )
+        farmers[DEFAULT_DB_ALIAS] = farmers.get(DEFAULT_DB_ALIAS, 0) + farmers.pop('', 0)
+        self.stdout.write(f"{'shard':<16} {'number':>6} {'farmers':>8} {'devices':>8}")
+        for alias, number in sorted(shards().items(), key=lambda item: item[1]):
+            with using_shard(alias):
+                devices = Device.objects.count()
+            self.stdout.write(f"{alias:<16} {number:>6} {farmers.get(alias, 0):>8} {devices:>8}")
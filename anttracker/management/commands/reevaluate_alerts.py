@@ -0,0 +1,52 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from anttracker.models import AlertReevaluation, Farmer
+from anttracker.reevaluation import reevaluation_workers, run_job, schedule_reevaluation
+
+
+class Command(BaseCommand):
+    help = "Re-evaluate stored readings against current alert thresholds and rules, without sending email"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--farmer', type=int, help="Queue and run a job for this farmer's primary key")
+        parser.add_argument('--days', type=int, default=None,
+                            help="With --farmer: how many days back to re-evaluate (default ALERT_REEVALUATION_DAYS)")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Worker processes (default ALERT_REEVALUATION_WORKERS)")
+        parser.add_argument('--loop', type=int, default=0,
+                            help="Re-check for queued jobs every N seconds instead of exiting")
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or reevaluation_workers()
+        if options['farmer'] is not None:
+            try:
+                farmer = Farmer.objects.get(pk=options['farmer'])
+            except Farmer.DoesNotExist:
+                raise CommandError(f"Farmer {options['farmer']} does not exist")
+            since = timezone.now() - timedelta(days=options['days']) if options['days'] else None
+            schedule_reevaluation(farmer, reason='manual', since=since)
+
+        while True:
+            # Interrupted and failed jobs resume with their unfinished chunks
+            jobs = AlertReevaluation.objects.exclude(status=AlertReevaluation.STATUS_DONE).order_by('created_at')
+            for job in jobs:
+                self.stdout.write(f"Job {job.pk}: farmer {job.farmer_id} since {job.since:%Y-%m-%d} ({job.reason or 'no reason'})")
+                job = run_job(job, workers=workers, progress=self.report)
+                self.stdout.write(
+                    f"Job {job.pk} {job.status}: {job.readings_checked} reading(s) checked, "
+                    f"{job.alerts_written} alert(s) recorded"
+                )
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
+
+    def report(self, job, elapsed):
+        rate = job.readings_checked / elapsed if elapsed else 0
+        self.stdout.write(
+            f"  {job.chunks_done}/{job.chunks_total} chunks, {job.readings_checked} readings "
+            f"({rate:,.0f}/s), {job.alerts_written} alerts"
+        )
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from anttracker.aggregates import rebuild, rollup
+from anttracker.sharding import shards
+
+
+class Command(BaseCommand):
+    help = "Fold new sensor readings into the per-region daily aggregates"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=int, default=0,
+                            help="Re-run every N seconds instead of exiting after one rollup")
+        parser.add_argument('--batch-size', type=int, help="Readings folded per transaction")
+        parser.add_argument('--rebuild', action='store_true',
+                            help="Drop all aggregates first and roll up every stored reading again")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            rebuild()
+            self.stdout.write("Dropped all aggregates")
+        while True:
+            for alias in shards():
+                started = time.perf_counter()
+                folded = rollup(alias, batch_size=options['batch_size'])
+                self.stdout.write(f"{alias}: folded {folded} reading(s) in {time.perf_counter() - started:.1f}s")
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -0,0 +1,270 @@
+"""
+In-process request metrics exposed in Prometheus text format.
+
+``MetricsMiddleware`` records per-endpoint latency, SQL query count and
+time (over every database alias, so replica and shard queries count too),
+response render time and response size. Ingest and alert code
+update their own counters through the module-level registry. Each worker
+process aggregates its own numbers; ``/metrics`` reports the numbers of
+the process that serves the scrape.
+"""
+import bisect
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # bucket counts..., +Inf count, sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            items = [(labels, list(counts)) for labels, counts in self.values.items()]
+        for labels, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket{_labels(self.labelnames + ("le",), labels + (bound,))} {cumulative}'
+                )
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {counts[-1]}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+REQUESTS = Counter('http_requests_total', 'HTTP requests by endpoint, method and status',
+                   ('endpoint', 'method', 'status'))
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Request latency', ('endpoint', 'method'))
+REQUEST_QUERIES = Histogram('http_request_db_queries', 'SQL queries per request', ('endpoint',),
+                            buckets=QUERY_COUNT_BUCKETS)
+REQUEST_DB_TIME = Histogram('http_request_db_seconds', 'Time spent in SQL per request', ('endpoint',))
+RESPONSE_RENDER_TIME = Histogram('http_response_render_seconds',
+                                 'Time spent rendering (serializing) API responses', ('endpoint',))
+RESPONSE_SIZE = Histogram('http_response_size_bytes', 'Response body size', ('endpoint',), buckets=SIZE_BUCKETS)
+INGEST_READINGS = Counter('ingest_readings_total', 'Readings accepted per device', ('device',))
+INGEST_DUPLICATES = Counter('ingest_duplicates_total', 'Retried readings ignored per device', ('device',))
+ALERT_SEND_LATENCY = Histogram('alert_send_duration_seconds', 'Time to send an alert notification',
+                               ('alert_type',))
+ALERT_SEND_FAILURES = Counter('alert_send_failures_total', 'Alert notifications that failed to send',
+                              ('alert_type',))
+ML_BATCH_SIZE = Histogram('ml_inference_batch_size', 'Images per server-side inference batch',
+                          buckets=(1, 2, 4, 8, 16, 32, 64))
+ML_BATCH_LATENCY = Histogram('ml_inference_batch_seconds', 'Wall time of a server-side inference batch',
+                             buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+SLOW_REQUESTS = Counter('http_slow_requests_total', 'Requests over the slow-request threshold', ('endpoint',))
+
+REGISTRY = [
+    REQUESTS, REQUEST_LATENCY, REQUEST_QUERIES, REQUEST_DB_TIME, RESPONSE_RENDER_TIME, RESPONSE_SIZE,
+    INGEST_READINGS, INGEST_DUPLICATES, ALERT_SEND_LATENCY, ALERT_SEND_FAILURES, ML_BATCH_SIZE,
+    ML_BATCH_LATENCY, SLOW_REQUESTS,
+]
+
+
+class _QueryTimer:
+    """Database execute wrapper counting queries and their time"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    """Record latency, SQL, render time and size for every request"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_threshold = getattr(settings, 'METRICS_SLOW_REQUEST_MS', None)
+        self.profile_dir = getattr(settings, 'METRICS_PROFILE_DIR', None)
+        self.profile_sample_rate = getattr(settings, 'METRICS_PROFILE_SAMPLE_RATE', 0.01)
+
+    def __call__(self, request):
+        # Profiling slows a request down severalfold, so only a sample is profiled
+        profiler = cProfile.Profile() if self.profile_request() else None
+        timer = _QueryTimer()
+        started = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(timer))
+                response = self.get_response(request)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        endpoint = (match.view_name or match.route) if match else 'unmatched'
+        REQUESTS.inc(endpoint, request.method, response.status_code)
+        REQUEST_LATENCY.observe(elapsed, endpoint, request.method)
+        REQUEST_QUERIES.observe(timer.count, endpoint)
+        REQUEST_DB_TIME.observe(timer.seconds, endpoint)
+        if not response.streaming:
+            RESPONSE_SIZE.observe(len(response.content), endpoint)
+        render_seconds = getattr(response, '_metrics_render_seconds', None)
+        if render_seconds is not None:
+            RESPONSE_RENDER_TIME.observe(render_seconds, endpoint)
+
+        if self.slow_threshold is not None and elapsed * 1000 >= self.slow_threshold:
+            SLOW_REQUESTS.inc(endpoint)
+            logger.warning("Slow request %s %s took %.0f ms (%d queries, %.0f ms SQL)",
+                           request.method, request.path, elapsed * 1000, timer.count, timer.seconds * 1000)
+            if profiler is not None:
+                self.dump_profile(profiler, endpoint, elapsed)
+        return response
+
+    def profile_request(self):
+        if self.slow_threshold is None or not self.profile_dir:
+            return False
+        return random.random() < self.profile_sample_rate
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook returns
+        started = time.perf_counter()
+
+        def record_render_time(rendered):
+            rendered._metrics_render_seconds = time.perf_counter() - started
+            return rendered
+
+        response.add_post_render_callback(record_render_time)
+        return response
+
+    def dump_profile(self, profiler, endpoint, elapsed):
+        directory = Path(self.profile_dir)
+        directory.mkdir(parents=True, exist_ok=True)
+        safe_endpoint = ''.join(c if c.isalnum() or c in '-_' else '_' for c in endpoint)
+        path = directory / f'{time.strftime("%Y%m%d-%H%M%S")}-{safe_endpoint}-{int(elapsed * 1000)}ms-{os.getpid()}.prof'
+        profiler.dump_stats(str(path))
+        logger.warning("Profile written to %s", path)
+
+
+def time_alert_send(alert_type, send):
+    """Run an alert send callable, recording its latency and failure"""
+    started = time.perf_counter()
+    ok = send()
+    ALERT_SEND_LATENCY.observe(time.perf_counter() - started, alert_type)
+    if ok is False:
+        ALERT_SEND_FAILURES.inc(alert_type)
+    return ok
+
+
+def render_metrics():
+    """Render every registered metric plus cache-backed counters"""
+    from .ingest import _buffer
+    from .ml_api import _queue
+    from .throttling import throttle_counters
+
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+
+    lines += ['# HELP throttled_requests_total Requests rejected by throttling or load shedding',
+              '# TYPE throttled_requests_total counter']
+    for scope, value in throttle_counters().items():
+        lines.append(f'throttled_requests_total{{scope="{scope}"}} {value}')
+
+    if _buffer is not None:
+        lines += ['# HELP ingest_buffer_rows Rows waiting in the write-behind buffer',
+                  '# TYPE ingest_buffer_rows gauge',
+                  f'ingest_buffer_rows {len(_buffer)}']
+        for stat, value in _buffer.stats.items():
+            lines += [f'# TYPE ingest_buffer_{stat}_total counter', f'ingest_buffer_{stat}_total {value}']
+
+    if _queue is not None:
+        lines += ['# HELP ml_inference_queue_images Images waiting for server-side counting',
+                  '# TYPE ml_inference_queue_images gauge',
+                  f'ml_inference_queue_images {len(_queue)}']
+        for stat, value in _queue.stats.items():
+            lines += [f'# TYPE ml_inference_{stat}_total counter', f'ml_inference_{stat}_total {value}']
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint, open to staff users and scrapers sending METRICS_TOKEN"""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    # Scrapers authenticate with a bearer token; the client address is not trusted
+    # because behind a reverse proxy every request comes from the proxy
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    has_token = bool(token) and constant_time_compare(header, f'Bearer {token}')
+    user = getattr(request, 'user', None)
+    if not has_token and not (user and user.is_staff):
+        return HttpResponseForbidden('Forbidden')
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.24 on 2026-10-19 02:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anttracker', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sensordata',
+            name='ml_confidence',
+            field=models.FloatField(blank=True, help_text='ML model confidence score from device', null=True),
+        ),
+        migrations.AddField(
+            model_name='sensordata',
+            name='moisture',
+            field=models.FloatField(blank=True, help_text='Soil moisture percentage', null=True),
+        ),
+        migrations.AlterField(
+            model_name='sensordata',
+            name='ant_count',
+            field=models.IntegerField(default=0, help_text='Number of ants detected by device-side ML'),
+        ),
+        migrations.AlterField(
+            model_name='sensordata',
+            name='mealy_bugs_count',
+            field=models.IntegerField(default=0, help_text='Number of mealy bugs detected by device-side ML'),
+        ),
+        migrations.CreateModel(
+            name='AlertRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Human readable rule name', max_length=200)),
+                ('alert_type', models.CharField(default='custom_rule', help_text='Recorded on AlertLog when the rule fires', max_length=50)),
+                ('conditions', models.JSONField(default=list, help_text='List of {"field", "op", "value"} conditions that must all hold')),
+                ('consecutive_readings', models.PositiveIntegerField(default=1, help_text='Number of consecutive matching readings before firing')),
+                ('is_active', models.BooleanField(default=True, help_text='Whether the rule is currently evaluated')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('device', models.ForeignKey(blank=True, help_text='Restrict the rule to one device (leave blank for all farmer devices)', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='alert_rules', to='anttracker.device')),
+                ('farmer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alert_rules', to='anttracker.farmer')),
+            ],
+            options={
+                'verbose_name': 'Alert Rule',
+                'verbose_name_plural': 'Alert Rules',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.24 on 2026-10-19 02:31
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def backfill_last_seen(apps, schema_editor):
+    """Seed last_seen from each device's newest reading"""
+    Device = apps.get_model('anttracker', 'Device')
+    for device in Device.objects.annotate(latest=Max('sensor_data__timestamp')).filter(latest__isnull=False):
+        Device.objects.filter(pk=device.pk).update(last_seen=device.latest)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anttracker', '0002_alertrule_sensordata_moisture_ml_confidence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='health_changed_at',
+            field=models.DateTimeField(blank=True, help_text='When the health state last changed', null=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='health_state',
+            field=models.CharField(choices=[('unknown', 'Unknown'), ('online', 'Online'), ('offline', 'Offline')], default='unknown', help_text='Reporting state maintained by the device health checker', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='last_seen',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When the device last submitted data', null=True),
+        ),
+        migrations.RunPython(backfill_last_seen, migrations.RunPython.noop),
+    ]
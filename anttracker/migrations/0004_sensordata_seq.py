@@ -0,0 +1,22 @@
+# Generated by Django 4.2.24 on 2026-10-19 02:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anttracker', '0003_device_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sensordata',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, help_text='Per-device sequence number used to ignore retried submissions', null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='sensordata',
+            constraint=models.UniqueConstraint(condition=models.Q(('seq__isnull', False)), fields=('device', 'seq'), name='unique_sensor_data_device_seq'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.24 on 2026-10-19 02:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anttracker', '0004_sensordata_seq'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='alertlog',
+            index=models.Index(fields=['-sent_at'], name='alertlog_sent_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sensordata',
+            index=models.Index(fields=['-timestamp'], name='sensordata_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sensordata',
+            index=models.Index(fields=['device', '-timestamp'], name='sensordata_device_ts_idx'),
+        ),
+    ]
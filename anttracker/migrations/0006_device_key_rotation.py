@@ -0,0 +1,23 @@
+# Generated by Django 4.2.24 on 2026-10-19 02:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anttracker', '0005_timestamp_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='previous_api_key',
+            field=models.CharField(blank=True, help_text='Key replaced by the last rotation, accepted until it expires', max_length=100, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='previous_api_key_expires_at',
+            field=models.DateTimeField(blank=True, help_text='End of the grace period for the previous key', null=True),
+        ),
+    ]
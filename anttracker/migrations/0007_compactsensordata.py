@@ -0,0 +1,42 @@
+# Generated by Django 4.2.24 on 2026-10-19 03:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anttracker', '0006_device_key_rotation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompactSensorData',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='compact_sensor_data', to='anttracker.device')),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now, help_text='When the data was recorded')),
+                ('seq', models.PositiveBigIntegerField(blank=True, help_text='Per-device sequence number used to ignore retried submissions', null=True)),
+                ('received_delay', models.IntegerField(help_text='Seconds between timestamp and when the reading was stored')),
+                ('temperature_centi', models.SmallIntegerField(help_text='Temperature in hundredths of a degree Celsius')),
+                ('humidity_centi', models.SmallIntegerField(help_text='Humidity in hundredths of a percent')),
+                ('moisture_centi', models.SmallIntegerField(blank=True, help_text='Soil moisture in hundredths of a percent', null=True)),
+                ('ml_confidence_e4', models.SmallIntegerField(blank=True, help_text='ML confidence score in units of 0.0001', null=True)),
+                ('ant_count', models.PositiveSmallIntegerField(default=0, help_text='Number of ants detected by device-side ML')),
+                ('mealy_bugs_count', models.PositiveSmallIntegerField(default=0, help_text='Number of mealy bugs detected by device-side ML')),
+                ('flags', models.PositiveSmallIntegerField(default=0, help_text='Bit 1: rainfall, bit 2: irrigation')),
+            ],
+            options={
+                'verbose_name': 'Compact Sensor Data',
+                'verbose_name_plural': 'Compact Sensor Data',
+                'ordering': ['-timestamp'],
+                'indexes': [models.Index(fields=['-timestamp'], name='compactdata_timestamp_idx'), models.Index(fields=['device', '-timestamp'], name='compactdata_device_ts_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='compactsensordata',
+            constraint=models.UniqueConstraint(condition=models.Q(('seq__isnull', False)), fields=('device', 'seq'), name='unique_compact_data_device_seq'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.24 on 2026-10-19 03:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_device_directory(apps, schema_editor):
+    """List the existing devices, which all live on the default database"""
+    if schema_editor.connection.alias != 'default':
+        return
+    Device = apps.get_model('anttracker', 'Device')
+    DeviceDirectory = apps.get_model('anttracker', 'DeviceDirectory')
+    DeviceDirectory.objects.bulk_create(
+        [DeviceDirectory(device_pk=pk, device_id=device_id, farmer_id=farmer_id)
+         for pk, device_id, farmer_id in Device.objects.values_list('pk', 'device_id', 'farmer_id').iterator()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anttracker', '0007_compactsensordata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='farmer',
+            name='shard',
+            field=models.CharField(blank=True, default='', help_text="Database alias holding the farmer's devices and readings; blank means default", max_length=64),
+        ),
+        migrations.AddField(
+            model_name='farmer',
+            name='shard_moving',
+            field=models.BooleanField(default=False, help_text='Writes are paused while the farmer moves between shards'),
+        ),
+        migrations.CreateModel(
+            name='DeviceDirectory',
+            fields=[
+                ('device_pk', models.BigIntegerField(help_text='Primary key of the device on its shard', primary_key=True, serialize=False)),
+                ('device_id', models.CharField(help_text='Unique device identifier', max_length=100, unique=True)),
+                ('farmer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='anttracker.farmer')),
+            ],
+            options={
+                'verbose_name': 'Device Directory Entry',
+                'verbose_name_plural': 'Device Directory',
+            },
+        ),
+        migrations.RunPython(populate_device_directory, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.24 on 2026-10-19 03:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anttracker', '0008_sharding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregateWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('database', models.CharField(help_text='Database alias of the shard', max_length=64, unique=True)),
+                ('last_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RegionDailyAggregate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('region', models.CharField(help_text="Farm location of the readings' farmers, blank when unknown", max_length=300)),
+                ('day', models.DateField(help_text='Day the readings were recorded')),
+                ('readings', models.BigIntegerField(default=0)),
+                ('devices', models.JSONField(default=list, help_text='Sorted primary keys of the devices that reported')),
+                ('ant_sum', models.BigIntegerField(default=0)),
+                ('ant_max', models.IntegerField(default=0)),
+                ('ant_histogram', models.JSONField(default=list, help_text='Reading counts per ant count bucket')),
+                ('mealy_bugs_sum', models.BigIntegerField(default=0)),
+                ('mealy_bugs_max', models.IntegerField(default=0)),
+                ('mealy_bugs_histogram', models.JSONField(default=list, help_text='Reading counts per mealy bug count bucket')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Region Daily Aggregate',
+                'verbose_name_plural': 'Region Daily Aggregates',
+                'ordering': ['-day', 'region'],
+                'indexes': [models.Index(fields=['day', 'region'], name='region_aggregate_day_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='regiondailyaggregate',
+            constraint=models.UniqueConstraint(fields=('region', 'day'), name='unique_region_day_aggregate'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.24 on 2026-10-19 03:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anttracker', '0009_regional_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlertReevaluation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reason', models.CharField(blank=True, help_text='What changed, e.g. ant_threshold_limit 50 -> 30', max_length=100)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('since', models.DateTimeField(help_text='Re-evaluate readings recorded from this time')),
+                ('until', models.DateTimeField(blank=True, help_text='Up to this time; set when the job is planned', null=True)),
+                ('chunks_total', models.PositiveIntegerField(default=0)),
+                ('chunks_done', models.PositiveIntegerField(default=0)),
+                ('readings_checked', models.PositiveBigIntegerField(default=0)),
+                ('alerts_written', models.PositiveBigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('farmer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alert_reevaluations', to='anttracker.farmer')),
+            ],
+            options={
+                'verbose_name': 'Alert Re-evaluation',
+                'verbose_name_plural': 'Alert Re-evaluations',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='alertlog',
+            name='reevaluated',
+            field=models.BooleanField(default=False, help_text='Recorded by re-evaluating stored readings; no email was sent'),
+        ),
+        migrations.CreateModel(
+            name='AlertReevaluationChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_pk', models.BigIntegerField(help_text="Primary key of the device on the farmer's shard")),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('done', models.BooleanField(default=False)),
+                ('readings', models.PositiveIntegerField(default=0)),
+                ('alerts', models.PositiveIntegerField(default=0)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='anttracker.alertreevaluation')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['job', 'done'], name='reevaluation_chunk_done_idx')],
+            },
+        ),
+    ]
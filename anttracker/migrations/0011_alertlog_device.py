@@ -0,0 +1,40 @@
+# Generated by Django 4.2.24 on 2026-10-19 03:50
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def populate_alert_devices(apps, schema_editor):
+    AlertLog = apps.get_model('anttracker', 'AlertLog')
+    SensorData = apps.get_model('anttracker', 'SensorData')
+    alias = schema_editor.connection.alias
+    AlertLog.objects.using(alias).update(device_id=Subquery(
+        SensorData.objects.using(alias).filter(pk=OuterRef('sensor_data_id')).values('device_id')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anttracker', '0010_alert_reevaluation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alertlog',
+            name='device',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='alert_logs', to='anttracker.device'),
+        ),
+        migrations.RunPython(populate_alert_devices, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='alertlog',
+            name='device',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alert_logs', to='anttracker.device'),
+        ),
+        migrations.AlterField(
+            model_name='alertlog',
+            name='sensor_data',
+            field=models.ForeignKey(blank=True, help_text='Reading that triggered the alert; blank for device status alerts', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='alerts', to='anttracker.sensordata'),
+        ),
+    ]
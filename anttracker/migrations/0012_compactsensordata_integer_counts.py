@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anttracker', '0011_alertlog_device'),
+    ]
+
+    operations = [
+        # Counts use the same range as SensorData so every reading can be copied
+        migrations.AlterField(
+            model_name='compactsensordata',
+            name='ant_count',
+            field=models.IntegerField(default=0, help_text='Number of ants detected by device-side ML'),
+        ),
+        migrations.AlterField(
+            model_name='compactsensordata',
+            name='mealy_bugs_count',
+            field=models.IntegerField(default=0, help_text='Number of mealy bugs detected by device-side ML'),
+        ),
+    ]
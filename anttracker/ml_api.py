@@ -0,0 +1,543 @@
+"""
+Server-side ant and mealy-bug counting for devices too weak to run the model.
+
+``POST /api/device-sensor-data/`` takes one reading from a device. Devices
+that count on-board send ``ant_count``/``mealy_bugs_count`` (and
+``ml_confidence``) and the reading is stored straight away. Devices that
+upload a trap ``image`` instead get ``202 Accepted``: the image is queued in
+this process, a dispatcher thread groups queued images into micro-batches of
+up to ``ML_BATCH_SIZE`` (or whatever arrived within ``ML_BATCH_WAIT_MS``) and
+runs them on a pool of ``ML_WORKERS`` CPU processes that each hold one copy of
+the model. The counts and confidence land in ``SensorData`` when the batch
+completes. ``GET /api/api-status/`` reports queue depth and throughput.
+
+An image is only acknowledged once it is written to ``ML_SPOOL_DIR`` (one
+``<pid>.<n>.job`` file per image, removed when its reading is stored); an
+upload that cannot be spooled gets 503. Each process holds a lock on
+``<pid>.lock`` while it runs, and a starting process queues the jobs of
+processes whose lock is free, skipping readings that are already stored, so
+images accepted before a restart or deploy are still counted. Uploads larger
+than ``ML_MAX_IMAGE_BYTES`` are refused from their Content-Length before the
+body is read.
+"""
+import atexit
+import fcntl
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from functools import wraps
+from pathlib import Path
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import permissions, status
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
+from rest_framework.response import Response
+
+from . import inference
+from .heartbeat import record_heartbeat
+from .ingest import TRANSIENT_ERRORS, store_readings
+from .idempotency import drop_duplicates, drop_replayed_rows, record_sequences
+from .metrics import INGEST_READINGS, INGEST_DUPLICATES, ML_BATCH_SIZE, ML_BATCH_LATENCY
+from .models import SensorData
+from .provisioning import request_device
+from .rules import evaluate_and_alert
+from .serializers import DeviceDataSubmissionSerializer
+from .sharding import load_devices
+from .throttling import DeviceRateThrottle
+from .views import submit_device_data
+
+
+logger = logging.getLogger(__name__)
+
+# Window used for the throughput figures reported by api-status
+THROUGHPUT_WINDOW = 60
+
+# Bytes allowed in a multipart upload besides the image, for the sensor fields
+UPLOAD_FORM_ALLOWANCE = 16 * 1024
+
+
+class InferenceQueueFull(Exception):
+    """Raised when too many images are waiting and the device should retry later"""
+
+
+class InferenceJob:
+    """One uploaded image with the sensor fields of the reading it belongs to"""
+    __slots__ = ('device', 'fields', 'image', 'received_at', 'path')
+
+    def __init__(self, device, fields, image, path=None):
+        self.device = device
+        self.fields = fields
+        self.image = image
+        self.received_at = time.monotonic()
+        self.path = path  # Spool file, once written
+
+    @property
+    def key(self):
+        seq = self.fields.get('seq')
+        return (self.device.pk, seq) if seq is not None else None
+
+
+class InferenceQueue:
+    """Bounded image queue feeding micro-batches to a process pool"""
+
+    def __init__(self, model_path, spool_dir, workers=2, batch_size=8, batch_wait_ms=500, max_pending=256,
+                 confidence=0.25, image_size=640, worker_threads=1):
+        self.model_path = model_path
+        self.spool_dir = str(spool_dir)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self.max_pending = max_pending
+        self.confidence = confidence
+        self.image_size = image_size
+        self.worker_threads = worker_threads
+
+        self._jobs = deque()
+        self._pending_keys = set()
+        self._in_flight = []
+        self._completed = []
+        self._lock = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self._stopped = False
+        self._recent = deque()  # (finished at, images, seconds from upload to stored)
+        self._spool_names = itertools.count()
+        self._spool_lock = None
+
+        self.stats = {'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0, 'batches': 0}
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def start(self):
+        """Replay spooled jobs, then start the worker pool and the dispatcher thread"""
+        if self._thread is None:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._spool_lock = open(os.path.join(self.spool_dir, f'{os.getpid()}.lock'), 'a')
+            fcntl.flock(self._spool_lock, fcntl.LOCK_EX)
+            self._replay_spool()
+            self._executor = self._make_executor()
+            self._thread = threading.Thread(target=self._run, name='ml-inference-dispatcher', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Stop dispatching; images not stored yet stay spooled for the next process"""
+        with self._lock:
+            self._stopped = True
+            self._lock.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        if self._spool_lock is not None:
+            self._spool_lock.close()
+            self._spool_lock = None
+
+    def submit(self, job):
+        """Spool and queue an image, returning False if the same reading is already queued
+
+        Raises InferenceQueueFull when too many images are waiting and OSError
+        when the image cannot be spooled.
+        """
+        with self._lock:
+            if job.key is not None and job.key in self._pending_keys:
+                return False
+            if len(self._jobs) >= self.max_pending:
+                self.stats['rejected'] += 1
+                raise InferenceQueueFull(f"Inference queue full ({self.max_pending} images)")
+        # Written outside the lock so a slow disk does not hold up the dispatcher
+        self._spool(job)
+        with self._lock:
+            if job.key is not None and job.key in self._pending_keys:
+                self._unspool([job])
+                return False
+            self._jobs.append(job)
+            if job.key is not None:
+                self._pending_keys.add(job.key)
+            self.stats['accepted'] += 1
+            self._lock.notify()
+        return True
+
+    def status(self):
+        """Queue depth, worker usage and recent throughput"""
+        with self._lock:
+            now = time.monotonic()
+            self._trim_recent(now)
+            images = sum(count for _, count, _ in self._recent)
+            latencies = [latency for _, _, latency in self._recent]
+            batches = self.stats['batches']
+            return {
+                'queue_depth': len(self._jobs),
+                'max_pending': self.max_pending,
+                'batches_in_flight': len(self._in_flight),
+                'images_in_flight': sum(len(jobs) for _, jobs, _ in self._in_flight),
+                'workers': self.workers,
+                'batch_size': self.batch_size,
+                'images_per_minute': round(images * 60 / THROUGHPUT_WINDOW, 1),
+                'avg_latency_seconds': round(sum(latencies) / len(latencies), 2) if latencies else None,
+                'avg_batch_size': round(self.stats['processed'] / batches, 1) if batches else None,
+                **self.stats,
+            }
+
+    def _make_executor(self):
+        # Spawned workers import only the Django-free inference module
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=inference.init_worker,
+            initargs=(self.model_path, self.confidence, self.image_size, self.worker_threads),
+        )
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._stopped and not self._completed and not self._ready():
+                    self._lock.wait(self._wait_timeout())
+                if self._stopped:
+                    return
+                completed, self._completed = self._completed, []
+                while self._ready():
+                    self._dispatch([self._jobs.popleft() for _ in range(min(self.batch_size, len(self._jobs)))])
+
+            for future, jobs, started in completed:
+                close_old_connections()
+                self._store(future, jobs, started)
+
+    def _ready(self):
+        """A batch can go out when a worker is free and the batch is full or old enough"""
+        if not self._jobs or len(self._in_flight) >= self.workers:
+            return False
+        return len(self._jobs) >= self.batch_size \
+            or time.monotonic() - self._jobs[0].received_at >= self.batch_wait
+
+    def _wait_timeout(self):
+        if self._jobs and len(self._in_flight) < self.workers:
+            return max(0.0, self._jobs[0].received_at + self.batch_wait - time.monotonic())
+        return None
+
+    def _dispatch(self, jobs):
+        """Hand a micro-batch to the pool; called with the lock held"""
+        images = [job.image for job in jobs]
+        try:
+            future = self._executor.submit(inference.count_batch, images)
+        except BrokenExecutor:
+            # A worker died (e.g. out of memory); start a fresh pool
+            self._executor = self._make_executor()
+            future = self._executor.submit(inference.count_batch, images)
+        entry = (future, jobs, time.monotonic())
+        self._in_flight.append(entry)
+        future.add_done_callback(lambda done: self._finished(entry))
+
+    def _finished(self, entry):
+        with self._lock:
+            self._in_flight.remove(entry)
+            self._completed.append(entry)
+            self._lock.notify()
+
+    def _store(self, future, jobs, started):
+        """Write the readings of a finished batch and evaluate alert rules for them"""
+        ML_BATCH_SIZE.observe(len(jobs))
+        ML_BATCH_LATENCY.observe(time.monotonic() - started)
+        # Jobs that failed for reasons other than their image stay spooled for the next start
+        keep = set()
+        try:
+            results = future.result()
+        except Exception:
+            logger.exception("Inference batch of %d image(s) failed", len(jobs))
+            results = [{'error': 'Inference failed'}] * len(jobs)
+            keep.update(id(job) for job in jobs)
+
+        rows, failed = [], 0
+        for job, result in zip(jobs, results):
+            if 'error' in result:
+                failed += 1
+                logger.warning("Could not count image from device %s: %s", job.device.device_id, result['error'])
+                continue
+            row = SensorData(device=job.device, **{**job.fields, **result})
+            row._inference_job = job
+            rows.append(row)
+
+        # Readings that arrived again through device-data while their image was queued are dropped
+        saved, unsaved = store_readings(rows)
+        failed += len(unsaved)
+        keep.update(id(row._inference_job) for row in unsaved if isinstance(row._ingest_error, TRANSIENT_ERRORS))
+        self._unspool([job for job in jobs if id(job) not in keep])
+
+        for reading in saved:
+            record_sequences(reading.device_id, [reading.seq])
+            INGEST_READINGS.inc(reading.device.device_id)
+
+        now = time.monotonic()
+        with self._lock:
+            for job in jobs:
+                self._pending_keys.discard(job.key)
+            self.stats['batches'] += 1
+            self.stats['processed'] += len(saved)
+            self.stats['failed'] += failed
+            if saved:
+                latency = sum(now - job.received_at for job in jobs) / len(jobs)
+                self._recent.append((now, len(saved), latency))
+            self._trim_recent(now)
+
+        try:
+            evaluate_and_alert(saved)
+        except Exception:
+            # Rows are committed; never re-insert them because alerting failed
+            logger.exception("Failed to evaluate alerts for counted readings")
+
+    def _trim_recent(self, now):
+        while self._recent and self._recent[0][0] < now - THROUGHPUT_WINDOW:
+            self._recent.popleft()
+
+    def _spool(self, job):
+        """Write a job durably: a JSON header line followed by the image bytes"""
+        fields = dict(job.fields, timestamp=job.fields['timestamp'].isoformat())
+        header = json.dumps({'device': job.device.pk, 'fields': fields}).encode()
+        path = os.path.join(self.spool_dir, f'{os.getpid()}.{next(self._spool_names)}.job')
+        with open(f'{path}.tmp', 'wb') as spool:
+            spool.write(header + b'\n' + job.image)
+            spool.flush()
+            os.fsync(spool.fileno())
+        # The rename makes a job visible only once it is complete
+        os.replace(f'{path}.tmp', path)
+        job.path = path
+
+    def _unspool(self, jobs):
+        for job in jobs:
+            if job.path is not None:
+                try:
+                    os.remove(job.path)
+                except FileNotFoundError:
+                    pass
+
+    def _orphaned_jobs(self):
+        """Spool files of processes that no longer hold their lock, with the locks taken over"""
+        by_pid = {}
+        for name in os.listdir(self.spool_dir):
+            pid = name.split('.')[0]
+            if pid.isdigit() and not name.endswith('.lock'):
+                by_pid.setdefault(int(pid), []).append(os.path.join(self.spool_dir, name))
+        orphans, locks = [], []
+        for pid, paths in by_pid.items():
+            if pid != os.getpid():
+                lock = open(os.path.join(self.spool_dir, f'{pid}.lock'), 'a')
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # The owner is still running
+                    lock.close()
+                    continue
+                locks.append(lock)
+            orphans += paths
+        return sorted(orphans), locks
+
+    def _replay_spool(self):
+        """Queue the images left in the spool by this or a previous process"""
+        paths, locks = self._orphaned_jobs()
+        jobs = []
+        for path in paths:
+            if path.endswith('.tmp'):
+                # Torn write of an upload that was never acknowledged
+                os.remove(path)
+                continue
+            try:
+                with open(path, 'rb') as spool:
+                    header, image = spool.read().split(b'\n', 1)
+                record = json.loads(header)
+            except FileNotFoundError:
+                continue
+            except ValueError:
+                logger.warning("Dropping unreadable inference spool file %s", path)
+                os.remove(path)
+                continue
+            # Claim the file so it stays spooled under this process's lock
+            claimed = os.path.join(self.spool_dir, f'{os.getpid()}.{next(self._spool_names)}.job')
+            os.replace(path, claimed)
+            record['fields']['timestamp'] = parse_datetime(record['fields']['timestamp'])
+            jobs.append((record, image, claimed))
+
+        devices = load_devices({record['device'] for record, _, _ in jobs})
+        rows = []
+        for record, image, path in jobs:
+            device = devices.get(record['device'])
+            if device is None:
+                os.remove(path)
+                continue
+            row = SensorData(device=device, **record['fields'])
+            row._inference_job = InferenceJob(device, record['fields'], image, path)
+            rows.append(row)
+        # Readings stored before the restart are not counted again
+        fresh = {id(row._inference_job) for row in drop_replayed_rows(rows)}
+        for row in rows:
+            job = row._inference_job
+            if id(job) not in fresh:
+                self._unspool([job])
+                continue
+            self._jobs.append(job)
+            if job.key is not None:
+                self._pending_keys.add(job.key)
+        if fresh:
+            logger.info("Replaying %d spooled image(s)", len(fresh))
+        for lock in locks:
+            os.remove(lock.name)
+            lock.close()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def server_inference_enabled():
+    return bool(getattr(settings, 'ML_MODEL_PATH', None))
+
+
+def get_queue():
+    """Return the process-wide inference queue, starting it on first use"""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = InferenceQueue(
+                    model_path=settings.ML_MODEL_PATH,
+                    spool_dir=getattr(settings, 'ML_SPOOL_DIR', Path(settings.BASE_DIR) / 'ml_spool'),
+                    workers=getattr(settings, 'ML_WORKERS', 2),
+                    batch_size=getattr(settings, 'ML_BATCH_SIZE', 8),
+                    batch_wait_ms=getattr(settings, 'ML_BATCH_WAIT_MS', 500),
+                    max_pending=getattr(settings, 'ML_MAX_PENDING_IMAGES', 256),
+                    confidence=getattr(settings, 'ML_CONFIDENCE_THRESHOLD', 0.25),
+                    image_size=getattr(settings, 'ML_IMAGE_SIZE', 640),
+                    worker_threads=getattr(settings, 'ML_WORKER_THREADS', 1),
+                )
+                _queue.start()
+    return _queue
+
+
+def refuse_large_uploads(view):
+    """Answer 413 to multipart bodies over ML_MAX_IMAGE_BYTES before anything parses them
+
+    Runs outside DRF because throttling and authentication read the body first.
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        max_bytes = getattr(settings, 'ML_MAX_IMAGE_BYTES', 5 * 1024 * 1024)
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        if request.content_type.startswith('multipart/') and content_length > max_bytes + UPLOAD_FORM_ALLOWANCE:
+            return JsonResponse({'error': f'Image is larger than {max_bytes} bytes'}, status=413)
+        return view(request, *args, **kwargs)
+    return wrapped
+
+
+@refuse_large_uploads
+@api_view(['POST'])
+@permission_classes([permissions.AllowAny])
+@throttle_classes([DeviceRateThrottle])
+def device_sensor_data_api(request):
+    """Accept a reading with on-device counts, or a trap image to count on the server"""
+    api_key = request.headers.get('Authorization')
+    device_id = request.data.get('device_id') if hasattr(request.data, 'get') else None
+
+    if not api_key or not device_id:
+        return Response({
+            'error': 'Device ID and API key are required'
+        }, status=status.HTTP_401_UNAUTHORIZED)
+
+    device = request_device(request, device_id)
+    if device is None:
+        return Response({
+            'error': 'Invalid device ID or API key'
+        }, status=status.HTTP_401_UNAUTHORIZED)
+
+    image = request.FILES.get('image')
+    if image is None:
+        response = submit_device_data(request, device)
+    else:
+        response = _queue_image(request, device, image)
+    # Only accepted submissions count as the device reporting
+    if response.status_code < 400:
+        record_heartbeat(device)
+    return response
+
+
+def _queue_image(request, device, image):
+    """Validate the reading's sensor fields and queue its image for counting"""
+    if not server_inference_enabled():
+        return Response({
+            'error': 'Server-side counting is not configured; submit ant_count and mealy_bugs_count instead'
+        }, status=status.HTTP_501_NOT_IMPLEMENTED)
+
+    max_bytes = getattr(settings, 'ML_MAX_IMAGE_BYTES', 5 * 1024 * 1024)
+    if image.size > max_bytes:
+        return Response({
+            'error': f'Image is larger than {max_bytes} bytes'
+        }, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    data = {key: value for key, value in request.data.items() if key not in ('device_id', 'image')}
+    serializer = DeviceDataSubmissionSerializer(data=data, context={'device': device})
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    fields = dict(serializer.validated_data)
+    # Counts come from the model; the reading is timed when it was uploaded
+    for field in ('ant_count', 'mealy_bugs_count', 'ml_confidence'):
+        fields.pop(field, None)
+    fields.setdefault('timestamp', timezone.now())
+
+    fresh, _ = drop_duplicates(device.pk, [fields], lambda item: item.get('seq'))
+    try:
+        queued = bool(fresh) and get_queue().submit(InferenceJob(device, fields, image.read()))
+    except InferenceQueueFull:
+        response = Response({
+            'error': 'Server is busy, please retry shortly'
+        }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        # A full queue takes a while to drain, so back off longer than for plain readings
+        response['Retry-After'] = '30'
+        return response
+    except OSError:
+        # An image that cannot be spooled would be lost on restart, so it is not accepted
+        logger.exception("Could not spool image from device %s", device.device_id)
+        response = Response({
+            'error': 'Could not store the image, please retry shortly'
+        }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        response['Retry-After'] = '30'
+        return response
+
+    if not queued:
+        # Retried upload of a reading that is already stored or still queued
+        INGEST_DUPLICATES.inc(device.device_id)
+        return Response({
+            'message': 'Duplicate submission ignored',
+            'duplicate': True,
+        }, status=status.HTTP_200_OK)
+    return Response({
+        'message': 'Image queued for counting',
+        'queue_depth': len(get_queue()),
+    }, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.AllowAny])
+def api_status_api(request):
+    """Report API health and the server-side counting queue"""
+    inference_status = _queue.status() if _queue is not None else None
+    return Response({
+        'status': 'ok',
+        'server_time': timezone.now(),
+        'server_inference': server_inference_enabled(),
+        'inference': inference_status,
+    })
@@ -1,8 +1,15 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.core.mail import send_mail
 from django.conf import settings
+import logging
+
+from .compact import (
+    CompactSensorDataQuerySet, created_at_property, flag_property, receipt_delay, scaled_property
+)
+
+logger = logging.getLogger(__name__)
 
 
 class Farmer(models.Model):
@@ -12,12 +19,22 @@ class Farmer(models.Model):
     farm_name = models.CharField(max_length=200, blank=True, null=True)
     farm_location = models.CharField(max_length=300, blank=True, null=True)
     ant_threshold_limit = models.IntegerField(default=50, help_text="Ant count threshold for alerts")
+    shard = models.CharField(max_length=64, blank=True, default='',
+                             help_text="Database alias holding the farmer's devices and readings; blank means default")
+    shard_moving = models.BooleanField(default=False, help_text="Writes are paused while the farmer moves between shards")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.user.username} - {self.farm_name}"
 
+    def save(self, *args, **kwargs):
+        """Override save to place new farmers on a shard"""
+        if self._state.adding and not self.shard:
+            from .sharding import choose_shard
+            self.shard = choose_shard()
+        super().save(*args, **kwargs)
+
     class Meta:
         verbose_name = "Farmer"
         verbose_name_plural = "Farmers"
@@ -25,23 +42,61 @@ class Farmer(models.Model):
 
 class Device(models.Model):
     """Model for Raspberry Pi devices"""
+    HEALTH_UNKNOWN = 'unknown'
+    HEALTH_ONLINE = 'online'
+    HEALTH_OFFLINE = 'offline'
+    HEALTH_CHOICES = [
+        (HEALTH_UNKNOWN, 'Unknown'),
+        (HEALTH_ONLINE, 'Online'),
+        (HEALTH_OFFLINE, 'Offline'),
+    ]
+
     farmer = models.ForeignKey(Farmer, on_delete=models.CASCADE, related_name='devices')
     device_id = models.CharField(max_length=100, unique=True, help_text="Unique device identifier")
     device_name = models.CharField(max_length=200, help_text="Human readable device name")
     location = models.CharField(max_length=300, blank=True, null=True, help_text="Device location description")
     is_active = models.BooleanField(default=True, help_text="Whether device is currently active")
     api_key = models.CharField(max_length=100, unique=True, help_text="API key for device authentication")
+    previous_api_key = models.CharField(max_length=100, unique=True, null=True, blank=True,
+                                        help_text="Key replaced by the last rotation, accepted until it expires")
+    previous_api_key_expires_at = models.DateTimeField(null=True, blank=True,
+                                                       help_text="End of the grace period for the previous key")
+    last_seen = models.DateTimeField(null=True, blank=True, db_index=True, help_text="When the device last submitted data")
+    health_state = models.CharField(max_length=10, choices=HEALTH_CHOICES, default=HEALTH_UNKNOWN,
+                                    help_text="Reporting state maintained by the device health checker")
+    health_changed_at = models.DateTimeField(null=True, blank=True, help_text="When the health state last changed")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.device_name} ({self.device_id})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        device = super().from_db(db, field_names, values)
+        # What the device's DeviceDirectory entry holds, so saves that keep it skip the directory
+        device._directory_entry = (device.__dict__.get('device_id'), device.__dict__.get('farmer_id'))
+        return device
+
     class Meta:
         verbose_name = "Device"
         verbose_name_plural = "Devices"
 
 
+class DeviceDirectory(models.Model):
+    """Global index of device IDs on the default database, for devices stored on any shard"""
+    device_pk = models.BigIntegerField(primary_key=True, help_text="Primary key of the device on its shard")
+    device_id = models.CharField(max_length=100, unique=True, help_text="Unique device identifier")
+    farmer = models.ForeignKey(Farmer, on_delete=models.CASCADE, related_name='+')
+
+    def __str__(self):
+        return self.device_id
+
+    class Meta:
+        verbose_name = "Device Directory Entry"
+        verbose_name_plural = "Device Directory"
+
+
 class SensorData(models.Model):
     """Model for storing sensor data from devices"""
     device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='sensor_data')
@@ -54,6 +109,7 @@ class SensorData(models.Model):
     is_rainfall = models.BooleanField(default=False, help_text="Whether rainfall was detected")
     is_irrigation = models.BooleanField(default=False, help_text="Whether irrigation was active")
     ml_confidence = models.FloatField(null=True, blank=True, help_text="ML model confidence score from device")
+    seq = models.PositiveBigIntegerField(null=True, blank=True, help_text="Per-device sequence number used to ignore retried submissions")
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -63,17 +119,31 @@ class SensorData(models.Model):
         verbose_name = "Sensor Data"
         verbose_name_plural = "Sensor Data"
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['-timestamp'], name='sensordata_timestamp_idx'),
+            models.Index(fields=['device', '-timestamp'], name='sensordata_device_ts_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['device', 'seq'],
+                condition=models.Q(seq__isnull=False),
+                name='unique_sensor_data_device_seq',
+            ),
+        ]
 
     def save(self, *args, **kwargs):
-        """Override save to send email alerts when ant count exceeds threshold"""
+        """Override save to evaluate alert rules for newly recorded readings"""
+        is_new = self._state.adding
         super().save(*args, **kwargs)
         
-        # Check if ant count exceeds threshold
-        if self.ant_count > self.device.farmer.ant_threshold_limit:
-            self.send_ant_alert()
+        # Run the farmer's alert rules (including the ant threshold) on new readings,
+        # once committed so a rolled-back reading never emails anyone
+        if is_new:
+            from .rules import evaluate_and_alert
+            transaction.on_commit(lambda: evaluate_and_alert([self]), using=self._state.db)
 
     def send_ant_alert(self):
-        """Send email alert when ant count exceeds threshold"""
+        """Send email alert when ant count exceeds threshold, returning False if sending failed"""
         try:
             subject = f"Ant Alert: High Ant Count Detected - {self.device.device_name}"
             message = f"""
@@ -105,23 +175,207 @@ MonitorMyBug System
                     [recipient_email],
                     fail_silently=False,
                 )
-        except Exception as e:
+            return True
+        except Exception:
             # Log the error but don't fail the save operation
-            print(f"Failed to send ant alert email: {e}")
+            logger.exception("Failed to send ant alert email")
+            return False
+
+
+class CompactSensorData(models.Model):
+    """Sensor readings in a compact layout; see anttracker.compact"""
+    # Columns are ordered widest first so PostgreSQL adds no alignment padding
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='compact_sensor_data')
+    timestamp = models.DateTimeField(default=timezone.now, help_text="When the data was recorded")
+    seq = models.PositiveBigIntegerField(null=True, blank=True, help_text="Per-device sequence number used to ignore retried submissions")
+    received_delay = models.IntegerField(help_text="Seconds between timestamp and when the reading was stored")
+    temperature_centi = models.SmallIntegerField(help_text="Temperature in hundredths of a degree Celsius")
+    humidity_centi = models.SmallIntegerField(help_text="Humidity in hundredths of a percent")
+    moisture_centi = models.SmallIntegerField(null=True, blank=True, help_text="Soil moisture in hundredths of a percent")
+    ml_confidence_e4 = models.SmallIntegerField(null=True, blank=True, help_text="ML confidence score in units of 0.0001")
+    ant_count = models.IntegerField(default=0, help_text="Number of ants detected by device-side ML")
+    mealy_bugs_count = models.IntegerField(default=0, help_text="Number of mealy bugs detected by device-side ML")
+    flags = models.PositiveSmallIntegerField(default=0, help_text="Bit 1: rainfall, bit 2: irrigation")
+
+    objects = CompactSensorDataQuerySet.as_manager()
+
+    temperature = scaled_property('temperature')
+    humidity = scaled_property('humidity')
+    moisture = scaled_property('moisture')
+    ml_confidence = scaled_property('ml_confidence')
+    is_rainfall = flag_property('is_rainfall')
+    is_irrigation = flag_property('is_irrigation')
+    created_at = created_at_property()
+
+    def __str__(self):
+        return f"{self.device.device_name} - {self.timestamp}"
+
+    class Meta:
+        verbose_name = "Compact Sensor Data"
+        verbose_name_plural = "Compact Sensor Data"
+        ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['-timestamp'], name='compactdata_timestamp_idx'),
+            models.Index(fields=['device', '-timestamp'], name='compactdata_device_ts_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['device', 'seq'],
+                condition=models.Q(seq__isnull=False),
+                name='unique_compact_data_device_seq',
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.received_delay is None:
+            self.received_delay = receipt_delay(self.timestamp, timezone.now())
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def from_sensor_data(cls, reading):
+        """Build the compact equivalent of a SensorData row"""
+        return cls(
+            device_id=reading.device_id, timestamp=reading.timestamp, seq=reading.seq,
+            temperature=reading.temperature, humidity=reading.humidity, moisture=reading.moisture,
+            ml_confidence=reading.ml_confidence, ant_count=reading.ant_count,
+            mealy_bugs_count=reading.mealy_bugs_count, is_rainfall=reading.is_rainfall,
+            is_irrigation=reading.is_irrigation, created_at=reading.created_at,
+        )
+
+
+class AlertRule(models.Model):
+    """Configurable multi-condition alert rule for a farmer or a single device"""
+    farmer = models.ForeignKey(Farmer, on_delete=models.CASCADE, related_name='alert_rules')
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='alert_rules', null=True, blank=True,
+                               help_text="Restrict the rule to one device (leave blank for all farmer devices)")
+    name = models.CharField(max_length=200, help_text="Human readable rule name")
+    alert_type = models.CharField(max_length=50, default='custom_rule', help_text="Recorded on AlertLog when the rule fires")
+    conditions = models.JSONField(default=list, help_text='List of {"field", "op", "value"} conditions that must all hold')
+    consecutive_readings = models.PositiveIntegerField(default=1, help_text="Number of consecutive matching readings before firing")
+    is_active = models.BooleanField(default=True, help_text="Whether the rule is currently evaluated")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.alert_type})"
+
+    class Meta:
+        verbose_name = "Alert Rule"
+        verbose_name_plural = "Alert Rules"
+        ordering = ['-created_at']
 
 
 class AlertLog(models.Model):
     """Model to track sent alerts"""
-    sensor_data = models.ForeignKey(SensorData, on_delete=models.CASCADE, related_name='alerts')
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='alert_logs')
+    sensor_data = models.ForeignKey(SensorData, on_delete=models.CASCADE, null=True, blank=True, related_name='alerts',
+                                    help_text="Reading that triggered the alert; blank for device status alerts")
     alert_type = models.CharField(max_length=50, default='ant_threshold')
     message = models.TextField()
     sent_at = models.DateTimeField(auto_now_add=True)
     sent_to = models.EmailField()
+    reevaluated = models.BooleanField(default=False, help_text="Recorded by re-evaluating stored readings; no email was sent")
 
     def __str__(self):
-        return f"Alert for {self.sensor_data.device.device_name} - {self.sent_at}"
+        return f"Alert for {self.device.device_name} - {self.sent_at}"
 
     class Meta:
         verbose_name = "Alert Log"
         verbose_name_plural = "Alert Logs"
         ordering = ['-sent_at']
+        indexes = [
+            models.Index(fields=['-sent_at'], name='alertlog_sent_at_idx'),
+        ]
+
+
+class RegionDailyAggregate(models.Model):
+    """Fleet-wide reading statistics per farm location and day; see anttracker.aggregates"""
+    region = models.CharField(max_length=300, help_text="Farm location of the readings' farmers, blank when unknown")
+    day = models.DateField(help_text="Day the readings were recorded")
+    readings = models.BigIntegerField(default=0)
+    devices = models.JSONField(default=list, help_text="Sorted primary keys of the devices that reported")
+    ant_sum = models.BigIntegerField(default=0)
+    ant_max = models.IntegerField(default=0)
+    ant_histogram = models.JSONField(default=list, help_text="Reading counts per ant count bucket")
+    mealy_bugs_sum = models.BigIntegerField(default=0)
+    mealy_bugs_max = models.IntegerField(default=0)
+    mealy_bugs_histogram = models.JSONField(default=list, help_text="Reading counts per mealy bug count bucket")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.region or 'Unknown'} - {self.day}"
+
+    class Meta:
+        verbose_name = "Region Daily Aggregate"
+        verbose_name_plural = "Region Daily Aggregates"
+        ordering = ['-day', 'region']
+        constraints = [
+            models.UniqueConstraint(fields=['region', 'day'], name='unique_region_day_aggregate'),
+        ]
+        indexes = [
+            models.Index(fields=['day', 'region'], name='region_aggregate_day_idx'),
+        ]
+
+
+class AggregateWatermark(models.Model):
+    """Last SensorData primary key of a database already folded into the aggregates"""
+    database = models.CharField(max_length=64, unique=True, help_text="Database alias of the shard")
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.database} @ {self.last_id}"
+
+
+class AlertReevaluation(models.Model):
+    """Job re-evaluating a farmer's stored readings against the current rules; see anttracker.reevaluation"""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    farmer = models.ForeignKey(Farmer, on_delete=models.CASCADE, related_name='alert_reevaluations')
+    reason = models.CharField(max_length=100, blank=True, help_text="What changed, e.g. ant_threshold_limit 50 -> 30")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    since = models.DateTimeField(help_text="Re-evaluate readings recorded from this time")
+    until = models.DateTimeField(null=True, blank=True, help_text="Up to this time; set when the job is planned")
+    chunks_total = models.PositiveIntegerField(default=0)
+    chunks_done = models.PositiveIntegerField(default=0)
+    readings_checked = models.PositiveBigIntegerField(default=0)
+    alerts_written = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Re-evaluation {self.pk} for {self.farmer} ({self.status})"
+
+    class Meta:
+        verbose_name = "Alert Re-evaluation"
+        verbose_name_plural = "Alert Re-evaluations"
+        ordering = ['-created_at']
+
+
+class AlertReevaluationChunk(models.Model):
+    """Checkpoint of one device and time range of an alert re-evaluation job"""
+    job = models.ForeignKey(AlertReevaluation, on_delete=models.CASCADE, related_name='chunks')
+    device_pk = models.BigIntegerField(help_text="Primary key of the device on the farmer's shard")
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    done = models.BooleanField(default=False)
+    readings = models.PositiveIntegerField(default=0)
+    alerts = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.job_id}: device {self.device_pk} {self.start:%Y-%m-%d} - {self.end:%Y-%m-%d}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['job', 'done'], name='reevaluation_chunk_done_idx'),
+        ]
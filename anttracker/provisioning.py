@@ -0,0 +1,127 @@
+"""
+Bulk device provisioning and API key rotation.
+
+Both operate on a whole batch in one transaction: provisioning validates
+every row up front (one query for already-taken device IDs) and inserts
+with ``bulk_create``; rotation moves each current key to
+``previous_api_key`` and writes all new keys with one ``bulk_update``. The
+previous key keeps working until ``previous_api_key_expires_at`` so a
+fleet can pick up new keys without downtime.
+
+Device IDs are unique across shards through ``DeviceDirectory``, which is
+also how a device credential finds the farmer's shard.
+"""
+import csv
+import io
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, router, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from .models import Device, DeviceDirectory
+from .sharding import activate_farmer, bulk_create_devices, sharding_enabled
+
+
+CSV_COLUMNS = ('device_id', 'device_name', 'location')
+
+
+def generate_api_key():
+    return get_random_string(32)
+
+
+def key_grace_period():
+    """How long a rotated-out key keeps working"""
+    return timedelta(seconds=getattr(settings, 'DEVICE_KEY_GRACE_PERIOD', 86400))
+
+
+def max_key_grace_period():
+    """Longest grace period a rotation request may ask for, in seconds"""
+    return getattr(settings, 'DEVICE_KEY_MAX_GRACE_PERIOD', 30 * 86400)
+
+
+def parse_device_csv(upload):
+    """Read provisioning rows from an uploaded CSV with a device_id,device_name[,location] header"""
+    text = io.TextIOWrapper(upload, encoding='utf-8-sig', newline='')
+    reader = csv.DictReader(text)
+    missing = {'device_id', 'device_name'} - set(reader.fieldnames or ())
+    if missing:
+        raise ValueError(f"CSV is missing column(s): {', '.join(sorted(missing))}")
+    return [
+        {column: (row.get(column) or '').strip() for column in CSV_COLUMNS}
+        for row in reader
+        if any((value or '').strip() for value in row.values() if isinstance(value, str))
+    ]
+
+
+def taken_device_ids(device_ids):
+    """Device IDs from the batch that already exist or repeat within it"""
+    if sharding_enabled():
+        existing = DeviceDirectory.objects.using(DEFAULT_DB_ALIAS).filter(device_id__in=device_ids)
+    else:
+        existing = Device.objects.filter(device_id__in=device_ids)
+    taken = set(existing.values_list('device_id', flat=True))
+    seen = set()
+    for device_id in device_ids:
+        if device_id in seen:
+            taken.add(device_id)
+        seen.add(device_id)
+    return taken
+
+
+def provision_devices(farmer, rows):
+    """Create devices for validated rows in one transaction, returning them with their keys"""
+    devices = [
+        Device(farmer=farmer, device_id=row['device_id'], device_name=row['device_name'],
+               location=row.get('location') or None, api_key=generate_api_key())
+        for row in rows
+    ]
+    return bulk_create_devices(devices)
+
+
+def rotate_keys(devices, grace=None, now=None):
+    """Issue new keys, keeping each old key valid for the grace period"""
+    now = now or timezone.now()
+    expires_at = now + (key_grace_period() if grace is None else grace)
+    devices = list(devices)
+    for device in devices:
+        device.previous_api_key = device.api_key
+        device.previous_api_key_expires_at = expires_at
+        device.api_key = generate_api_key()
+        device.updated_at = now
+    with transaction.atomic(using=router.db_for_write(Device)):
+        Device.objects.bulk_update(
+            devices, ['api_key', 'previous_api_key', 'previous_api_key_expires_at', 'updated_at'],
+            batch_size=500,
+        )
+    return devices
+
+
+def request_device(request, device_id):
+    """The device a request's Authorization header authenticates, checked once per request"""
+    if not hasattr(request, '_authenticated_device'):
+        request._authenticated_device = authenticate_device(device_id, request.headers.get('Authorization'))
+    return request._authenticated_device
+
+
+def authenticate_device(device_id, api_key, now=None):
+    """Return the active device for a device ID and its current or still-valid previous key"""
+    if not device_id or not api_key:
+        return None
+    # Remove 'Bearer ' prefix if present
+    if api_key.startswith('Bearer '):
+        api_key = api_key[7:]
+    now = now or timezone.now()
+    if sharding_enabled():
+        farmer_id = DeviceDirectory.objects.using(DEFAULT_DB_ALIAS).filter(
+            device_id=device_id).values_list('farmer_id', flat=True).first()
+        if farmer_id is None:
+            return None
+        # Raises FarmerMoving (503) while the farmer moves between shards
+        activate_farmer(farmer_id, for_write=True)
+    return Device.objects.select_related('farmer__user').filter(
+        Q(api_key=api_key) | Q(previous_api_key=api_key, previous_api_key_expires_at__gt=now),
+        device_id=device_id, is_active=True,
+    ).first()
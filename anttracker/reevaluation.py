@@ -0,0 +1,226 @@
+"""
+Re-evaluation of stored readings after alert thresholds or rules change.
+
+An ``AlertReevaluation`` job replays a farmer's stored readings through the
+farmer's current compiled rules (including the ant threshold) and records
+what would have fired as ``AlertLog`` rows with ``reevaluated=True``. No
+email is sent. Changing ``ant_threshold_limit`` through the profile API, or
+saving or deleting an ``AlertRule``, queues a job; the ``reevaluate_alerts``
+command runs queued jobs.
+
+A job is split into chunks of one device and ``ALERT_REEVALUATION_CHUNK_DAYS``
+days. Each ``AlertReevaluationChunk`` is a checkpoint:
+
+- A pool of ``ALERT_REEVALUATION_WORKERS`` processes works through the chunks.
+- Each chunk replaces the re-evaluated logs of its range with one bulk
+  insert, then marks itself done.
+- An interrupted job resumes with the chunks not done yet, and redoing a
+  chunk is harmless.
+
+Multi-reading rules are seeded with the readings just before each chunk, so
+chunk boundaries do not break streaks.
+"""
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import AlertLog, AlertReevaluation, AlertReevaluationChunk, AlertRule, Device, Farmer, SensorData
+from .rules import RULE_FIELDS, compile_farmer_rules, replay_streaks, streak_lookback
+from .sharding import shard_for_farmer, using_shard
+
+
+logger = logging.getLogger(__name__)
+
+READING_FIELDS = ('id', 'device_id', 'timestamp', *RULE_FIELDS)
+
+
+def reevaluation_workers():
+    return getattr(settings, 'ALERT_REEVALUATION_WORKERS', 4)
+
+
+def chunk_days():
+    """Days of one device's readings re-evaluated per chunk"""
+    return getattr(settings, 'ALERT_REEVALUATION_CHUNK_DAYS', 30)
+
+
+def default_period():
+    """How far back a queued job re-evaluates"""
+    return timedelta(days=getattr(settings, 'ALERT_REEVALUATION_DAYS', 365))
+
+
+class StoredReading:
+    """The fields of a stored reading that rules look at, without a model instance"""
+    __slots__ = READING_FIELDS
+
+    def __init__(self, values):
+        for name, value in zip(READING_FIELDS, values):
+            setattr(self, name, value)
+
+
+def schedule_reevaluation(farmer, reason='', since=None):
+    """Queue a job for a farmer, reusing one that has not started yet"""
+    since = since or timezone.now() - default_period()
+    max_length = AlertReevaluation._meta.get_field('reason').max_length
+    job = AlertReevaluation.objects.filter(farmer=farmer, status=AlertReevaluation.STATUS_PENDING).first()
+    if job is None:
+        return AlertReevaluation.objects.create(farmer=farmer, reason=reason[:max_length], since=since)
+    job.since = min(job.since, since)
+    if reason and reason not in job.reason:
+        job.reason = f'{job.reason}; {reason}'[:max_length] if job.reason else reason[:max_length]
+    job.save(update_fields=['since', 'reason'])
+    return job
+
+
+@receiver(post_save, sender=AlertRule)
+@receiver(post_delete, sender=AlertRule)
+def _alert_rule_changed(sender, instance, using, origin=None, **kwargs):
+    # Rules deleted along with their farmer or device leave nothing to re-evaluate
+    if origin is not None and getattr(origin, 'model', type(origin)) is not AlertRule:
+        return
+    # Neither does removing the old copy after a move
+    if using != shard_for_farmer(instance.farmer_id):
+        return
+    farmer = Farmer.objects.filter(pk=instance.farmer_id).first()
+    if farmer is not None:
+        schedule_reevaluation(farmer, reason=f'alert rule {instance.pk} changed')
+
+
+def plan_chunks(job, days=None):
+    """Split a job into device and time range chunks covering the readings it has to check"""
+    days = timedelta(days=days or chunk_days())
+    job.until = job.until or timezone.now()
+    alias = shard_for_farmer(job.farmer_id)
+    spans = (
+        SensorData.objects.using(alias)
+        .filter(device__farmer_id=job.farmer_id, timestamp__gte=job.since, timestamp__lt=job.until)
+        .order_by().values('device_id').annotate(first=Min('timestamp'), last=Max('timestamp'))
+    )
+    chunks = []
+    for span in spans:
+        start = span['first']
+        while start <= span['last']:
+            end = min(start + days, job.until)
+            chunks.append(AlertReevaluationChunk(job=job, device_pk=span['device_id'], start=start, end=end))
+            start = end
+    with transaction.atomic():
+        AlertReevaluationChunk.objects.bulk_create(chunks, batch_size=1000)
+        job.chunks_total = len(chunks)
+        job.save(update_fields=['until', 'chunks_total'])
+    return chunks
+
+
+def _stored_readings(queryset):
+    return [StoredReading(values) for values in queryset.values_list(*READING_FIELDS).iterator(chunk_size=5000)]
+
+
+def reevaluate_chunk(chunk_id):
+    """Replay one chunk's readings through the farmer's rules, returning (chunk id, readings, alerts)"""
+    chunk = AlertReevaluationChunk.objects.select_related('job').get(pk=chunk_id)
+    farmer = Farmer.objects.select_related('user').get(pk=chunk.job.farmer_id)
+    alias = shard_for_farmer(farmer.pk)
+    with using_shard(alias):
+        device = Device.objects.get(pk=chunk.device_pk)
+        rules = [rule for rule in compile_farmer_rules(farmer) if rule.device_id in (None, device.pk)]
+        device_readings = SensorData.objects.filter(device_id=device.pk).order_by('timestamp', 'id')
+        readings = _stored_readings(device_readings.filter(timestamp__gte=chunk.start, timestamp__lt=chunk.end))
+
+        # Readings just before the chunk carry streaks of multi-reading rules over the boundary
+        lookback = streak_lookback(rules)
+        previous = _stored_readings(
+            device_readings.filter(timestamp__lt=chunk.start).order_by('-timestamp', '-id')[:lookback]
+        ) if lookback else []
+        streaks = replay_streaks(rules, reversed(previous))
+
+        logs = []
+        for reading in readings:
+            for rule in rules:
+                matched = rule.predicate(reading)
+                if rule.consecutive > 1:
+                    streaks[rule] = streaks.get(rule, 0) + 1 if matched else 0
+                    matched = streaks[rule] == rule.consecutive
+                if matched:
+                    logs.append(AlertLog(
+                        device_id=device.pk,
+                        sensor_data_id=reading.id,
+                        alert_type=rule.alert_type,
+                        message=f"{rule.name} triggered by {device.device_name} "
+                                f"(ants: {reading.ant_count}, mealy bugs: {reading.mealy_bugs_count})",
+                        sent_to=farmer.user.email or '',
+                        reevaluated=True,
+                    ))
+
+        with transaction.atomic(using=alias):
+            AlertLog.objects.filter(
+                reevaluated=True, device_id=device.pk,
+                sensor_data__timestamp__gte=chunk.start, sensor_data__timestamp__lt=chunk.end,
+            ).delete()
+            AlertLog.objects.bulk_create(logs, batch_size=1000)
+
+    AlertReevaluationChunk.objects.filter(pk=chunk.pk).update(done=True, readings=len(readings), alerts=len(logs))
+    return chunk.pk, len(readings), len(logs)
+
+
+def run_job(job, workers=None, progress=None):
+    """Run (or resume) a job's unfinished chunks on a process pool, returning the job"""
+    workers = reevaluation_workers() if workers is None else workers
+    if not job.chunks.exists():
+        plan_chunks(job)
+    job.status = AlertReevaluation.STATUS_RUNNING
+    job.started_at = job.started_at or timezone.now()
+    job.save(update_fields=['status', 'started_at'])
+
+    pending = list(job.chunks.filter(done=False).values_list('pk', flat=True))
+    started = time.monotonic()
+    failed = 0
+
+    def finished():
+        # Totals come from the checkpoints, so resumed jobs count every chunk once
+        totals = job.chunks.filter(done=True).aggregate(
+            chunks=Count('id'), readings=Sum('readings'), alerts=Sum('alerts'),
+        )
+        job.chunks_done = totals['chunks']
+        job.readings_checked = totals['readings'] or 0
+        job.alerts_written = totals['alerts'] or 0
+        job.save(update_fields=['chunks_done', 'readings_checked', 'alerts_written'])
+        if progress:
+            progress(job, time.monotonic() - started)
+
+    if workers <= 1 or len(pending) <= 1:
+        for chunk_id in pending:
+            try:
+                reevaluate_chunk(chunk_id)
+                finished()
+            except Exception:
+                failed += 1
+                logger.exception("Re-evaluation chunk %s failed", chunk_id)
+    else:
+        # Workers open their own connections; never share the parent's
+        connections.close_all()
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup,
+        ) as pool:
+            futures = {pool.submit(reevaluate_chunk, chunk_id): chunk_id for chunk_id in pending}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    finished()
+                except Exception:
+                    failed += 1
+                    logger.exception("Re-evaluation chunk %s failed", futures[future])
+
+    job.status = AlertReevaluation.STATUS_FAILED if failed else AlertReevaluation.STATUS_DONE
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'finished_at'])
+    return job
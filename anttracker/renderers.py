@@ -0,0 +1,117 @@
+"""
+Compact renderers for list-heavy API responses.
+
+Clients pick them through ``Accept`` (or ``?format=``):
+
+* ``application/vnd.monitormybug.columnar+json`` (``columnar``): every list of
+  records is sent as ``{"count": n, "columns": {field: [values...]}}`` so
+  field names are not repeated per row and similar values sit next to each
+  other, which compresses far better. Fields that follow from another
+  column (``device_name`` and ``farmer_name`` from ``device``) are sent once
+  per device in ``"lookups": {"device": {pk: {field: value}}}``.
+* ``application/msgpack`` (``msgpack``): MessagePack.
+
+Renderers with a missing dependency are skipped during content negotiation
+instead of failing at render time.
+"""
+import json
+
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import msgpack
+except ImportError:  # Listed in requirements.txt; the renderer is skipped without it
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # Optional dependency, only used for speed
+    orjson = None
+
+
+# Column -> columns whose values follow from it, sent once per distinct value
+LOOKUP_FIELDS = {
+    'device': ('device_name', 'farmer_name'),
+}
+
+
+def split_lookups(columns):
+    """Move columns that follow from another column into per-value lookup tables"""
+    lookups = {}
+    for key, dependents in LOOKUP_FIELDS.items():
+        dependents = [field for field in dependents if field in columns]
+        if key not in columns or not dependents:
+            continue
+        table = {}
+        for i, value in enumerate(columns[key]):
+            entry = {field: columns[field][i] for field in dependents}
+            if table.setdefault(str(value), entry) != entry:
+                # Not a function of the key column after all; keep the columns
+                break
+        else:
+            lookups[key] = table
+            for field in dependents:
+                del columns[field]
+    return lookups
+
+
+def to_columns(data):
+    """Recursively turn lists of same-shaped dicts into column arrays"""
+    if isinstance(data, dict):
+        return {key: to_columns(value) for key, value in data.items()}
+    if isinstance(data, list):
+        if data and all(isinstance(item, dict) for item in data):
+            fields = list(data[0])
+            if all(len(item) == len(fields) and all(field in item for field in fields) for item in data):
+                columns = {field: [to_columns(item[field]) for item in data] for field in fields}
+                result = {'count': len(data), 'columns': columns}
+                lookups = split_lookups(columns)
+                if lookups:
+                    result['lookups'] = lookups
+                return result
+        return [to_columns(item) for item in data]
+    return data
+
+
+def _default(obj):
+    # Same conversions as DRF's JSON renderer (dates, decimals, UUIDs, lazy strings)
+    return JSONEncoder().default(obj)
+
+
+class ColumnarJSONRenderer(BaseRenderer):
+    """JSON with lists of records transposed into columns"""
+    media_type = 'application/vnd.monitormybug.columnar+json'
+    format = 'columnar'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        data = to_columns(data)
+        if orjson is not None:
+            return orjson.dumps(data, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class MessagePackRenderer(BaseRenderer):
+    """MessagePack encoding of the regular response structure"""
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    available = msgpack is not None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_default, use_bin_type=True)
+
+
+class ContentNegotiation(DefaultContentNegotiation):
+    """Default negotiation that ignores renderers whose optional dependency is missing"""
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        renderers = [renderer for renderer in renderers if getattr(renderer, 'available', True)]
+        return super().select_renderer(request, renderers, format_suffix)
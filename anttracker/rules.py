@@ -0,0 +1,321 @@
+"""
+Alert rule engine.
+
+Rules are compiled once per farmer into a cached evaluator and run against
+batches of readings, so the per-reading cost stays a handful of comparisons
+no matter how many rules a farmer configures.
+"""
+import logging
+import operator
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import send_mail
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .metrics import time_alert_send
+from .models import Farmer, Device, SensorData, AlertRule, AlertLog
+from .sharding import group_by_database, using_shard
+
+
+logger = logging.getLogger(__name__)
+
+
+# Reading fields a rule condition may refer to
+RULE_FIELDS = (
+    'temperature', 'humidity', 'moisture', 'ant_count', 'mealy_bugs_count',
+    'is_rainfall', 'is_irrigation', 'ml_confidence',
+)
+
+RULE_OPERATORS = {
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'eq': operator.eq,
+    'ne': operator.ne,
+}
+
+# Alert type recorded for the built-in per-farmer ant threshold rule
+ANT_THRESHOLD_ALERT = 'ant_threshold'
+
+# farmer_id -> (version, compiled rules)
+_compiled_rules = {}
+
+
+def validate_conditions(conditions):
+    """Validate a rule's condition list, raising ValueError when malformed"""
+    if not isinstance(conditions, list) or not conditions:
+        raise ValueError("Conditions must be a non-empty list.")
+    for condition in conditions:
+        if not isinstance(condition, dict):
+            raise ValueError("Each condition must be an object with field, op and value.")
+        if condition.get('field') not in RULE_FIELDS:
+            raise ValueError(f"Unknown field '{condition.get('field')}'. Choose from: {', '.join(RULE_FIELDS)}.")
+        if condition.get('op') not in RULE_OPERATORS:
+            raise ValueError(f"Unknown operator '{condition.get('op')}'. Choose from: {', '.join(RULE_OPERATORS)}.")
+        value = condition.get('value')
+        if isinstance(value, bool):
+            if not condition['field'].startswith('is_'):
+                raise ValueError(f"Condition value for '{condition['field']}' must be a number.")
+        elif not isinstance(value, (int, float)):
+            raise ValueError(f"Condition value for '{condition['field']}' must be a number or boolean.")
+
+
+def compile_conditions(conditions):
+    """Compile a condition list into a single predicate over a reading"""
+    checks = tuple(
+        (operator.attrgetter(c['field']), RULE_OPERATORS[c['op']], c['value'])
+        for c in conditions
+    )
+
+    def predicate(reading):
+        for getter, op, value in checks:
+            current = getter(reading)
+            if current is None or not op(current, value):
+                return False
+        return True
+
+    return predicate
+
+
+class CompiledRule:
+    """An alert rule reduced to a predicate plus the metadata needed to fire it"""
+
+    __slots__ = ('rule_id', 'name', 'alert_type', 'device_id', 'consecutive', 'predicate')
+
+    def __init__(self, rule_id, name, alert_type, device_id, consecutive, predicate):
+        self.rule_id = rule_id
+        self.name = name
+        self.alert_type = alert_type
+        self.device_id = device_id
+        self.consecutive = max(consecutive, 1)
+        self.predicate = predicate
+
+    def applies_to(self, reading):
+        return self.device_id is None or self.device_id == reading.device_id
+
+
+def streak_lookback(rules):
+    """Stored readings needed to know the streaks of multi-reading rules"""
+    # One more than a rule needs, so a streak that already fired does not fire again
+    return max((rule.consecutive for rule in rules if rule.consecutive > 1), default=0)
+
+
+def replay_streaks(rules, readings):
+    """Streak of each multi-reading rule at the end of readings (oldest first)"""
+    streaks = {}
+    for reading in readings:
+        for rule in rules:
+            if rule.consecutive > 1:
+                streaks[rule] = streaks.get(rule, 0) + 1 if rule.predicate(reading) else 0
+    return streaks
+
+
+def readings_before(device_id, reading, count, exclude=()):
+    """The last count stored readings of a device before a reading, oldest first"""
+    earlier = SensorData.objects.filter(device_id=device_id).filter(
+        Q(timestamp__lt=reading.timestamp) | Q(timestamp=reading.timestamp, id__lt=reading.pk)
+    ).exclude(pk__in=exclude)
+    fields = ('id', 'device_id', 'timestamp', *RULE_FIELDS)
+    return list(reversed(earlier.order_by('-timestamp', '-id').only(*fields)[:count]))
+
+
+def _version_key(farmer_id):
+    return f'alert_rules_version:{farmer_id}'
+
+
+def invalidate_rules(farmer_id):
+    """Force every process to recompile the farmer's rules on the next batch"""
+    try:
+        cache.incr(_version_key(farmer_id))
+    except ValueError:
+        cache.set(_version_key(farmer_id), 1, None)
+    _compiled_rules.pop(farmer_id, None)
+
+
+def compile_farmer_rules(farmer):
+    """Build the compiled rule list for a farmer, including the ant threshold rule"""
+    threshold = farmer.ant_threshold_limit
+    compiled = [
+        CompiledRule(
+            rule_id=None,
+            name='Ant threshold',
+            alert_type=ANT_THRESHOLD_ALERT,
+            device_id=None,
+            consecutive=1,
+            predicate=lambda reading: reading.ant_count > threshold,
+        )
+    ]
+    for rule in AlertRule.objects.filter(farmer=farmer, is_active=True).order_by('id'):
+        try:
+            validate_conditions(rule.conditions)
+        except ValueError as e:
+            logger.warning("Skipping invalid alert rule %s: %s", rule.pk, e)
+            continue
+        compiled.append(CompiledRule(
+            rule_id=rule.pk,
+            name=rule.name,
+            alert_type=rule.alert_type,
+            device_id=rule.device_id,
+            consecutive=rule.consecutive_readings,
+            predicate=compile_conditions(rule.conditions),
+        ))
+    return compiled
+
+
+def get_farmer_rules(farmer):
+    """Return the farmer's compiled rules, recompiling only when they changed"""
+    version = cache.get(_version_key(farmer.pk), 0)
+    cached = _compiled_rules.get(farmer.pk)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    compiled = compile_farmer_rules(farmer)
+    _compiled_rules[farmer.pk] = (version, compiled)
+    return compiled
+
+
+def _attach_devices(readings):
+    """Load device, farmer and user for a batch of readings in one query"""
+    missing = {
+        r.device_id for r in readings
+        if not SensorData.device.is_cached(r) or not Device.farmer.is_cached(r.device)
+    }
+    if not missing:
+        return
+    devices = Device.objects.select_related('farmer__user').in_bulk(missing)
+    for reading in readings:
+        if reading.device_id in devices:
+            reading.device = devices[reading.device_id]
+
+
+def evaluate_readings(readings):
+    """Run the compiled rules over a batch of readings and return (reading, rule) matches"""
+    readings = sorted(readings, key=lambda r: (r.device_id, r.timestamp, r.pk))
+    _attach_devices(readings)
+
+    rules_by_farmer = {}
+    for reading in readings:
+        farmer = reading.device.farmer
+        if farmer.pk not in rules_by_farmer:
+            rules_by_farmer[farmer.pk] = get_farmer_rules(farmer)
+
+    # Streaks of multi-reading rules are rebuilt from the readings stored just
+    # before each device's first reading in the batch
+    batch_ids = [reading.pk for reading in readings]
+    streaks = {}
+    for reading in readings:
+        if reading.device_id in streaks:
+            continue
+        rules = [
+            rule for rule in rules_by_farmer[reading.device.farmer_id]
+            if rule.consecutive > 1 and rule.applies_to(reading)
+        ]
+        lookback = streak_lookback(rules)
+        previous = readings_before(reading.device_id, reading, lookback, batch_ids) if lookback else []
+        streaks[reading.device_id] = replay_streaks(rules, previous)
+
+    matches = []
+    for reading in readings:
+        device_streaks = streaks[reading.device_id]
+        for rule in rules_by_farmer[reading.device.farmer_id]:
+            if not rule.applies_to(reading):
+                continue
+            matched = rule.predicate(reading)
+            if rule.consecutive == 1:
+                if matched:
+                    matches.append((reading, rule))
+                continue
+            streak = device_streaks.get(rule, 0) + 1 if matched else 0
+            device_streaks[rule] = streak
+            if streak == rule.consecutive:
+                matches.append((reading, rule))
+
+    return matches
+
+
+def send_rule_alert(reading, rule):
+    """Send email alert when a configured rule fires, returning False if sending failed"""
+    user = reading.device.farmer.user
+    subject = f"{rule.name} Alert - {reading.device.device_name}"
+    message = f"""
+Dear {user.first_name or user.username},
+
+Your alert rule "{rule.name}" was triggered by device "{reading.device.device_name}".
+
+Alert Details:
+- Device: {reading.device.device_name}
+- Location: {reading.device.location or 'Not specified'}
+- Ant Count: {reading.ant_count}
+- Mealy Bugs Count: {reading.mealy_bugs_count}
+- Temperature: {reading.temperature}°C
+- Humidity: {reading.humidity}%
+- Time: {reading.timestamp.strftime('%Y-%m-%d %H:%M:%S')}
+
+Please check your farm and take necessary action if required.
+
+Best regards,
+MonitorMyBug System
+            """
+    try:
+        if user.email:
+            send_mail(
+                subject,
+                message,
+                getattr(settings, 'DEFAULT_FROM_EMAIL', None) or 'noreply@monitormybug.com',
+                [user.email],
+                fail_silently=False,
+            )
+        return True
+    except Exception:
+        # Log the error but don't fail the ingest
+        logger.exception("Failed to send rule alert email")
+        return False
+
+
+def send_alerts(matches, notify=True):
+    """Notify farmers about fired rules and record them in AlertLog"""
+    logs = []
+    for reading, rule in matches:
+        if notify:
+            if rule.alert_type == ANT_THRESHOLD_ALERT and rule.rule_id is None:
+                time_alert_send(rule.alert_type, reading.send_ant_alert)
+            else:
+                time_alert_send(rule.alert_type, lambda: send_rule_alert(reading, rule))
+        logs.append(AlertLog(
+            device_id=reading.device_id,
+            sensor_data=reading,
+            alert_type=rule.alert_type,
+            message=f"{rule.name} triggered by {reading.device.device_name} "
+                    f"(ants: {reading.ant_count}, mealy bugs: {reading.mealy_bugs_count})",
+            sent_to=reading.device.farmer.user.email or '',
+        ))
+    return AlertLog.objects.bulk_create(logs)
+
+
+def evaluate_and_alert(readings, notify=True):
+    """Evaluate a batch of saved readings and fire any matching alerts"""
+    readings = [r for r in readings if r.pk is not None]
+    matches = []
+    # Rules and alert logs live on the shard of the readings
+    for alias, group in group_by_database(readings):
+        with using_shard(alias):
+            group_matches = evaluate_readings(group)
+            if group_matches:
+                send_alerts(group_matches, notify=notify)
+        matches += group_matches
+    return matches
+
+
+@receiver(post_save, sender=AlertRule)
+@receiver(post_delete, sender=AlertRule)
+def _alert_rule_changed(sender, instance, **kwargs):
+    invalidate_rules(instance.farmer_id)
+
+
+@receiver(post_save, sender=Farmer)
+def _farmer_changed(sender, instance, **kwargs):
+    # The built-in ant threshold rule depends on the farmer's limit
+    invalidate_rules(instance.pk)
@@ -1,6 +1,9 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import Farmer, Device, SensorData, AlertLog
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from .models import Farmer, Device, DeviceDirectory, SensorData, AlertLog, AlertRule
+from .idempotency import SequenceConflict, drop_duplicates, record_sequences, stored_sequences
+from .rules import validate_conditions, evaluate_and_alert
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -31,13 +34,36 @@ class DeviceSerializer(serializers.ModelSerializer):
     class Meta:
         model = Device
         fields = ['id', 'device_id', 'device_name', 'location', 'is_active', 
-                 'api_key', 'farmer', 'farmer_name', 'sensor_data_count', 
-                 'created_at', 'updated_at']
-        read_only_fields = ['id', 'api_key', 'created_at', 'updated_at']
+                 'api_key', 'previous_api_key_expires_at', 'farmer', 'farmer_name', 'sensor_data_count', 
+                 'last_seen', 'health_state', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'api_key', 'previous_api_key_expires_at', 'last_seen', 'health_state',
+                            'created_at', 'updated_at']
     
     def get_sensor_data_count(self, obj):
         """Get count of sensor data records for this device"""
+        # List views annotate the count so it is not one query per device
+        if hasattr(obj, 'sensor_data_total'):
+            return obj.sensor_data_total
         return obj.sensor_data.count()
+    
+    def validate_device_id(self, value):
+        """Device IDs are unique across every shard, not just the farmer's"""
+        taken = DeviceDirectory.objects.using(DEFAULT_DB_ALIAS).filter(device_id=value)
+        if self.instance is not None:
+            taken = taken.exclude(device_pk=self.instance.pk)
+        if taken.exists():
+            raise serializers.ValidationError("device with this device id already exists.")
+        return value
+
+
+class DeviceProvisionSerializer(serializers.ModelSerializer):
+    """Serializer for one row of a bulk device provisioning request"""
+    
+    class Meta:
+        model = Device
+        fields = ['device_id', 'device_name', 'location']
+        # Taken device IDs are checked for the whole batch in one query
+        extra_kwargs = {'device_id': {'validators': []}}
 
 
 class SensorDataSerializer(serializers.ModelSerializer):
@@ -53,29 +79,113 @@ class SensorDataSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
 
 
+class DeviceDataBatchSerializer(serializers.ListSerializer):
+    """List serializer that stores a batch of device readings with one insert"""
+    duplicates = 0
+    
+    def create(self, validated_data):
+        """Bulk create new sensor data records and evaluate alert rules once for the batch"""
+        device = self.context['device']
+        seq_of = lambda item: item.get('seq')
+        items, self.duplicates = drop_duplicates(device.pk, validated_data, seq_of)
+        try:
+            with transaction.atomic(using=device._state.db):
+                readings = SensorData.objects.bulk_create(
+                    [SensorData(device=device, **item) for item in items]
+                )
+        except IntegrityError:
+            # A concurrent retry stored some of these sequences first
+            items, duplicates = drop_duplicates(device.pk, items, seq_of, check_all=True)
+            self.duplicates += duplicates
+            with transaction.atomic(using=device._state.db):
+                readings = SensorData.objects.bulk_create(
+                    [SensorData(device=device, **item) for item in items]
+                )
+        record_sequences(device.pk, [item.get('seq') for item in items])
+        evaluate_and_alert(readings)
+        return readings
+
+
 class DeviceDataSubmissionSerializer(serializers.ModelSerializer):
     """Serializer for device data submission API (used by Raspberry Pi)"""
+    duplicate = False
     
     class Meta:
         model = SensorData
-        fields = ['timestamp', 'temperature', 'humidity', 'ant_count', 
-                 'mealy_bugs_count', 'is_rainfall', 'is_irrigation']
+        fields = ['timestamp', 'temperature', 'humidity', 'moisture', 'ant_count', 
+                 'mealy_bugs_count', 'is_rainfall', 'is_irrigation', 'ml_confidence', 'seq']
+        list_serializer_class = DeviceDataBatchSerializer
+        # Uniqueness of (device, seq) is enforced by the index, not a lookup per request
+        validators = []
+    
+    def validate_ml_confidence(self, value):
+        """Confidence scores are probabilities"""
+        if value is not None and not 0 <= value <= 1:
+            raise serializers.ValidationError("ML confidence must be between 0 and 1.")
+        return value
     
     def create(self, validated_data):
-        """Create sensor data record"""
+        """Create sensor data record, returning the stored one for a retried sequence"""
         device = self.context['device']
-        return SensorData.objects.create(device=device, **validated_data)
+        seq = validated_data.get('seq')
+        if seq is None:
+            return SensorData.objects.create(device=device, **validated_data)
+        
+        for attempt in range(2):
+            if not stored_sequences(device.pk, [seq]):
+                try:
+                    with transaction.atomic(using=device._state.db):
+                        reading = SensorData.objects.create(device=device, **validated_data)
+                    record_sequences(device.pk, [seq])
+                    return reading
+                except IntegrityError:
+                    pass
+            try:
+                # Read from the device's database; a replica may not have the row yet
+                reading = SensorData.objects.using(device._state.db).get(device=device, seq=seq)
+            except SensorData.DoesNotExist:
+                # The conflicting insert rolled back; try again
+                continue
+            self.duplicate = True
+            return reading
+        raise SequenceConflict()
+
+
+class AlertRuleSerializer(serializers.ModelSerializer):
+    """Serializer for AlertRule model"""
+    device_name = serializers.CharField(source='device.device_name', read_only=True)
+    
+    class Meta:
+        model = AlertRule
+        fields = ['id', 'name', 'alert_type', 'device', 'device_name', 'conditions', 
+                 'consecutive_readings', 'is_active', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'created_at', 'updated_at']
+    
+    def validate_conditions(self, value):
+        """Validate rule conditions against the fields and operators the engine supports"""
+        try:
+            validate_conditions(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return value
+    
+    def validate_device(self, value):
+        """Only allow rules on the requesting farmer's own devices"""
+        farmer = self.context['request'].user.farmer
+        if value is not None and value.farmer_id != farmer.id:
+            raise serializers.ValidationError("Device does not belong to this farmer.")
+        return value
 
 
 class AlertLogSerializer(serializers.ModelSerializer):
     """Serializer for AlertLog model"""
-    device_name = serializers.CharField(source='sensor_data.device.device_name', read_only=True)
+    device_name = serializers.CharField(source='device.device_name', read_only=True)
     
     class Meta:
         model = AlertLog
-        fields = ['id', 'sensor_data', 'device_name', 'alert_type', 'message', 
-                 'sent_at', 'sent_to']
-        read_only_fields = ['id', 'sent_at']
+        fields = ['id', 'device', 'sensor_data', 'device_name', 'alert_type', 'message', 
+                 'sent_at', 'sent_to', 'reevaluated']
+        read_only_fields = ['id', 'sent_at', 'reevaluated']
 
 
 class FarmerRegistrationSerializer(serializers.ModelSerializer):
@@ -0,0 +1,521 @@
+"""
+Farmer-based sharding of device data across several databases.
+
+``DATABASE_SHARDS`` maps database aliases to shard numbers. Each farmer is
+placed on one shard (``Farmer.shard``, the shard map) and everything that
+belongs to the farmer's devices - ``Device``, ``SensorData``,
+``CompactSensorData``, ``AlertRule`` and ``AlertLog`` - lives there. Users,
+farmers, tokens and sessions stay on ``default``; each shard keeps a copy
+of its farmers' ``User`` and ``Farmer`` rows so relations and joins such as
+``select_related('farmer__user')`` work inside a shard.
+
+``ShardRouter`` sends sharded models to:
+
+1. the database an instance was loaded from, or the shard of the farmer or
+   device it belongs to;
+2. the shard activated for the current context - by ``using_shard``, by
+   device authentication, or lazily from the farmer of the request user;
+3. ``default``.
+
+Rows get globally unique primary keys: shard ``n`` allocates IDs from
+``n * SHARD_ID_SPAN`` on, so a farmer moves between shards without
+renumbering. ``DeviceDirectory`` on ``default`` maps device IDs to farmers,
+so ingest finds the shard from the device credential alone.
+
+With a single shard (the default) the router stays out of the way.
+"""
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+from itertools import groupby
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Count, Max, Q
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+from rest_framework import exceptions
+
+from .models import AlertLog, AlertRule, CompactSensorData, Device, DeviceDirectory, Farmer, SensorData
+
+
+logger = logging.getLogger(__name__)
+
+SHARD_ID_SPAN = 2 ** 40
+
+# In dependency order, for copying; deleted in reverse
+SHARDED_MODELS = (Device, AlertRule, SensorData, CompactSensorData, AlertLog)
+
+# Path from each sharded model to its farmer's primary key
+FARMER_LOOKUPS = {
+    Device: 'farmer_id',
+    AlertRule: 'farmer_id',
+    SensorData: 'device__farmer_id',
+    CompactSensorData: 'device__farmer_id',
+    AlertLog: 'device__farmer_id',
+}
+
+# Routing state of the current request or task
+_context = contextvars.ContextVar('shard_context', default=None)
+
+# farmer_id -> (checked at, shard, moving)
+_shard_map = {}
+
+
+class FarmerMoving(exceptions.APIException):
+    status_code = 503
+    default_detail = 'Farmer data is moving to another database; retry shortly.'
+    default_code = 'farmer_moving'
+
+    @property
+    def wait(self):
+        # DRF sends this as Retry-After
+        return shard_map_ttl() + 1
+
+
+def shards():
+    return getattr(settings, 'DATABASE_SHARDS', {DEFAULT_DB_ALIAS: 0})
+
+
+def sharding_enabled():
+    return len(shards()) > 1
+
+
+def shard_map_ttl():
+    """Seconds a process trusts its copy of a farmer's shard"""
+    return getattr(settings, 'SHARD_MAP_TTL', 5)
+
+
+def is_sharded(model):
+    return model in FARMER_LOOKUPS
+
+
+def choose_shard():
+    """Shard for a new farmer: the one with the fewest farmers"""
+    if not sharding_enabled():
+        return DEFAULT_DB_ALIAS
+    counts = dict(
+        Farmer.objects.using(DEFAULT_DB_ALIAS).values_list('shard').annotate(farmers=Count('id')).order_by()
+    )
+    counts[DEFAULT_DB_ALIAS] = counts.get(DEFAULT_DB_ALIAS, 0) + counts.pop('', 0)
+    return min(shards(), key=lambda alias: (counts.get(alias, 0), shards()[alias]))
+
+
+def farmer_shard(farmer_id):
+    """(shard alias, moving) of a farmer, cached per process for SHARD_MAP_TTL seconds"""
+    if not sharding_enabled():
+        return DEFAULT_DB_ALIAS, False
+    checked_at, shard, moving = _shard_map.get(farmer_id, (None, None, False))
+    if checked_at is None or time.monotonic() - checked_at >= shard_map_ttl():
+        row = Farmer.objects.using(DEFAULT_DB_ALIAS).filter(pk=farmer_id).values_list('shard', 'shard_moving').first()
+        shard, moving = row if row else (DEFAULT_DB_ALIAS, False)
+        shard = shard or DEFAULT_DB_ALIAS
+        _shard_map[farmer_id] = (time.monotonic(), shard, moving)
+    return shard, moving
+
+
+def shard_for_farmer(farmer_id):
+    return farmer_shard(farmer_id)[0]
+
+
+def forget_farmer(farmer_id):
+    _shard_map.pop(farmer_id, None)
+
+
+def activate_farmer(farmer_id, for_write=False):
+    """Route the rest of the current context to a farmer's shard"""
+    shard, moving = farmer_shard(farmer_id)
+    if moving and for_write:
+        raise FarmerMoving()
+    state = _context.get()
+    if state is None:
+        _context.set({'shard': shard, 'farmer_id': farmer_id, 'request': None})
+    else:
+        state['shard'], state['farmer_id'] = shard, farmer_id
+    return shard
+
+
+@contextmanager
+def using_shard(alias):
+    """Route sharded models without an instance to alias inside the block"""
+    token = _context.set({'shard': alias, 'farmer_id': None, 'request': None})
+    try:
+        yield alias
+    finally:
+        _context.reset(token)
+
+
+def _request_farmer_id(request):
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return None
+    farmer = getattr(user, 'farmer', None)
+    return farmer.pk if farmer is not None else None
+
+
+def context_shard(for_write=False):
+    """Shard of the current context, resolving the request user's farmer on first use"""
+    state = _context.get()
+    if state is None:
+        return DEFAULT_DB_ALIAS
+    if state['shard'] is None and state['request'] is not None:
+        farmer_id = _request_farmer_id(state['request'])
+        if farmer_id is not None:
+            state['shard'], state['farmer_id'] = shard_for_farmer(farmer_id), farmer_id
+    if for_write and state['farmer_id'] is not None and farmer_shard(state['farmer_id'])[1]:
+        raise FarmerMoving()
+    return state['shard'] or DEFAULT_DB_ALIAS
+
+
+def instance_shard(instance):
+    """Database a model instance lives on, or None when it cannot tell"""
+    if isinstance(instance, Farmer):
+        return shard_for_farmer(instance.pk)
+    if not is_sharded(type(instance)):
+        return None
+    if instance._state.db:
+        return instance._state.db
+    farmer_id = getattr(instance, 'farmer_id', None)
+    if farmer_id is not None:
+        return shard_for_farmer(farmer_id)
+    for name in ('device', 'sensor_data'):
+        related = instance._state.fields_cache.get(name)
+        if related is not None:
+            return instance_shard(related)
+    return None
+
+
+def group_by_database(instances):
+    """Split saved instances into (alias, instances) groups"""
+    key = lambda instance: instance._state.db or DEFAULT_DB_ALIAS
+    return [(alias, list(group)) for alias, group in groupby(sorted(instances, key=key), key=key)]
+
+
+def readings_by_shard(readings):
+    """Split new readings into (alias, readings) groups by their device's farmer"""
+    if not sharding_enabled():
+        return [(DEFAULT_DB_ALIAS, list(readings))] if readings else []
+    groups = {}
+    for reading in readings:
+        groups.setdefault(shard_for_farmer(reading.device.farmer_id), []).append(reading)
+    return list(groups.items())
+
+
+def load_devices(pks):
+    """Devices with farmer and user by primary key, from whichever shard holds them"""
+    if not sharding_enabled():
+        return Device.objects.using(DEFAULT_DB_ALIAS).select_related('farmer__user').in_bulk(pks)
+    by_shard = {}
+    entries = DeviceDirectory.objects.using(DEFAULT_DB_ALIAS).filter(device_pk__in=pks)
+    for device_pk, farmer_id in entries.values_list('device_pk', 'farmer_id'):
+        by_shard.setdefault(shard_for_farmer(farmer_id), []).append(device_pk)
+    devices = {}
+    for alias, group in by_shard.items():
+        devices.update(Device.objects.using(alias).select_related('farmer__user').in_bulk(group))
+    return devices
+
+
+def shard_id_range(alias):
+    number = shards()[alias]
+    return number * SHARD_ID_SPAN, (number + 1) * SHARD_ID_SPAN
+
+
+class ShardRouter:
+    """Send device data of each farmer to the farmer's shard"""
+
+    def _route(self, model, hints, for_write):
+        if not sharding_enabled() or not is_sharded(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None:
+            alias = instance_shard(instance)
+            if alias is not None:
+                return alias
+        return context_shard(for_write)
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints, for_write=False)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints, for_write=True)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Farmers and users are copied to their shard, device data never leaves it
+        if sharding_enabled() and obj1._state.db in shards() and obj2._state.db in shards():
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+class ShardRoutingMiddleware:
+    """Give each request its own shard context, resolved from the user when first needed"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _context.set({'shard': None, 'farmer_id': None, 'request': request})
+        try:
+            return self.get_response(request)
+        finally:
+            _context.reset(token)
+
+
+def replicate_farmer(farmer, alias):
+    """Copy a farmer and its user to a shard so relations resolve there"""
+    if alias == DEFAULT_DB_ALIAS:
+        return
+    user = User.objects.using(DEFAULT_DB_ALIAS).get(pk=farmer.user_id)
+    User._base_manager.using(alias).update_or_create(pk=user.pk, defaults={
+        'username': user.username, 'email': user.email, 'first_name': user.first_name,
+        'last_name': user.last_name, 'is_active': user.is_active, 'date_joined': user.date_joined,
+        # Shards never authenticate anyone
+        'password': make_password(None),
+    })
+    Farmer._base_manager.using(alias).update_or_create(pk=farmer.pk, defaults={
+        field.attname: getattr(farmer, field.attname)
+        for field in Farmer._meta.concrete_fields if not field.primary_key
+    })
+
+
+@receiver(post_save, sender=Farmer)
+def _farmer_saved(sender, instance, using, **kwargs):
+    forget_farmer(instance.pk)
+    if using == DEFAULT_DB_ALIAS and sharding_enabled():
+        replicate_farmer(instance, instance.shard or DEFAULT_DB_ALIAS)
+
+
+@receiver(post_save, sender=User)
+def _user_saved(sender, instance, using, **kwargs):
+    if using != DEFAULT_DB_ALIAS or not sharding_enabled():
+        return
+    farmer = Farmer.objects.using(DEFAULT_DB_ALIAS).filter(user_id=instance.pk).first()
+    if farmer is not None:
+        replicate_farmer(farmer, farmer.shard or DEFAULT_DB_ALIAS)
+
+
+@receiver(post_delete, sender=Farmer)
+def _farmer_deleted(sender, instance, using, **kwargs):
+    forget_farmer(instance.pk)
+    shard = instance.shard or DEFAULT_DB_ALIAS
+    if using == DEFAULT_DB_ALIAS and shard != DEFAULT_DB_ALIAS and shard in shards():
+        # Cascades to the farmer's devices and readings on the shard
+        User._base_manager.using(shard).filter(pk=instance.user_id).delete()
+
+
+@receiver(post_save, sender=Device)
+def _device_saved(sender, instance, created, **kwargs):
+    entry = (instance.__dict__.get('device_id'), instance.__dict__.get('farmer_id'))
+    # Only a new device, or a new device ID or farmer, changes the entry
+    if not created and entry == getattr(instance, '_directory_entry', None):
+        return
+    DeviceDirectory.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+        device_pk=instance.pk, defaults={'device_id': instance.device_id, 'farmer_id': instance.farmer_id}
+    )
+    instance._directory_entry = (instance.device_id, instance.farmer_id)
+
+
+@receiver(post_delete, sender=Device)
+def _device_deleted(sender, instance, using, **kwargs):
+    # Removing the old copy after a move must not drop the entry
+    if using != shard_for_farmer(instance.farmer_id):
+        return
+    DeviceDirectory.objects.using(DEFAULT_DB_ALIAS).filter(device_pk=instance.pk).delete()
+
+
+def register_devices(devices):
+    """Add directory entries for devices created with bulk_create"""
+    DeviceDirectory.objects.using(DEFAULT_DB_ALIAS).bulk_create([
+        DeviceDirectory(device_pk=device.pk, device_id=device.device_id, farmer_id=device.farmer_id)
+        for device in devices
+    ])
+
+
+def bulk_create_devices(devices, batch_size=500):
+    """Create devices on their farmers' shards with their directory entries, returning them"""
+    by_shard = {}
+    for device in devices:
+        by_shard.setdefault(shard_for_farmer(device.farmer_id), []).append(device)
+    created = []
+    for alias, group in by_shard.items():
+        with transaction.atomic(using=alias), transaction.atomic(using=DEFAULT_DB_ALIAS):
+            group = Device.objects.using(alias).bulk_create(group, batch_size=batch_size)
+            # bulk_create sends no post_save, so list the devices here
+            register_devices(group)
+        created += group
+    return created
+
+
+def reserve_id_range(alias):
+    """Make a shard allocate primary keys from its own range"""
+    start = shard_id_range(alias)[0]
+    if not start:
+        return
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        for model in SHARDED_MODELS:
+            table = model._meta.db_table
+            if connection.vendor == 'sqlite':
+                cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+                row = cursor.fetchone()
+                if row is None:
+                    cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, start - 1])
+                elif row[0] < start - 1:
+                    cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s", [start - 1, table])
+            elif connection.vendor == 'postgresql':
+                qn = connection.ops.quote_name
+                cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                    f"GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM {qn(table)})))",
+                    [table, start - 1],
+                )
+            elif connection.vendor == 'mysql':
+                # AUTO_INCREMENT is never lowered below existing rows
+                cursor.execute(f"ALTER TABLE {connection.ops.quote_name(table)} AUTO_INCREMENT = {int(start)}")
+
+
+@receiver(post_migrate)
+def _reserve_id_ranges(sender, using, **kwargs):
+    if sender.name == 'anttracker' and using in shards():
+        reserve_id_range(using)
+
+
+def farmer_rows(model, alias, farmer_id):
+    return model._base_manager.using(alias).filter(**{FARMER_LOOKUPS[model]: farmer_id})
+
+
+def id_ranges():
+    """Primary key ranges of the shards, widened to cover every pk: [(low or None, high or None), ...]"""
+    starts = sorted(shard_id_range(alias)[0] for alias in shards())
+    lows = [None] + starts[1:]
+    highs = starts[1:] + [None]
+    return list(zip(lows, highs))
+
+
+def copy_rows(model, farmer_id, source, target, after=None, id_range=None, batch_size=5000):
+    """Copy a farmer's rows with pk > after (within id_range) from source to target, skipping rows already there"""
+    rows = farmer_rows(model, source, farmer_id).order_by('pk')
+    if id_range is not None:
+        low, high = id_range
+        if low is not None:
+            rows = rows.filter(pk__gte=low)
+        if high is not None:
+            rows = rows.filter(pk__lt=high)
+    if after is not None:
+        rows = rows.filter(pk__gt=after)
+    copied, last = 0, None
+    while True:
+        batch = list((rows.filter(pk__gt=last) if last is not None else rows)[:batch_size])
+        if not batch:
+            return copied
+        model._base_manager.using(target).bulk_create(batch, ignore_conflicts=True)
+        copied += len(batch)
+        last = batch[-1].pk
+
+
+def sync_mutable_rows(model, farmer_id, source, target):
+    """Bring devices and rules, which change after creation, in line with the source"""
+    rows = list(farmer_rows(model, source, farmer_id))
+    fields = [f.name for f in model._meta.concrete_fields if not f.primary_key]
+    model._base_manager.using(target).bulk_update(rows, fields, batch_size=500)
+    farmer_rows(model, target, farmer_id).exclude(pk__in=[row.pk for row in rows]).delete()
+
+
+def _high_water_marks(farmer_id, source, ranges):
+    """Largest pk of the farmer's rows per model and ID range on the source
+
+    Rows copied in from other shards keep their pks, and some backends
+    allocate new pks above them, so a single mark over the source's own
+    range would either miss new rows or copy old ones on every pass.
+    """
+    marks = {}
+    for model in SHARDED_MODELS:
+        rows = farmer_rows(model, source, farmer_id)
+        aggregates = {}
+        for number, (low, high) in enumerate(ranges):
+            condition = Q()
+            if low is not None:
+                condition &= Q(pk__gte=low)
+            if high is not None:
+                condition &= Q(pk__lt=high)
+            aggregates[f'last_{number}'] = Max('pk', filter=condition)
+        last = rows.aggregate(**aggregates)
+        marks[model] = {id_range: last[f'last_{number}'] for number, id_range in enumerate(ranges)}
+    return marks
+
+
+def _copy_new_rows(farmer_id, source, target, after, ranges, batch_size):
+    """Copy rows above the previous marks in every ID range; returns the number copied"""
+    return sum(
+        copy_rows(model, farmer_id, source, target, after=after[model][id_range], id_range=id_range,
+                  batch_size=batch_size)
+        for model in SHARDED_MODELS for id_range in ranges
+    )
+
+
+def move_farmer(farmer, target, batch_size=5000, drain_seconds=None, max_passes=5, log=logger.info):
+    """Move a farmer's device data to another shard while it keeps reporting
+
+    Rows are copied in catch-up passes while the source stays live. Writes
+    are then paused for the farmer (ingest answers 503) until every process
+    has seen the pause, the last rows are copied, the shard map is switched
+    and, after every process has seen the switch, the source rows are removed.
+    """
+    source = farmer.shard or DEFAULT_DB_ALIAS
+    if target not in shards():
+        raise ValueError(f"Unknown shard '{target}'")
+    if target == source:
+        raise ValueError(f"Farmer {farmer.pk} is already on '{target}'")
+    drain = shard_map_ttl() + 1 if drain_seconds is None else drain_seconds
+
+    replicate_farmer(farmer, target)
+
+    # Online catch-up passes; ignore_conflicts makes re-copying harmless
+    ranges = id_ranges()
+    after = {model: dict.fromkeys(ranges) for model in SHARDED_MODELS}
+    for number in range(1, max_passes + 1):
+        marks = _high_water_marks(farmer.pk, source, ranges)
+        # The first pass copies everything, later ones only rows added since, per ID range
+        copied = _copy_new_rows(farmer.pk, source, target, after, ranges, batch_size)
+        after = {
+            model: {id_range: marks[model][id_range] if marks[model][id_range] is not None
+                    else after[model][id_range] for id_range in ranges}
+            for model in SHARDED_MODELS
+        }
+        log(f"Pass {number}: copied {copied} row(s)")
+        if copied < batch_size:
+            break
+
+    # Cutover: pause writes until every process has noticed, then copy the rest
+    Farmer.objects.using(DEFAULT_DB_ALIAS).filter(pk=farmer.pk).update(shard_moving=True)
+    forget_farmer(farmer.pk)
+    log(f"Writes paused; waiting {drain}s for in-flight writes to land")
+    time.sleep(drain)
+    copied = _copy_new_rows(farmer.pk, source, target, after, ranges, batch_size)
+    for model in (Device, AlertRule):
+        sync_mutable_rows(model, farmer.pk, source, target)
+    log(f"Final pass: copied {copied} row(s)")
+
+    Farmer.objects.using(DEFAULT_DB_ALIAS).filter(pk=farmer.pk).update(shard=target, shard_moving=False)
+    farmer.shard, farmer.shard_moving = target, False
+    forget_farmer(farmer.pk)
+    replicate_farmer(farmer, target)
+    log(f"Switched to '{target}'; waiting {drain}s before removing rows from '{source}'")
+    time.sleep(drain)
+
+    # Remove the source copy, children first so deletes never cascade
+    for model in reversed(SHARDED_MODELS):
+        while True:
+            pks = list(farmer_rows(model, source, farmer.pk).values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            with transaction.atomic(using=source):
+                model._base_manager.using(source).filter(pk__in=pks).delete()
+    if source != DEFAULT_DB_ALIAS:
+        User._base_manager.using(source).filter(pk=farmer.user_id).delete()
+    log(f"Removed farmer {farmer.pk} from '{source}'")
@@ -0,0 +1,532 @@
+let authToken = localStorage.getItem('authToken');
+let farmerData = null;
+let currentDateFilter = null;
+let antChart = null;
+let envChart = null;
+// Readings currently shown, newest first; refreshes only fetch newer ones
+let chartData = [];
+let tableData = [];
+const CHART_READINGS = 100;  // Readings sent by /api/dashboard/
+const TABLE_ROWS = 20;  // Page size of /api/sensor-data/
+
+// Check authentication
+if (!authToken) {
+    window.location.href = '/login.html';
+}
+
+// Initialize dashboard
+document.addEventListener('DOMContentLoaded', function() {
+    // The page embeds the initial profile, summary and readings
+    const bootstrap = document.getElementById('dashboard-bootstrap');
+    if (bootstrap) {
+        const state = JSON.parse(bootstrap.textContent);
+        showFarmerProfile(state.profile);
+        showDashboardData(state.dashboard, false);
+        showSensorData(state.sensor_data, false);
+    } else {
+        loadFarmerProfile();
+        loadDashboardData();
+        loadSensorData();
+    }
+    setDefaultDate();
+});
+
+function mergeReadings(newer, older, limit) {
+    const ids = new Set(newer.map(item => item.id));
+    return newer.concat(older.filter(item => !ids.has(item.id))).slice(0, limit);
+}
+
+function setDefaultDate() {
+    // Set today's date as default
+    const today = new Date().toISOString().split('T')[0];
+    document.getElementById('dateFilter').value = today;
+}
+
+async function loadFarmerProfile() {
+    try {
+        const response = await fetch('/api/profile/', {
+            headers: {
+                'Authorization': `Token ${authToken}`,
+                'Content-Type': 'application/json'
+            }
+        });
+
+        if (response.ok) {
+            showFarmerProfile(await response.json());
+        } else {
+            console.error('Failed to load farmer profile');
+        }
+    } catch (error) {
+        console.error('Error loading farmer profile:', error);
+    }
+}
+
+function showFarmerProfile(profile) {
+    farmerData = profile;
+    document.getElementById('farmer-name').textContent = farmerData.user.first_name || farmerData.user.username;
+}
+
+async function loadDashboardData(delta = false) {
+    try {
+        let url = '/api/dashboard/';
+        // Without a date filter only readings newer than those shown are fetched
+        const since = delta && !currentDateFilter && chartData.length ? chartData[0].timestamp : null;
+
+        // Add date filter if selected
+        if (currentDateFilter) {
+            url += `?start_date=${currentDateFilter}&end_date=${currentDateFilter}`;
+        } else if (since) {
+            url += `?since=${encodeURIComponent(since)}`;
+        }
+
+        const response = await fetch(url, {
+            headers: {
+                'Authorization': `Token ${authToken}`,
+                'Content-Type': 'application/json'
+            }
+        });
+
+        if (response.ok) {
+            showDashboardData(await response.json(), Boolean(since));
+        } else {
+            console.error('Failed to load dashboard data');
+        }
+    } catch (error) {
+        console.error('Error loading dashboard data:', error);
+    }
+}
+
+function showDashboardData(data, delta) {
+    chartData = delta ? mergeReadings(data.sensor_data, chartData, CHART_READINGS) : data.sensor_data;
+    updateSummaryCards(data.summary);
+    updateCharts(chartData);
+}
+
+function updateSummaryCards(summary) {
+    document.getElementById('total-devices').textContent = summary.total_devices;
+    document.getElementById('active-devices').textContent = summary.active_devices;
+    document.getElementById('recent-alerts').textContent = summary.recent_alerts;
+
+    // Use server-calculated average temperature
+    document.getElementById('avg-temperature').textContent = summary.avg_temperature + '°C';
+
+    // Add additional metrics if available
+    if (summary.avg_humidity !== undefined) {
+        document.getElementById('avg-humidity').textContent = summary.avg_humidity + '%';
+    }
+
+    if (summary.max_ant_count !== undefined) {
+        document.getElementById('max-ant-count').textContent = summary.max_ant_count;
+    }
+
+    // Calculate total readings and last update
+    const totalReadings = summary.sensor_data ? summary.sensor_data.length : 0;
+    document.getElementById('total-readings').textContent = totalReadings;
+
+    // Get last update time
+    if (summary.latest_data && Object.keys(summary.latest_data).length > 0) {
+        const latestDevice = Object.values(summary.latest_data)[0];
+        const lastUpdate = new Date(latestDevice.timestamp);
+        const timeAgo = getTimeAgo(lastUpdate);
+        document.getElementById('last-update').textContent = timeAgo;
+    } else {
+        document.getElementById('last-update').textContent = 'No data';
+    }
+}
+
+function getTimeAgo(date) {
+    const now = new Date();
+    const diffInSeconds = Math.floor((now - date) / 1000);
+
+    if (diffInSeconds < 60) {
+        return diffInSeconds + 's ago';
+    } else if (diffInSeconds < 3600) {
+        const minutes = Math.floor(diffInSeconds / 60);
+        return minutes + 'm ago';
+    } else if (diffInSeconds < 86400) {
+        const hours = Math.floor(diffInSeconds / 3600);
+        return hours + 'h ago';
+    } else {
+        const days = Math.floor(diffInSeconds / 86400);
+        return days + 'd ago';
+    }
+}
+
+function updateCharts(sensorData) {
+    if (!sensorData || sensorData.length === 0) {
+        console.log('No sensor data available for charts');
+        // Show a message in the chart areas
+        const antCtx = document.getElementById('antChart').getContext('2d');
+        const envCtx = document.getElementById('envChart').getContext('2d');
+        antCtx.clearRect(0, 0, 800, 400);
+        envCtx.clearRect(0, 0, 800, 400);
+
+        // Draw "No Data" message
+        antCtx.fillStyle = '#666';
+        antCtx.font = '16px Arial';
+        antCtx.textAlign = 'center';
+        antCtx.fillText('No sensor data available', 400, 200);
+
+        envCtx.fillStyle = '#666';
+        envCtx.font = '16px Arial';
+        envCtx.textAlign = 'center';
+        envCtx.fillText('No sensor data available', 400, 200);
+        return;
+    }
+
+    // Use all available data for scrollable charts, but limit to reasonable amount for performance
+    const maxDataPoints = 200;
+    const chartData = sensorData.slice(0, maxDataPoints).reverse(); // Most recent data first
+    const labels = chartData.map(data => {
+        const date = new Date(data.timestamp);
+        // Show time only for 24-hour view, date+time for filtered view
+        if (currentDateFilter) {
+            return date.toLocaleDateString() + ' ' + date.toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
+        } else {
+            return date.toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
+        }
+    });
+
+    const antCounts = chartData.map(data => data.ant_count);
+    const temperatures = chartData.map(data => data.temperature);
+    const humidities = chartData.map(data => data.humidity);
+
+    console.log('Chart data:', {
+        dataPoints: labels.length,
+        timeRange: currentDateFilter ? 'Filtered date' : 'Last 24 hours',
+        antCounts: antCounts.slice(0, 5),
+        temperatures: temperatures.slice(0, 5),
+        humidities: humidities.slice(0, 5)
+    });
+
+    // Destroy existing charts if they exist
+    if (antChart) {
+        antChart.destroy();
+    }
+    if (envChart) {
+        envChart.destroy();
+    }
+
+    // Ant Count Chart
+    const antCtx = document.getElementById('antChart').getContext('2d');
+    antChart = new Chart(antCtx, {
+        type: 'line',
+        data: {
+            labels: labels,
+            datasets: [{
+                label: 'Ant Count',
+                data: antCounts,
+                borderColor: '#dc3545',
+                backgroundColor: 'rgba(220, 53, 69, 0.1)',
+                tension: 0.4,
+                fill: true
+            }]
+        },
+        options: {
+            responsive: true,
+            maintainAspectRatio: false,
+            interaction: {
+                intersect: false,
+                mode: 'index'
+            },
+            plugins: {
+                legend: {
+                    display: true,
+                    position: 'top',
+                    labels: {
+                        font: {
+                            size: 14,
+                            weight: 'bold'
+                        }
+                    }
+                },
+                title: {
+                    display: true,
+                    text: currentDateFilter ? 'Ant Activity - ' + currentDateFilter : 'Ant Activity - Last 24 Hours',
+                    font: {
+                        size: 16,
+                        weight: 'bold'
+                    }
+                },
+                tooltip: {
+                    mode: 'index',
+                    intersect: false
+                }
+            },
+            scales: {
+                y: {
+                    beginAtZero: true,
+                    title: {
+                        display: true,
+                        text: 'Ant Count',
+                        font: {
+                            size: 12,
+                            weight: 'bold'
+                        }
+                    },
+                    grid: {
+                        color: 'rgba(0,0,0,0.1)'
+                    }
+                },
+                x: {
+                    title: {
+                        display: true,
+                        text: currentDateFilter ? 'Date & Time' : 'Time (Last 24 Hours)',
+                        font: {
+                            size: 12,
+                            weight: 'bold'
+                        }
+                    },
+                    grid: {
+                        color: 'rgba(0,0,0,0.1)'
+                    },
+                    ticks: {
+                        maxTicksLimit: 10
+                    }
+                }
+            },
+            elements: {
+                point: {
+                    radius: 2,
+                    hoverRadius: 6
+                },
+                line: {
+                    tension: 0.1
+                }
+            }
+        }
+    });
+
+    // Environmental Chart
+    const envCtx = document.getElementById('envChart').getContext('2d');
+    envChart = new Chart(envCtx, {
+        type: 'line',
+        data: {
+            labels: labels,
+            datasets: [{
+                label: 'Temperature (°C)',
+                data: temperatures,
+                borderColor: '#fd7e14',
+                backgroundColor: 'rgba(253, 126, 20, 0.1)',
+                tension: 0.4,
+                fill: false,
+                yAxisID: 'y'
+            }, {
+                label: 'Humidity (%)',
+                data: humidities,
+                borderColor: '#17a2b8',
+                backgroundColor: 'rgba(23, 162, 184, 0.1)',
+                tension: 0.4,
+                fill: false,
+                yAxisID: 'y1'
+            }]
+        },
+        options: {
+            responsive: true,
+            maintainAspectRatio: false,
+            interaction: {
+                intersect: false,
+                mode: 'index'
+            },
+            plugins: {
+                legend: {
+                    display: true,
+                    position: 'top',
+                    labels: {
+                        font: {
+                            size: 14,
+                            weight: 'bold'
+                        }
+                    }
+                },
+                title: {
+                    display: true,
+                    text: currentDateFilter ? 'Environmental Conditions - ' + currentDateFilter : 'Environmental Conditions - Last 24 Hours',
+                    font: {
+                        size: 16,
+                        weight: 'bold'
+                    }
+                },
+                tooltip: {
+                    mode: 'index',
+                    intersect: false
+                }
+            },
+            scales: {
+                y: {
+                    type: 'linear',
+                    display: true,
+                    position: 'left',
+                    title: {
+                        display: true,
+                        text: 'Temperature (°C)',
+                        font: {
+                            size: 12,
+                            weight: 'bold'
+                        }
+                    },
+                    grid: {
+                        color: 'rgba(0,0,0,0.1)'
+                    }
+                },
+                y1: {
+                    type: 'linear',
+                    display: true,
+                    position: 'right',
+                    title: {
+                        display: true,
+                        text: 'Humidity (%)',
+                        font: {
+                            size: 12,
+                            weight: 'bold'
+                        }
+                    },
+                    grid: {
+                        drawOnChartArea: false,
+                        color: 'rgba(0,0,0,0.1)'
+                    },
+                },
+                x: {
+                    title: {
+                        display: true,
+                        text: currentDateFilter ? 'Date & Time' : 'Time (Last 24 Hours)',
+                        font: {
+                            size: 12,
+                            weight: 'bold'
+                        }
+                    },
+                    grid: {
+                        color: 'rgba(0,0,0,0.1)'
+                    },
+                    ticks: {
+                        maxTicksLimit: 10
+                    }
+                }
+            },
+            elements: {
+                point: {
+                    radius: 2,
+                    hoverRadius: 5
+                },
+                line: {
+                    tension: 0.1
+                }
+            }
+        }
+    });
+}
+
+async function loadSensorData(delta = false) {
+    try {
+        let url = '/api/sensor-data/?limit=50';
+        const since = delta && !currentDateFilter && tableData.length ? tableData[0].timestamp : null;
+
+        // Add date filter if selected
+        if (currentDateFilter) {
+            url += `&start_date=${currentDateFilter}&end_date=${currentDateFilter}`;
+        } else if (since) {
+            url += `&since=${encodeURIComponent(since)}`;
+        }
+
+        const response = await fetch(url, {
+            headers: {
+                'Authorization': `Token ${authToken}`,
+                'Content-Type': 'application/json'
+            }
+        });
+
+        if (response.ok) {
+            const data = await response.json();
+            showSensorData(data.results || data, Boolean(since));
+        } else {
+            console.error('Failed to load sensor data');
+        }
+    } catch (error) {
+        console.error('Error loading sensor data:', error);
+    }
+}
+
+function filterByDate() {
+    const selectedDate = document.getElementById('dateFilter').value;
+    if (selectedDate) {
+        currentDateFilter = selectedDate;
+        document.getElementById('dateFilterStatus').textContent = `Showing: ${selectedDate}`;
+        document.getElementById('dateFilterStatus').className = 'badge bg-success me-2';
+    } else {
+        clearDateFilter();
+    }
+    loadSensorData();
+    loadDashboardData();
+}
+
+function clearDateFilter() {
+    currentDateFilter = null;
+    document.getElementById('dateFilter').value = '';
+    document.getElementById('dateFilterStatus').textContent = 'Showing: Last 24 hours';
+    document.getElementById('dateFilterStatus').className = 'badge bg-info me-2';
+    loadSensorData();
+    loadDashboardData();
+}
+
+function showSensorData(data, delta) {
+    tableData = delta ? mergeReadings(data, tableData, TABLE_ROWS) : data;
+    updateSensorDataTable(tableData);
+}
+
+function updateSensorDataTable(data) {
+    const tbody = document.getElementById('sensor-data-table');
+    const dataCount = document.getElementById('dataCount');
+
+    // Update data count
+    dataCount.textContent = `${data.length} records`;
+
+    if (data.length === 0) {
+        const message = currentDateFilter 
+            ? `No sensor data available for ${currentDateFilter}`
+            : 'No sensor data available';
+        tbody.innerHTML = `<tr><td colspan="8" class="text-center">${message}</td></tr>`;
+        return;
+    }
+
+    tbody.innerHTML = data.map(item => `
+        <tr>
+            <td>${item.device_name}</td>
+            <td>${new Date(item.timestamp).toLocaleString()}</td>
+            <td>${item.temperature}°C</td>
+            <td>${item.humidity}%</td>
+            <td>
+                <span class="badge ${item.ant_count > 50 ? 'bg-danger' : 'bg-success'}">
+                    ${item.ant_count}
+                </span>
+            </td>
+            <td>${item.mealy_bugs_count}</td>
+            <td>
+                <span class="badge ${item.is_rainfall ? 'bg-info' : 'bg-secondary'}">
+                    ${item.is_rainfall ? 'Yes' : 'No'}
+                </span>
+            </td>
+            <td>
+                <span class="badge ${item.is_irrigation ? 'bg-primary' : 'bg-secondary'}">
+                    ${item.is_irrigation ? 'Yes' : 'No'}
+                </span>
+            </td>
+        </tr>
+    `).join('');
+}
+
+function refreshData() {
+    loadDashboardData(true);
+    loadSensorData(true);
+}
+
+function logout() {
+    // Clear client-side token first
+    localStorage.removeItem('authToken');
+
+    // Use GET request to logout endpoint to properly clear server session
+    // This will work with the existing session cookie
+    window.location.href = '/logout/';
+}
+
+// Auto-refresh every 5 minutes
+setInterval(refreshData, 5 * 60 * 1000);
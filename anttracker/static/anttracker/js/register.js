@@ -0,0 +1,82 @@
+document.getElementById('registerForm').addEventListener('submit', async function(e) {
+    e.preventDefault();
+
+    const formData = {
+        username: document.getElementById('username').value,
+        email: document.getElementById('email').value,
+        password: document.getElementById('password').value,
+        password_confirm: document.getElementById('password_confirm').value,
+        farm_name: document.getElementById('farm_name').value,
+        farm_location: document.getElementById('farm_location').value,
+        phone_number: document.getElementById('phone_number').value,
+        ant_threshold_limit: parseInt(document.getElementById('ant_threshold_limit').value) || 50
+    };
+
+    // Validate passwords match
+    if (formData.password !== formData.password_confirm) {
+        showAlert('Passwords do not match', 'danger');
+        return;
+    }
+
+    try {
+        const response = await fetch('/api/register/', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(formData)
+        });
+
+        const data = await response.json();
+
+        if (response.ok) {
+            localStorage.setItem('authToken', data.token);
+            showAlert('Registration successful! Redirecting to dashboard...', 'success');
+            setTimeout(() => {
+                window.location.href = '/dashboard.html';
+            }, 2000);
+        } else {
+            // Handle validation errors
+            if (data.username) {
+                showAlert(`Username: ${data.username[0]}`, 'danger');
+            } else if (data.email) {
+                showAlert(`Email: ${data.email[0]}`, 'danger');
+            } else if (data.password) {
+                showAlert(`Password: ${data.password[0]}`, 'danger');
+            } else if (data.non_field_errors) {
+                showAlert(data.non_field_errors[0], 'danger');
+            } else {
+                showAlert('Registration failed. Please check your information.', 'danger');
+            }
+        }
+    } catch (error) {
+        showAlert('Network error. Please try again.', 'danger');
+        console.error('Registration error:', error);
+    }
+});
+
+function showAlert(message, type) {
+    const alertContainer = document.getElementById('alert-container');
+    alertContainer.innerHTML = `
+        <div class="alert alert-${type} alert-dismissible fade show" role="alert">
+            ${message}
+            <button type="button" class="btn-close" data-bs-dismiss="alert"></button>
+        </div>
+    `;
+}
+
+function showLogin() {
+    window.location.href = '/login.html';
+}
+
+// Password confirmation validation
+document.getElementById('password_confirm').addEventListener('input', function() {
+    const password = document.getElementById('password').value;
+    const confirmPassword = this.value;
+
+    if (confirmPassword && password !== confirmPassword) {
+        this.setCustomValidity('Passwords do not match');
+    } else {
+        this.setCustomValidity('');
+    }
+});
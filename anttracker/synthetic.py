@@ -0,0 +1,206 @@
+"""
+Synthetic sensor data for benchmarks and capacity planning.
+
+Series are generated per device with numpy (diurnal and seasonal
+temperature, rain events driving humidity and soil moisture, ant outbreaks
+that flare up and fade) and loaded with multi-row inserts, or COPY on
+PostgreSQL, bypassing ``SensorData.save`` so no alert rules run and no
+email is sent. Each device's readings go to the database the device is on.
+"""
+import csv
+import io
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from .models import Device, SensorData, AlertLog
+from .sharding import group_by_database
+
+
+READING_COLUMNS = (
+    'device_id', 'timestamp', 'temperature', 'humidity', 'moisture', 'ant_count',
+    'mealy_bugs_count', 'is_rainfall', 'is_irrigation', 'ml_confidence', 'created_at',
+)
+
+
+def generate_device_series(rng, start, periods, interval_seconds):
+    """Return a dict of column arrays for one device's correlated readings"""
+    offsets = np.arange(periods, dtype=np.int64) * interval_seconds
+    hours = ((start.hour * 3600 + start.minute * 60 + offsets) / 3600.0) % 24
+    days = (start.timetuple().tm_yday + offsets / 86400.0) % 365
+
+    # Temperature: seasonal swing plus a daily cycle peaking mid-afternoon
+    base = rng.uniform(18, 26)
+    temperature = (
+        base
+        + 6 * np.sin(2 * np.pi * (days - 80) / 365)
+        + 5 * np.sin(2 * np.pi * (hours - 9) / 24)
+        + rng.normal(0, 0.6, periods)
+    )
+
+    # Rain: events start as a Poisson process and last a few hours
+    steps_per_hour = max(1, 3600 // interval_seconds)
+    rain_starts = rng.random(periods) < (1 / (72 * steps_per_hour))
+    rain_length = int(4 * steps_per_hour)
+    is_rainfall = np.convolve(rain_starts.astype(np.int8), np.ones(rain_length, dtype=np.int8))[:periods] > 0
+    temperature -= is_rainfall * 3
+
+    humidity = np.clip(
+        70 - 1.5 * (temperature - base) + is_rainfall * 12 + rng.normal(0, 4, periods), 5, 100
+    )
+
+    # Irrigation early in the morning on dry days
+    is_irrigation = (~is_rainfall) & (hours >= 5) & (hours < 6) & (rng.random(periods) < 0.6)
+
+    # Soil moisture: wetted by rain/irrigation, exponential drying otherwise
+    wetting = is_rainfall * 2.0 + is_irrigation * 4.0
+    decay = 0.995 ** (interval_seconds / 600)
+    moisture = _exponential_filter(wetting, decay, initial=35.0) + 20
+    moisture = np.clip(moisture + rng.normal(0, 1, periods), 0, 100)
+
+    # Ants: warm-weather baseline plus occasional outbreaks that flare up and fade
+    warmth = np.clip(temperature - 15, 0, None)
+    outbreak_starts = rng.random(periods) < (1 / (14 * 24 * steps_per_hour))
+    outbreak = _exponential_filter(outbreak_starts * 60.0, 0.999 ** (interval_seconds / 60), initial=0.0)
+    ant_count = rng.poisson(1 + warmth * 0.8 + outbreak * (1 - is_rainfall * 0.7))
+    mealy_bugs_count = rng.poisson(0.5 + np.clip(humidity - 60, 0, None) * 0.08 + outbreak * 0.1)
+
+    timestamps = np.datetime64(start.astimezone(dt_timezone.utc).replace(tzinfo=None), 'us') + offsets.astype('timedelta64[s]')
+    return {
+        'timestamp': timestamps,
+        'temperature': np.round(temperature, 1),
+        'humidity': np.round(humidity, 1),
+        'moisture': np.round(moisture, 1),
+        'ant_count': ant_count,
+        'mealy_bugs_count': mealy_bugs_count,
+        'is_rainfall': is_rainfall,
+        'is_irrigation': is_irrigation,
+        'ml_confidence': np.round(rng.uniform(0.55, 0.99, periods), 3),
+    }
+
+
+def _exponential_filter(impulses, decay, initial):
+    """y[t] = decay * y[t-1] + impulses[t], vectorised with cumulative sums per block"""
+    n = len(impulses)
+    result = np.empty(n)
+    # Keep decay ** -block well inside float64 range
+    block = int(min(4096, max(1, 200 / -np.log(decay)))) if decay < 1 else 4096
+    powers = decay ** np.arange(block, dtype=np.float64)
+    level = initial
+    for start in range(0, n, block):
+        chunk = impulses[start:start + block]
+        p = powers[:len(chunk)]
+        values = p * (decay * level + np.cumsum(chunk / p))
+        result[start:start + len(chunk)] = values
+        level = values[-1]
+    return result
+
+
+def _format_timestamps(timestamps, connection):
+    """Render datetime64 values the way the connection's backend stores them"""
+    text = np.datetime_as_string(timestamps, unit='us')
+    text = np.char.replace(text, 'T', ' ')
+    if connection.vendor == 'postgresql':
+        text = np.char.add(text, '+00:00')
+    return text
+
+
+def bulk_load_readings(device_pk, series, batch_size=50_000, using=DEFAULT_DB_ALIAS):
+    """Insert one device's generated series without touching the ORM per row"""
+    connection = connections[using]
+    count = len(series['timestamp'])
+    if connection.vendor in ('sqlite', 'postgresql'):
+        timestamps = _format_timestamps(series['timestamp'], connection)
+    else:
+        timestamps = np.array([
+            datetime.fromisoformat(str(t)).replace(tzinfo=dt_timezone.utc)
+            for t in series['timestamp']
+        ], dtype=object)
+
+    columns = [
+        np.full(count, device_pk),
+        timestamps,
+        series['temperature'],
+        series['humidity'],
+        series['moisture'],
+        series['ant_count'],
+        series['mealy_bugs_count'],
+        series['is_rainfall'],
+        series['is_irrigation'],
+        series['ml_confidence'],
+        timestamps,
+    ]
+    table = connection.ops.quote_name(SensorData._meta.db_table)
+    names = ', '.join(
+        connection.ops.quote_name(SensorData._meta.get_field(name).column) for name in READING_COLUMNS
+    )
+
+    with connection.cursor() as cursor:
+        for start in range(0, count, batch_size):
+            rows = list(zip(*(column[start:start + batch_size].tolist() for column in columns)))
+            if connection.vendor == 'postgresql':
+                _copy_rows(cursor, table, names, rows)
+            else:
+                placeholders = ', '.join(['%s'] * len(READING_COLUMNS))
+                cursor.executemany(f'INSERT INTO {table} ({names}) VALUES ({placeholders})', rows)
+    return count
+
+
+def _copy_rows(cursor, table, names, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    raw = cursor.cursor
+    sql = f'COPY {table} ({names}) FROM STDIN WITH (FORMAT csv)'
+    if hasattr(raw, 'copy_expert'):
+        raw.copy_expert(sql, buffer)
+    else:
+        with raw.copy(sql) as copy:
+            copy.write(buffer.getvalue())
+
+
+def insert_threshold_alert_logs(devices, using=DEFAULT_DB_ALIAS):
+    """Record ant threshold AlertLogs for generated readings with one INSERT ... SELECT"""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    alert_table = qn(AlertLog._meta.db_table)
+    reading_table = qn(SensorData._meta.db_table)
+    device_table = qn(Device._meta.db_table)
+    farmer_table = qn(Device._meta.get_field('farmer').related_model._meta.db_table)
+    device_ids = [device.pk for device in devices]
+    if not device_ids:
+        return 0
+    placeholders = ', '.join(['%s'] * len(device_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {alert_table} (device_id, sensor_data_id, alert_type, message, sent_at, sent_to, reevaluated) "
+            f"SELECT r.device_id, r.id, 'ant_threshold', 'Synthetic ant threshold alert', r.{qn('timestamp')}, '', %s "
+            f"FROM {reading_table} r "
+            f"JOIN {device_table} d ON d.id = r.device_id "
+            f"JOIN {farmer_table} f ON f.id = d.farmer_id "
+            f"WHERE r.device_id IN ({placeholders}) AND r.ant_count > f.ant_threshold_limit",
+            [False, *device_ids],
+        )
+        return cursor.rowcount
+
+
+def populate_devices(devices, start, end, interval_seconds, seed=None, alert_logs=False, progress=None):
+    """Generate and load readings for every device between start and end"""
+    rng = np.random.default_rng(seed)
+    periods = int((end - start).total_seconds() // interval_seconds)
+    total = 0
+    last_seen = start + timedelta(seconds=interval_seconds * (periods - 1)) if periods else None
+    for alias, group in group_by_database(devices):
+        with transaction.atomic(using=alias):
+            for device in group:
+                series = generate_device_series(rng, start, periods, interval_seconds)
+                total += bulk_load_readings(device.pk, series, using=alias)
+                if progress:
+                    progress(device, total)
+            Device.objects.using(alias).filter(pk__in=[d.pk for d in group]).update(
+                last_seen=last_seen, health_state=Device.HEALTH_ONLINE
+            )
+            if alert_logs:
+                insert_threshold_alert_logs(group, using=alias)
+    return total
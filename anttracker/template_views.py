@@ -5,6 +5,11 @@ from django.contrib import messages
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
+from django.utils import timezone
+from rest_framework.settings import api_settings
+
+from .dashboard import dashboard_payload, profile_payload, sensor_data_page
+from .db_routers import read_from_replica
 
 
 def login_page(request):
@@ -41,11 +46,21 @@ def dashboard_page(request):
     try:
         # Check if user has a farmer profile
         farmer = request.user.farmer
-        return render(request, 'anttracker/dashboard.html', {'farmer': farmer})
     except:
         # If user doesn't have farmer profile, redirect to register
         messages.error(request, 'Please complete your farmer profile registration.')
         return redirect('register-page')
+    
+    # Embed what the page would otherwise fetch from /api/profile/, /api/dashboard/
+    # and /api/sensor-data/, so the first chart needs no API round trip
+    read_from_replica(request)
+    bootstrap = {
+        'generated_at': timezone.now(),
+        'profile': profile_payload(farmer),
+        'dashboard': dashboard_payload(farmer),
+        'sensor_data': sensor_data_page(farmer, api_settings.PAGE_SIZE),
+    }
+    return render(request, 'anttracker/dashboard.html', {'farmer': farmer, 'bootstrap': bootstrap})
 
 
 @csrf_exempt
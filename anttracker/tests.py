@@ -1,3 +1,1251 @@
-from django.test import TestCase
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connections, transaction
+from django.db.models import Q
+from django.http import HttpResponse
+from django.test import LiveServerTestCase, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from . import ml_api
+from .aggregates import regional_summary, rollup
+from .authentication import _token_key, _user_key
+from .idempotency import _high_water
+from .ingest import WriteBehindBuffer
+from .management.commands.benchmark_endpoints import Command as BenchmarkEndpoints
+from .compression import CompressionMiddleware
+from .db_routers import ReplicaRouter
+from .heartbeat import DEVICE_OFFLINE_ALERT, DEVICE_ONLINE_ALERT, check_device_health, record_heartbeat
+from .metrics import REQUEST_QUERIES, MetricsMiddleware
+from .models import AlertLog, AlertReevaluation, AlertRule, CompactSensorData, Device, DeviceDirectory, Farmer, SensorData
+from .reevaluation import plan_chunks, reevaluate_chunk, run_job, schedule_reevaluation
+from .renderers import msgpack
+from .sharding import forget_farmer, move_farmer, reserve_id_range, shard_id_range, using_shard
+from .synthetic import populate_devices
+from .throttling import IN_FLIGHT_KEY, TokenBucketThrottle
+
+
+def create_farmer(username='farmer', **kwargs):
+    user = User.objects.create_user(username, f'{username}@example.com', 'pw-12345678')
+    return Farmer.objects.create(user=user, **kwargs)
+
+
+def create_device(farmer, device_id='pi-1', api_key='key-1', **kwargs):
+    return Device.objects.create(
+        farmer=farmer, device_id=device_id, device_name=device_id.upper(), api_key=api_key, **kwargs
+    )
+
+
+def has_databases(*aliases):
+    return skipUnless(set(aliases) <= set(settings.DATABASES),
+                      f"needs the {', '.join(aliases)} database(s) of MonitorMyBug.test_settings")
+
+
+def configured(*aliases):
+    """The aliases that exist, for the databases of tests skipped without them"""
+    return {'default', *aliases} & set(settings.DATABASES)
+
+
+def reading(ant_count=0, mealy_bugs_count=0, **kwargs):
+    return {'temperature': 21.5, 'humidity': 60.0, 'ant_count': ant_count,
+            'mealy_bugs_count': mealy_bugs_count, **kwargs}
+
+
+class AlertRuleStreakTests(TestCase):
+    """Rules over consecutive readings must see readings stored by earlier requests"""
+
+    def setUp(self):
+        cache.clear()
+        self.farmer = create_farmer(ant_threshold_limit=1000)
+        self.device = create_device(self.farmer)
+        AlertRule.objects.create(
+            farmer=self.farmer, name='Ants rising', alert_type='ants_streak', consecutive_readings=3,
+            conditions=[{'field': 'ant_count', 'op': 'gt', 'value': 5}],
+        )
+
+    def submit(self, payload):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/api/device-data/{self.device.device_id}/', payload,
+                                    content_type='application/json', HTTP_AUTHORIZATION='key-1')
+
+    def streak_alerts(self):
+        return AlertLog.objects.filter(alert_type='ants_streak').count()
+
+    def test_streak_spans_requests_without_cache(self):
+        for ants in (6, 7, 8):
+            # Every request may land on a different worker with an empty cache
+            cache.clear()
+            self.assertEqual(self.submit(reading(ants)).status_code, 201)
+        self.assertEqual(self.streak_alerts(), 1)
+
+    def test_streak_fires_once_per_run(self):
+        self.submit([reading(6), reading(7), reading(8), reading(9)])
+        self.submit(reading(10))
+        self.assertEqual(self.streak_alerts(), 1)
+        self.submit([reading(0), reading(6), reading(6)])
+        self.assertEqual(self.streak_alerts(), 1)
+        self.submit(reading(6))
+        self.assertEqual(self.streak_alerts(), 2)
+
+    def test_streak_uses_reading_order(self):
+        now = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            for minutes, ants in ((30, 6), (20, 0), (10, 7)):
+                SensorData.objects.create(device=self.device, timestamp=now - timedelta(minutes=minutes),
+                                          temperature=20, humidity=50, ant_count=ants)
+            SensorData.objects.create(device=self.device, timestamp=now, temperature=20, humidity=50, ant_count=8)
+        self.assertEqual(self.streak_alerts(), 0)
+
+
+class WriteBehindBufferTests(TestCase):
+    def setUp(self):
+        self.device = create_device(create_farmer())
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.base = os.path.join(self.directory.name, 'ingest.spool')
+
+    def row(self, **kwargs):
+        return SensorData(device=self.device, **{'temperature': 20.0, 'humidity': 50.0, **kwargs})
+
+    def spooled(self):
+        """Records in every spool file of the base path except the dead-letter file"""
+        records = []
+        for name in sorted(os.listdir(self.directory.name)):
+            if not name.endswith(('.lock', '.dead')):
+                with open(os.path.join(self.directory.name, name)) as spool:
+                    records += [json.loads(line) for line in spool if line.strip()]
+        return records
+
+    def test_poison_row_is_dead_lettered(self):
+        buffer = WriteBehindBuffer(spool_path=self.base, max_attempts=3)
+        buffer.submit([self.row(ant_count=1), self.row(temperature=None), self.row(ant_count=2)])
+        with self.assertLogs('anttracker.ingest', 'ERROR'):
+            self.assertEqual(buffer.flush(), 2)
+            # Only the failing row stays spooled for the next attempt
+            self.assertEqual(len(buffer), 1)
+            self.assertEqual([r['temperature'] for r in self.spooled()], [None])
+            buffer.flush()
+            buffer.flush()
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(buffer.stats['dead_lettered'], 1)
+        self.assertEqual(self.spooled(), [])
+        with open(f'{self.base}.dead') as dead:
+            self.assertIn('IntegrityError', json.loads(dead.readline())['error'])
+        self.assertEqual(SensorData.objects.filter(device=self.device).count(), 2)
+
+    def test_failed_flush_keeps_rows(self):
+        buffer = WriteBehindBuffer(spool_path=self.base)
+        buffer.submit([self.row(ant_count=1), self.row(ant_count=2)])
+        with mock.patch('anttracker.ingest.readings_by_shard', side_effect=OperationalError('gone')), \
+                self.assertLogs('anttracker.ingest', 'ERROR'):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual((len(buffer), buffer._in_flight, buffer.stats['failures']), (2, 0, 1))
+        self.assertEqual(len(self.spooled()), 2)
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual((len(buffer), self.spooled()), (0, []))
+
+    def test_flusher_survives_errors(self):
+        buffer = WriteBehindBuffer(flush_interval_ms=1)
+        calls = []
+
+        def flush():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError('boom')
+            buffer._stopped = True
+
+        with mock.patch.object(buffer, 'flush', side_effect=flush), \
+                mock.patch('anttracker.ingest.close_old_connections'), \
+                self.assertLogs('anttracker.ingest', 'ERROR'):
+            buffer._run()
+        self.assertEqual(len(calls), 2)
+
+    def test_sequences_recorded_on_commit(self):
+        _high_water.pop(self.device.pk, None)
+        buffer = WriteBehindBuffer(max_attempts=1)
+        buffer.submit([self.row(seq=5, temperature=None)])
+        self.assertIsNone(_high_water.get(self.device.pk))
+        with self.assertLogs('anttracker.ingest', 'ERROR'):
+            buffer.flush()
+        # Dead-lettered, so a retry of seq 5 must be stored rather than acknowledged
+        self.assertIsNone(_high_water.get(self.device.pk))
+        buffer.submit([self.row(seq=6)])
+        buffer.flush()
+        self.assertEqual(_high_water[self.device.pk], 6)
+
+    def test_spool_file_per_process(self):
+        buffer = WriteBehindBuffer(spool_path=self.base)
+        buffer.submit([self.row()])
+        self.assertTrue(os.path.exists(f'{self.base}.{os.getpid()}'))
+        self.assertFalse(os.path.exists(self.base))
+
+    def test_replays_orphaned_spools_only(self):
+        record = {'temperature': 20.0, 'humidity': 50.0, 'moisture': None, 'ant_count': 3,
+                  'mealy_bugs_count': 0, 'is_rainfall': False, 'is_irrigation': False,
+                  'ml_confidence': None, 'seq': None, 'device_id': self.device.pk}
+        for pid, minute in ((999999901, 1), (999999902, 2)):
+            with open(f'{self.base}.{pid}', 'w') as spool:
+                spool.write(json.dumps({**record, 'timestamp': f'2024-05-01T10:0{minute}:00+00:00'}) + '\n')
+        # Process 999999902 is still running
+        running = open(f'{self.base}.999999902.lock', 'a')
+        self.addCleanup(running.close)
+        fcntl.flock(running, fcntl.LOCK_EX)
+
+        WriteBehindBuffer(spool_path=self.base)
+        self.assertEqual(SensorData.objects.filter(device=self.device).count(), 1)
+        self.assertFalse(os.path.exists(f'{self.base}.999999901'))
+        self.assertTrue(os.path.exists(f'{self.base}.999999902'))
+
+    def test_replay_skips_committed_rows(self):
+        stored = [
+            SensorData.objects.create(device=self.device, temperature=20, humidity=50, seq=7),
+            SensorData.objects.create(device=self.device, temperature=20, humidity=50),
+        ]
+        crashed = WriteBehindBuffer(spool_path=self.base)
+        # Spooled, committed, then the process died before removing the spool
+        crashed.submit([self.row(seq=7, timestamp=stored[0].timestamp),
+                        self.row(timestamp=stored[1].timestamp), self.row(seq=8)])
+        crashed._spool.close()
+        crashed._spool_lock.close()
+        os.rename(f'{self.base}.{os.getpid()}', f'{self.base}.999999903')
+
+        WriteBehindBuffer(spool_path=self.base)
+        self.assertEqual(SensorData.objects.filter(device=self.device).count(), 3)
+        self.assertTrue(SensorData.objects.filter(device=self.device, seq=8).exists())
+
+
+class SingleReadingIngestTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _high_water.clear()
+        self.farmer = create_farmer(ant_threshold_limit=10)
+        self.device = create_device(self.farmer)
+
+    def submit(self, payload):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/api/device-data/{self.device.device_id}/', payload,
+                                    content_type='application/json', HTTP_AUTHORIZATION='key-1')
+
+    def test_alert_email_waits_for_commit(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                SensorData.objects.create(device=self.device, temperature=20, humidity=50, ant_count=50)
+                raise RuntimeError("roll back")
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(self.submit(reading(50)).status_code, 201)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(AlertLog.objects.count(), 1)
+
+    def test_retried_sequence_is_acknowledged(self):
+        first = self.submit(reading(1, seq=5))
+        retry = self.submit(reading(1, seq=5))
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.json()['data_id'], first.json()['data_id'])
+
+    def test_conflicting_insert_rolled_back(self):
+        create = type(SensorData.objects).create
+        calls = []
+
+        def conflict_once(manager, **kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                # Another request held the sequence, then rolled back
+                raise IntegrityError("UNIQUE constraint failed")
+            return create(manager, **kwargs)
+
+        with mock.patch.object(type(SensorData.objects), 'create', autospec=True, side_effect=conflict_once):
+            response = self.submit(reading(1, seq=9))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(calls), 2)
+
+    def test_persistent_conflict_returns_409(self):
+        with mock.patch.object(type(SensorData.objects), 'create', autospec=True,
+                               side_effect=IntegrityError("UNIQUE constraint failed")):
+            response = self.submit(reading(1, seq=9))
+        self.assertEqual(response.status_code, 409)
+
+
+def throttle_rates(**rates):
+    return {**settings.REST_FRAMEWORK,
+            'DEFAULT_THROTTLE_RATES': {**settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'], **rates}}
+
+
+@override_settings(REST_FRAMEWORK=throttle_rates(device='3/min'))
+class DeviceThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.device = create_device(create_farmer())
+
+    def submit(self, api_key='key-1'):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/api/device-data/{self.device.device_id}/', reading(),
+                                    content_type='application/json', HTTP_AUTHORIZATION=api_key)
+
+    def test_bucket_belongs_to_the_device(self):
+        self.device.previous_api_key = 'key-0'
+        self.device.previous_api_key_expires_at = timezone.now() + timedelta(hours=1)
+        self.device.save()
+        self.assertEqual([self.submit('key-1').status_code, self.submit('key-0').status_code,
+                          self.submit('key-1').status_code], [201, 201, 201])
+        # The previous key draws from the same bucket
+        self.assertEqual(self.submit('key-0').status_code, 429)
+
+    def test_unknown_credentials_get_no_bucket(self):
+        for attempt in range(5):
+            self.assertEqual(self.submit(f'garbage-{attempt}').status_code, 401)
+        self.assertEqual([self.submit().status_code for _ in range(4)], [201, 201, 201, 429])
+
+
+class InferenceQueueTests(TestCase):
+    class ThreadQueue(ml_api.InferenceQueue):
+        # Threads see the patched count_batch; spawned worker processes would not
+        def _make_executor(self):
+            return ThreadPoolExecutor(max_workers=self.workers)
+
+    def setUp(self):
+        cache.clear()
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_dir)
+        self.device = create_device(create_farmer())
+
+    def job(self, seq):
+        fields = {'timestamp': timezone.now(), 'temperature': 21.5, 'humidity': 60.0, 'seq': seq}
+        return ml_api.InferenceJob(self.device, fields, b'image-%d' % seq)
+
+    def spooled(self):
+        return sorted(name for name in os.listdir(self.spool_dir) if name.endswith('.job'))
+
+    def upload(self, seq, size=16):
+        return self.client.post('/api/device-sensor-data/', {
+            'device_id': 'pi-1', 'temperature': 21.5, 'humidity': 60.0, 'seq': seq,
+            'image': SimpleUploadedFile('trap.jpg', b'x' * size),
+        }, HTTP_AUTHORIZATION='key-1')
+
+    def test_images_are_counted_in_micro_batches(self):
+        queue = self.ThreadQueue(None, self.spool_dir, workers=1, batch_size=3, batch_wait_ms=200)
+        batches, done = [], threading.Event()
+
+        def store(future, jobs, started):
+            batches.append(len(future.result()))
+            if sum(batches) == 7:
+                done.set()
+
+        def count_batch(images):
+            return [{'ant_count': 1, 'mealy_bugs_count': 0, 'ml_confidence': 0.9}] * len(images)
+
+        with mock.patch('anttracker.inference.count_batch', side_effect=count_batch), \
+                mock.patch.object(queue, '_store', side_effect=store):
+            queue.start()
+            try:
+                for seq in range(1, 8):
+                    self.assertTrue(queue.submit(self.job(seq)))
+                self.assertFalse(queue.submit(self.job(7)))
+                self.assertTrue(done.wait(5))
+            finally:
+                queue.stop()
+        # Two full batches, then the rest once the oldest image waited batch_wait_ms
+        self.assertEqual(batches, [3, 3, 1])
+        self.assertEqual(len(self.spooled()), 7)
+
+    def test_store_saves_counts_and_removes_spooled_images(self):
+        queue = ml_api.InferenceQueue(None, self.spool_dir)
+        jobs = [self.job(1), self.job(2)]
+        for job in jobs:
+            queue.submit(job)
+        future = Future()
+        future.set_result([{'ant_count': 7, 'mealy_bugs_count': 1, 'ml_confidence': 0.9},
+                           {'error': 'Unreadable image'}])
+        with self.captureOnCommitCallbacks(execute=True):
+            queue._store(future, jobs, time.monotonic())
+        reading = SensorData.objects.get()
+        self.assertEqual((reading.seq, reading.ant_count, reading.ml_confidence), (1, 7, 0.9))
+        self.assertEqual((queue.stats['processed'], queue.stats['failed']), (1, 1))
+        self.assertEqual(self.spooled(), [])
+
+    def test_failed_batch_stays_spooled(self):
+        queue = ml_api.InferenceQueue(None, self.spool_dir)
+        jobs = [self.job(1)]
+        queue.submit(jobs[0])
+        future = Future()
+        future.set_exception(RuntimeError('worker died'))
+        queue._store(future, jobs, time.monotonic())
+        self.assertFalse(SensorData.objects.exists())
+        self.assertEqual(len(self.spooled()), 1)
+
+    def test_spooled_images_are_replayed_by_the_next_process(self):
+        queue = ml_api.InferenceQueue(None, self.spool_dir)
+        jobs = [self.job(1), self.job(2)]
+        for job in jobs:
+            queue.submit(job)
+        # Left behind by a process that has exited
+        for name in self.spooled():
+            os.rename(os.path.join(self.spool_dir, name), os.path.join(self.spool_dir, f'999999.{name}'))
+        open(os.path.join(self.spool_dir, '999999.lock'), 'a').close()
+        SensorData.objects.create(device=self.device, temperature=21.5, humidity=60.0, seq=1)
+
+        restarted = ml_api.InferenceQueue(None, self.spool_dir)
+        restarted._replay_spool()
+        self.assertEqual(len(restarted), 1)
+        replayed = restarted._jobs[0]
+        self.assertEqual((replayed.device, replayed.image, replayed.fields), (self.device, b'image-2', jobs[1].fields))
+        self.assertEqual(self.spooled(), [os.path.basename(replayed.path)])
+        self.assertTrue(replayed.path.startswith(os.path.join(self.spool_dir, f'{os.getpid()}.')))
+        self.assertFalse(os.path.exists(os.path.join(self.spool_dir, '999999.lock')))
+
+    @override_settings(ML_MODEL_PATH='weights.pt')
+    def test_full_queue_is_rejected(self):
+        queue = ml_api.InferenceQueue('weights.pt', self.spool_dir, max_pending=1)
+        with mock.patch.object(ml_api, '_queue', queue):
+            self.assertEqual(self.upload(1).status_code, 202)
+            response = self.upload(2)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '30')
+            self.assertTrue(self.upload(1).json()['duplicate'])
+        self.assertEqual(queue.stats['rejected'], 1)
+        self.assertEqual(len(self.spooled()), 1)
+
+    @override_settings(ML_MODEL_PATH='weights.pt')
+    def test_image_that_cannot_be_spooled_is_not_accepted(self):
+        queue = ml_api.InferenceQueue('weights.pt', os.path.join(self.spool_dir, 'missing'))
+        with mock.patch.object(ml_api, '_queue', queue):
+            self.assertEqual(self.upload(1).status_code, 503)
+        self.assertEqual(len(queue), 0)
+
+    @override_settings(ML_MODEL_PATH='weights.pt', ML_MAX_IMAGE_BYTES=1024)
+    def test_oversized_upload_is_refused_before_parsing(self):
+        with mock.patch('rest_framework.parsers.DjangoMultiPartParser.parse', side_effect=AssertionError):
+            response = self.upload(1, size=64 * 1024)
+        self.assertEqual(response.status_code, 413)
+
+
+class TokenBucketConcurrencyTests(TestCase):
+    class Throttle(TokenBucketThrottle):
+        scope = 'test'
+
+        def get_rate(self):
+            return '5/min'
+
+        def get_cache_key(self, request, view):
+            return 'throttle_bucket:test:shared'
+
+    def test_concurrent_requests_cannot_spend_a_token_twice(self):
+        cache.clear()
+        get = LocMemCache.get
+
+        def slow_get(*args, **kwargs):
+            # Widen the window between reading and writing the bucket
+            value = get(*args, **kwargs)
+            time.sleep(0.002)
+            return value
+
+        allowed = []
+        start = threading.Barrier(8)
+
+        def request():
+            start.wait()
+            allowed.append(self.Throttle().allow_request(None, None))
+
+        # Every thread has its own cache instance, so patch the class
+        with mock.patch.object(LocMemCache, 'get', autospec=True, side_effect=slow_get):
+            threads = [threading.Thread(target=request) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(allowed.count(True), 5)
+
+    def test_expired_lock_is_not_released_by_its_old_owner(self):
+        cache.clear()
+        throttle = self.Throttle()
+        key = 'throttle_bucket:test:shared'
+        token = throttle.acquire(key)
+        # The lock expired and another request took it
+        cache.set(f'{key}:lock', 'other', 1)
+        throttle.release(key, token)
+        self.assertEqual(cache.get(f'{key}:lock'), 'other')
+        throttle.release(key, 'other')
+        self.assertIsNone(cache.get(f'{key}:lock'))
+
+
+class LoadSheddingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.device = create_device(create_farmer())
+
+    @override_settings(LOAD_SHED_LOW_PRIORITY_IN_FLIGHT=2, LOAD_SHED_MAX_IN_FLIGHT=4)
+    def test_in_flight_count_is_shared_through_the_cache(self):
+        # Requests running in other workers
+        cache.set(IN_FLIGHT_KEY, 2)
+        response = self.client.get('/api/devices/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/api/device-data/{self.device.device_id}/', reading(),
+                                        content_type='application/json', HTTP_AUTHORIZATION='key-1')
+        self.assertEqual(response.status_code, 201)
+        # Finished and shed requests both give their slot back
+        self.assertEqual(cache.get(IN_FLIGHT_KEY), 2)
+
+
+@has_databases('shard1')
+class MetricsQueryCountTests(TestCase):
+    databases = configured('shard1')
+
+    def test_queries_on_every_alias_are_counted(self):
+        def view(request):
+            for alias in ('default', 'shard1', 'shard1'):
+                with connections[alias].cursor() as cursor:
+                    cursor.execute('SELECT 1')
+            return HttpResponse('ok')
+
+        request = RequestFactory().get('/metrics-test/')
+        REQUEST_QUERIES.values.clear()
+        MetricsMiddleware(view)(request)
+        counts = REQUEST_QUERIES.values[('unmatched',)]
+        self.assertEqual(counts[-1], 3)
+
+
+class MetricsAccessTests(TestCase):
+    @override_settings(METRICS_TOKEN='scrape-token')
+    def test_scrapers_need_the_token(self):
+        # The test client connects from 127.0.0.1, like a local reverse proxy
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'http_requests_total', response.content)
+
+    def test_staff_without_token(self):
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer None').status_code, 403)
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_only_sampled_requests_are_profiled(self):
+        request = RequestFactory().get('/metrics-test/')
+        with tempfile.TemporaryDirectory() as profile_dir:
+            for rate in (0, 1):
+                with override_settings(METRICS_SLOW_REQUEST_MS=0, METRICS_PROFILE_DIR=profile_dir,
+                                       METRICS_PROFILE_SAMPLE_RATE=rate):
+                    MetricsMiddleware(lambda request: HttpResponse('ok'))(request)
+                    self.assertEqual(len(os.listdir(profile_dir)), rate)
+
+
+class CompressionMiddlewareTests(TestCase):
+    def compress(self, content_type):
+        middleware = CompressionMiddleware(lambda request: HttpResponse('x' * 4096, content_type=content_type))
+        return middleware(RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip'))
+
+    def test_json_is_compressed(self):
+        self.assertEqual(self.compress('application/json')['Content-Encoding'], 'gzip')
+
+    def test_html_is_not_compressed(self):
+        response = self.compress('text/html; charset=utf-8')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(len(response.content), 4096)
+
+
+class CompactFormatTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.farmer = create_farmer()
+        self.devices = [create_device(self.farmer), create_device(self.farmer, 'pi-2', 'key-2')]
+        for device in self.devices * 3:
+            SensorData.objects.create(device=device, temperature=20, humidity=50)
+        self.client.force_login(self.farmer.user)
+
+    def test_columnar_sends_device_fields_once(self):
+        response = self.client.get('/api/sensor-data/', {'format': 'columnar'})
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)['results']
+        self.assertEqual(results['count'], 6)
+        self.assertNotIn('device_name', results['columns'])
+        self.assertNotIn('farmer_name', results['columns'])
+        self.assertEqual(results['lookups']['device'], {
+            str(device.pk): {'device_name': device.device_name, 'farmer_name': 'farmer'}
+            for device in self.devices
+        })
+
+    @skipUnless(msgpack, "needs msgpack")
+    def test_msgpack(self):
+        response = self.client.get('/api/sensor-data/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(msgpack.unpackb(response.content)['count'], 6)
+
+
+class CompactSensorDataTests(TestCase):
+    def setUp(self):
+        self.device = create_device(create_farmer())
+
+    def test_copy_round_trip(self):
+        original = SensorData.objects.create(
+            device=self.device, temperature=21.57, humidity=60.2, moisture=None, ml_confidence=0.8123,
+            ant_count=40000, mealy_bugs_count=3, is_rainfall=True, is_irrigation=False, seq=7,
+        )
+        self.assertEqual(CompactSensorData.objects.copy_from(SensorData.objects.all()), 1)
+        compact = CompactSensorData.objects.get()
+        fields = ['timestamp', 'seq', 'temperature', 'humidity', 'moisture', 'ml_confidence', 'ant_count',
+                  'mealy_bugs_count', 'is_rainfall', 'is_irrigation']
+        self.assertEqual({name: getattr(compact, name) for name in fields},
+                         {name: getattr(original, name) for name in fields})
+        # Receipt time is kept to the second
+        self.assertLess(abs((compact.created_at - original.created_at).total_seconds()), 1)
+
+    def test_values_are_stored_at_fixed_resolution(self):
+        compact = CompactSensorData.from_sensor_data(SensorData(
+            device=self.device, timestamp=timezone.now(), temperature=-12.345, humidity=99.999,
+            is_irrigation=True, created_at=timezone.now(),
+        ))
+        compact.save()
+        compact.refresh_from_db()
+        self.assertEqual((compact.temperature_centi, compact.temperature), (-1234, -12.34))
+        self.assertEqual(compact.humidity, 100.0)
+        self.assertEqual((compact.flags, compact.is_rainfall, compact.is_irrigation), (2, False, True))
+        with self.assertRaises(ValueError):
+            compact.temperature = 400
+
+    def test_lookups_on_reading_names(self):
+        now = timezone.now()
+        for temperature, is_rainfall in ((18.5, False), (21.25, True), (30.0, False)):
+            CompactSensorData.objects.create(device=self.device, timestamp=now, temperature=temperature,
+                                             humidity=50, is_rainfall=is_rainfall)
+
+        def temperatures(queryset):
+            return sorted(reading.temperature for reading in queryset)
+
+        objects = CompactSensorData.objects
+        self.assertEqual(temperatures(objects.filter(temperature__gte=21)), [21.25, 30.0])
+        self.assertEqual(temperatures(objects.filter(Q(temperature__gte=21))), [21.25, 30.0])
+        self.assertEqual(temperatures(objects.filter(Q(temperature__lt=20) | Q(is_rainfall=True))), [18.5, 21.25])
+        self.assertEqual(temperatures(objects.filter(~Q(is_rainfall=True), temperature__in=[18.5, 21.25])), [18.5])
+        self.assertEqual(temperatures(objects.exclude(Q(temperature__range=(20, 25)))), [18.5, 30.0])
+        self.assertEqual([reading.temperature for reading in objects.order_by('-temperature')], [30.0, 21.25, 18.5])
+
+
+@has_databases('replica')
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(TransactionTestCase):
+    # Reads inside the primary's transaction never go to a replica, so no TestCase
+    databases = configured('replica')
+
+    def setUp(self):
+        cache.clear()
+        self.farmer = create_farmer()
+        self.client.force_login(self.farmer.user)
+
+    def replica_queries(self, method, path, **kwargs):
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = getattr(self.client, method)(path, **kwargs)
+        self.assertLess(response.status_code, 400)
+        return len(queries)
+
+    def test_list_reads_use_replica(self):
+        self.assertGreater(self.replica_queries('get', '/api/sensor-data/'), 0)
+
+    def test_user_reads_own_writes(self):
+        self.assertEqual(self.replica_queries('put', '/api/profile/update/', data={'farm_location': 'North'},
+                                              content_type='application/json'), 0)
+        # Pinned to the primary after the write
+        self.assertEqual(self.replica_queries('get', '/api/sensor-data/'), 0)
+        cache.clear()
+        self.assertGreater(self.replica_queries('get', '/api/sensor-data/'), 0)
+
+    def test_no_replica_outside_requests(self):
+        with CaptureQueriesContext(connections['replica']) as queries:
+            list(SensorData.objects.all())
+        self.assertEqual(len(queries), 0)
+
+    def test_replicas_are_not_migrated(self):
+        self.assertIs(ReplicaRouter().allow_migrate('replica', 'anttracker'), False)
+        self.assertIsNone(ReplicaRouter().allow_migrate('default', 'anttracker'))
+
+
+class KeyRotationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.farmer = create_farmer()
+        self.device = create_device(self.farmer)
+        self.client.force_login(self.farmer.user)
+
+    def rotate(self, grace):
+        return self.client.post('/api/devices/rotate-keys/', {'grace_period_seconds': grace},
+                                content_type='application/json')
+
+    def test_grace_period_is_bounded(self):
+        for grace in (-1, 10 ** 20, settings.DEVICE_KEY_MAX_GRACE_PERIOD + 1, 'soon'):
+            self.assertEqual(self.rotate(grace).status_code, 400, grace)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.api_key, 'key-1')
+
+    def test_infinite_grace_period_is_rejected(self):
+        response = self.client.post('/api/devices/rotate-keys/', '{"grace_period_seconds": 1e400}',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_old_key_works_during_grace_period(self):
+        self.assertEqual(self.rotate(3600).status_code, 200)
+        self.device.refresh_from_db()
+        self.assertNotEqual(self.device.api_key, 'key-1')
+        response = self.client.post(f'/api/device-data/{self.device.device_id}/', reading(),
+                                    content_type='application/json', HTTP_AUTHORIZATION='key-1')
+        self.assertEqual(response.status_code, 201)
+
+
+class PageTests(TestCase):
+    """Pages render under DEBUG = False without collectstatic, as in the test runner"""
+
+    def test_public_pages_render(self):
+        for path in ('/api/login.html', '/api/register.html'):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200, path)
+            self.assertContains(response, '/static/anttracker/')
+
+    def test_dashboard_renders(self):
+        self.client.force_login(create_farmer().user)
+        self.assertEqual(self.client.get('/api/dashboard.html').status_code, 200)
+
+
+class SyntheticDataTests(TestCase):
+    def test_threshold_alert_logs(self):
+        device = create_device(create_farmer(ant_threshold_limit=0))
+        end = timezone.now()
+        populate_devices([device], end - timedelta(hours=2), end, 600, seed=0, alert_logs=True)
+        logs = AlertLog.objects.filter(sensor_data__device=device)
+        self.assertTrue(logs.exists())
+        self.assertEqual(logs.count(), SensorData.objects.filter(device=device, ant_count__gt=0).count())
+        self.assertFalse(logs.filter(reevaluated=True).exists())
+
+
+@override_settings(ALERT_REEVALUATION_CHUNK_DAYS=1)
+class AlertReevaluationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.farmer = create_farmer(ant_threshold_limit=1000)
+        self.device = create_device(self.farmer)
+        self.start = timezone.now() - timedelta(days=3)
+
+    def add_readings(self, *readings):
+        """Store (hours after start, ant count) readings without live alerts"""
+        SensorData.objects.bulk_create([
+            SensorData(device=self.device, timestamp=self.start + timedelta(hours=hours),
+                       temperature=21.5, humidity=60, ant_count=ants)
+            for hours, ants in readings
+        ])
+
+    def reevaluated(self, alert_type=None):
+        logs = AlertLog.objects.filter(reevaluated=True)
+        return logs.filter(alert_type=alert_type) if alert_type else logs
+
+    def test_threshold_change_records_alerts_without_email(self):
+        self.add_readings((1, 2), (2, 8), (26, 9), (50, 3))
+        self.client.force_login(self.farmer.user)
+        response = self.client.put('/api/profile/update/', {'ant_threshold_limit': 5},
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        job = AlertReevaluation.objects.get(pk=response.json()['alert_reevaluation'])
+        self.assertIn('1000 -> 5', job.reason)
+
+        job = run_job(job, workers=1)
+        self.assertEqual((job.status, job.chunks_done, job.chunks_total), (AlertReevaluation.STATUS_DONE, 3, 3))
+        self.assertEqual((job.readings_checked, job.alerts_written), (4, 2))
+        self.assertEqual(sorted(self.reevaluated().values_list('sensor_data__ant_count', flat=True)), [8, 9])
+        self.assertFalse(AlertLog.objects.filter(reevaluated=False).exists())
+        self.assertEqual(mail.outbox, [])
+
+    def test_resume_skips_finished_chunks(self):
+        self.farmer.ant_threshold_limit = 5
+        self.farmer.save()
+        self.add_readings((1, 8), (26, 9), (50, 10))
+        job = schedule_reevaluation(self.farmer, reason='test')
+        first, *rest = plan_chunks(job)
+        # An earlier run finished the first chunk before it was interrupted
+        reevaluate_chunk(first.pk)
+        with mock.patch('anttracker.reevaluation.reevaluate_chunk', wraps=reevaluate_chunk) as chunk:
+            job = run_job(job, workers=1)
+        self.assertEqual([call.args[0] for call in chunk.call_args_list], [c.pk for c in rest])
+        self.assertEqual((job.chunks_done, job.readings_checked, job.alerts_written), (3, 3, 3))
+        self.assertEqual(self.reevaluated().count(), 3)
+
+    def test_rerunning_a_chunk_replaces_its_logs(self):
+        self.farmer.ant_threshold_limit = 5
+        self.farmer.save()
+        self.add_readings((1, 8), (2, 9), (26, 10))
+        job = schedule_reevaluation(self.farmer, reason='test')
+        first, second = plan_chunks(job)
+        self.assertEqual(reevaluate_chunk(first.pk), (first.pk, 2, 2))
+        self.assertEqual(reevaluate_chunk(second.pk), (second.pk, 1, 1))
+        self.assertEqual(reevaluate_chunk(first.pk), (first.pk, 2, 2))
+        self.assertEqual(self.reevaluated().count(), 3)
+
+    def test_streak_carries_over_chunk_boundary(self):
+        AlertRule.objects.create(
+            farmer=self.farmer, name='Ants rising', alert_type='ants_streak', consecutive_readings=3,
+            conditions=[{'field': 'ant_count', 'op': 'gt', 'value': 5}],
+        )
+        # Chunks start at the first reading: two matches in the first chunk, two in the second
+        self.add_readings((0, 6), (23, 7), (25, 8), (26, 9))
+        job = AlertReevaluation.objects.get(farmer=self.farmer)
+        job = run_job(job, workers=1)
+        self.assertEqual(job.chunks_total, 2)
+        logs = self.reevaluated('ants_streak')
+        self.assertEqual(list(logs.values_list('sensor_data__ant_count', flat=True)), [8])
+
+    def test_alert_rule_changes_queue_one_job(self):
+        rule = AlertRule.objects.create(
+            farmer=self.farmer, name='Hot', alert_type='hot',
+            conditions=[{'field': 'temperature', 'op': 'gt', 'value': 35}],
+        )
+        rule_id = rule.pk
+        rule.is_active = False
+        rule.save()
+        rule.delete()
+        job = AlertReevaluation.objects.get(farmer=self.farmer)
+        self.assertEqual(job.status, AlertReevaluation.STATUS_PENDING)
+        self.assertEqual(job.reason, f'alert rule {rule_id} changed')
+
+    def test_rules_deleted_with_their_farmer_queue_nothing(self):
+        AlertRule.objects.create(farmer=self.farmer, name='Hot', conditions=[], device=self.device)
+        AlertReevaluation.objects.all().delete()
+        self.farmer.user.delete()
+        self.assertFalse(AlertReevaluation.objects.exists())
+
+
+class BenchmarkEndpointsTests(TestCase):
+    def test_tiny_scenario(self):
+        # The command sets up its own test databases, so it runs in a separate process
+        with tempfile.TemporaryDirectory() as tmp:
+            baseline = os.path.join(tmp, 'baselines.json')
+            subprocess.run(
+                [sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'benchmark_endpoints',
+                 '--scenarios', 'tiny', '--iterations', '1', '--baseline', baseline, '--update-baseline',
+                 '--settings', os.environ['DJANGO_SETTINGS_MODULE']],
+                check=True, capture_output=True, timeout=120,
+            )
+            with open(baseline) as f:
+                results = json.load(f)['tiny']
+        self.assertEqual(set(results), {'device_data_submission', 'dashboard', 'sensor_data_list',
+                                        'alert_log_list', 'device_list'})
+        # List endpoints do not query per row
+        self.assertEqual(results['device_list']['queries'], 2)
+        self.assertEqual(results['alert_log_list']['queries'], 2)
+
+    def test_missing_baseline_is_a_regression(self):
+        result = {'queries': 2, 'wall_ms': 1.0, 'peak_kb': 10.0}
+        options = {'time_tolerance': 0.5, 'memory_tolerance': 0.5}
+        regressions = BenchmarkEndpoints().compare(
+            {'tiny': {'dashboard': result, 'device_list': result}}, {'tiny': {'dashboard': result}}, options
+        )
+        self.assertEqual(regressions, ['tiny/device_list: no baseline, run with --update-baseline to record one'])
+
+
+class CachedAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.farmer = create_farmer(ant_threshold_limit=50)
+        self.token = Token.objects.create(user=self.farmer.user)
+
+    def get_profile(self, **headers):
+        return self.client.get('/api/profile/', **headers)
+
+    def token_header(self):
+        return {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def test_token_requests_skip_auth_queries(self):
+        # Cold: token, user and farmer in one query, plus the view's device query
+        with self.assertNumQueries(2):
+            self.assertEqual(self.get_profile(**self.token_header()).status_code, 200)
+        # Warm: only the view's own query
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_profile(**self.token_header()).status_code, 200)
+
+    def test_session_requests_skip_auth_queries(self):
+        self.client.force_login(self.farmer.user)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.get_profile().status_code, 200)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_profile().status_code, 200)
+
+    def test_logout_drops_cached_user(self):
+        self.client.force_login(self.farmer.user)
+        self.get_profile()
+        self.assertIsNotNone(cache.get(_user_key(self.farmer.user_id)))
+        self.client.post('/api/logout/')
+        self.assertIsNone(cache.get(_user_key(self.farmer.user_id)))
+        self.assertIn(self.get_profile().status_code, (401, 403))
+
+    def test_password_change_ends_sessions(self):
+        self.client.force_login(self.farmer.user)
+        self.assertEqual(self.get_profile().status_code, 200)
+        user = User.objects.get(pk=self.farmer.user_id)
+        user.set_password('new-password-123')
+        user.save()
+        # A stale cached user would still match the old session hash
+        self.assertIn(self.get_profile().status_code, (401, 403))
+
+    def test_deleted_token_is_refused(self):
+        self.assertEqual(self.get_profile(**self.token_header()).status_code, 200)
+        self.assertIsNotNone(cache.get(_token_key(self.token.key)))
+        Token.objects.get(pk=self.token.pk).delete()
+        self.assertIn(self.get_profile(**self.token_header()).status_code, (401, 403))
+
+    def test_profile_update_refreshes_cached_farmer(self):
+        self.assertEqual(self.get_profile(**self.token_header()).json()['ant_threshold_limit'], 50)
+        response = self.client.put('/api/profile/update/', {'ant_threshold_limit': 10},
+                                   content_type='application/json', **self.token_header())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_profile(**self.token_header()).json()['ant_threshold_limit'], 10)
+
+
+class AdminChangelistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        device = create_device(create_farmer())
+        for ant_count in range(5):
+            reading_row = SensorData.objects.create(device=device, temperature=21.5, humidity=60, ant_count=ant_count)
+        AlertLog.objects.create(device=device, sensor_data=reading_row, alert_type='ant_threshold',
+                                message='Too many ants', sent_to='farmer@example.com')
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw-12345678'))
+        # Resolve the cached user so only the changelist's own queries are counted
+        self.client.get('/admin/')
+
+    def test_count_is_bounded(self):
+        with CaptureQueriesContext(connections['default']) as captured, self.assertNumQueries(2):
+            response = self.client.get('/admin/anttracker/sensordata/')
+        self.assertEqual(response.status_code, 200)
+        count_sql = captured[0]['sql']
+        self.assertIn('COUNT(*)', count_sql)
+        self.assertIn('LIMIT 10001', count_sql)
+        with self.assertNumQueries(3):
+            # Alert types come from the rule table, not a DISTINCT over the logs
+            self.assertEqual(self.client.get('/admin/anttracker/alertlog/').status_code, 200)
+
+    def test_unfiltered_count_uses_the_estimate(self):
+        with mock.patch('anttracker.admin.table_row_estimate', return_value=10 ** 7), self.assertNumQueries(1):
+            response = self.client.get('/admin/anttracker/sensordata/', {'period': 'all'})
+        self.assertEqual(response.context['cl'].result_count, 10 ** 7)
+
+    def test_date_filter_rejects_values_it_does_not_offer(self):
+        month = timezone.localdate().strftime('%Y-%m')
+        self.assertEqual(self.client.get('/admin/anttracker/sensordata/', {'period': month}).status_code, 200)
+        for period in ('2024-13', '9999-12', '1999-01', 'yesterday'):
+            response = self.client.get('/admin/anttracker/sensordata/', {'period': period})
+            self.assertRedirects(response, '/admin/anttracker/sensordata/?e=1', fetch_redirect_response=False)
+
+
+class DashboardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.farmer = create_farmer(ant_threshold_limit=50)
+        SensorData.objects.create(device=create_device(self.farmer), temperature=20, humidity=50, ant_count=20)
+        self.client.force_login(self.farmer.user)
+
+    def recent_alerts(self):
+        return self.client.get('/api/dashboard/').json()['summary']['recent_alerts']
+
+    def test_threshold_change_updates_cached_summary(self):
+        self.assertEqual(self.recent_alerts(), 0)
+        response = self.client.put('/api/profile/update/', {'ant_threshold_limit': 10},
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.recent_alerts(), 1)
+
+
+class DeviceDirectoryTests(TestCase):
+    def setUp(self):
+        self.device = create_device(create_farmer())
+
+    def entry(self):
+        return DeviceDirectory.objects.filter(device_pk=self.device.pk).values_list('device_id', flat=True).first()
+
+    def test_saves_keeping_the_entry_skip_the_directory(self):
+        DeviceDirectory.objects.all().delete()
+        device = Device.objects.get(pk=self.device.pk)
+        device.device_name = 'Renamed'
+        device.save()
+        self.assertIsNone(self.entry())
+
+    def test_device_id_change_updates_the_entry(self):
+        device = Device.objects.get(pk=self.device.pk)
+        device.device_id = 'pi-renamed'
+        device.save()
+        self.assertEqual(self.entry(), 'pi-renamed')
+
+
+SHARDS = {'default': 0, 'shard1': 1, 'shard2': 2}
+
+
+@has_databases('shard1', 'shard2')
+@override_settings(DATABASE_SHARDS=SHARDS, SHARD_MAP_TTL=0)
+class ShardingTests(TestCase):
+    databases = configured('shard1', 'shard2')
+
+    def setUp(self):
+        cache.clear()
+        for alias in ('shard1', 'shard2'):
+            reserve_id_range(alias)
+
+    def submit(self, device, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/api/device-data/{device.device_id}/', reading(**kwargs),
+                                    content_type='application/json', HTTP_AUTHORIZATION=device.api_key)
+
+    def readings(self, alias):
+        return SensorData.objects.using(alias).count()
+
+    def create_device(self, shard):
+        farmer = create_farmer(shard=shard)
+        # As ShardRoutingMiddleware does for the farmer's requests
+        with using_shard(shard):
+            return create_device(farmer)
+
+    def test_new_farmers_spread_over_shards(self):
+        farmers = [create_farmer(f'farmer-{i}') for i in range(3)]
+        self.assertEqual({farmer.shard for farmer in farmers}, set(SHARDS))
+        for farmer in farmers:
+            self.assertTrue(Farmer.objects.using(farmer.shard).filter(pk=farmer.pk).exists())
+
+    def test_device_data_goes_to_farmer_shard(self):
+        device = self.create_device('shard1')
+        low, high = shard_id_range('shard1')
+        self.assertTrue(low <= device.pk < high)
+        self.assertTrue(DeviceDirectory.objects.filter(device_pk=device.pk, device_id='pi-1').exists())
+
+        self.assertEqual(self.submit(device).status_code, 201)
+        self.assertEqual((self.readings('default'), self.readings('shard1')), (0, 1))
+
+    def test_move_farmer(self):
+        device = self.create_device('shard1')
+        farmer = device.farmer
+        self.submit(device, ant_count=1)
+        move_farmer(farmer, 'shard2', drain_seconds=0, log=lambda message: None)
+        forget_farmer(farmer.pk)
+
+        self.assertEqual(Farmer.objects.get(pk=farmer.pk).shard, 'shard2')
+        self.assertFalse(Device.objects.using('shard1').exists())
+        self.assertEqual((self.readings('shard1'), self.readings('shard2')), (0, 1))
+        # The device keeps reporting with the same key and primary key
+        self.assertEqual(self.submit(device, ant_count=2).status_code, 201)
+        self.assertEqual(SensorData.objects.using('shard2').filter(device_id=device.pk).count(), 2)
+
+    def test_rows_copied_in_from_other_shards_are_copied_once(self):
+        device = self.create_device('shard2')
+        farmer = device.farmer
+        for _ in range(3):
+            self.submit(device)
+        move_farmer(farmer, 'shard1', drain_seconds=0, log=lambda message: None)
+        forget_farmer(farmer.pk)
+        # shard1 now holds the farmer's rows with shard2's primary keys
+        self.submit(device)
+
+        messages = []
+        move_farmer(farmer, 'default', batch_size=2, drain_seconds=0, log=messages.append)
+        self.assertEqual(messages[:2], ['Pass 1: copied 5 row(s)', 'Pass 2: copied 0 row(s)'])
+        self.assertEqual(SensorData.objects.using('default').filter(device_id=device.pk).count(), 4)
+
+    def test_rule_changes_on_shard_queue_reevaluation(self):
+        device = self.create_device('shard1')
+        with using_shard('shard1'):
+            AlertRule.objects.create(farmer=device.farmer, name='Hot', conditions=[])
+        self.assertEqual(AlertReevaluation.objects.get().farmer_id, device.farmer_id)
+        AlertReevaluation.objects.all().delete()
+        # Removing the rules from the old shard is not a rule change
+        move_farmer(device.farmer, 'shard2', drain_seconds=0, log=lambda message: None)
+        self.assertFalse(AlertReevaluation.objects.exists())
+
+    def test_generated_data_is_sharded(self):
+        call_command('generate_sensor_data', farmers=3, devices_per_farmer=2, days=0.1, interval_minutes=60,
+                     stdout=open(os.devnull, 'w'))
+        farmers = Farmer.objects.all()
+        self.assertEqual({farmer.shard for farmer in farmers}, set(SHARDS))
+        for farmer in farmers:
+            devices = Device.objects.using(farmer.shard).filter(farmer=farmer)
+            self.assertEqual(devices.count(), 2)
+            self.assertEqual(DeviceDirectory.objects.filter(farmer=farmer).count(), 2)
+            self.assertTrue(SensorData.objects.using(farmer.shard).filter(device__farmer=farmer).exists())
+
+
+class RegionalAggregatesTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+
+    def regions(self, **params):
+        return self.client.get('/api/fleet/regions/', params)
+
+    def test_invalid_dates_are_rejected(self):
+        for params in ({'end': 'garbage'}, {'start': '2024-13-45'}, {'end': '2024-02-30'},
+                       {'start': '2024-02-01', 'end': '2024-01-01'}):
+            self.assertEqual(self.regions(**params).status_code, 400, params)
+
+    def test_default_period(self):
+        response = self.regions(end='2024-03-30')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['start'], '2024-03-01')
+
+
+@override_settings(AGGREGATE_ROLLUP_LAG=60)
+class RegionalRollupTests(TestCase):
+    def setUp(self):
+        self.device = create_device(create_farmer(farm_location='North  Valley'))
+        self.later = timezone.now() + timedelta(minutes=5)
+
+    def add_readings(self, ant_counts, day=None):
+        timestamp = timezone.make_aware(datetime.combine(day or date(2024, 3, 1), datetime.min.time().replace(hour=12)))
+        SensorData.objects.bulk_create([
+            SensorData(device=self.device, timestamp=timestamp, temperature=21.5, humidity=60, ant_count=ants)
+            for ants in ant_counts
+        ])
+
+    def summary(self, **kwargs):
+        return regional_summary(date(2024, 3, 1), date(2024, 3, 31), **kwargs)['regions']
+
+    def test_readings_are_folded_once(self):
+        self.add_readings([1, 2, 3])
+        self.assertEqual(rollup(batch_size=2, now=self.later), 3)
+        self.assertEqual(rollup(batch_size=2, now=self.later), 0)
+        self.add_readings([4])
+        self.assertEqual(rollup(now=self.later), 1)
+        [region] = self.summary()
+        self.assertEqual((region['region'], region['readings'], region['devices']), ('North Valley', 4, 1))
+        self.assertEqual((region['ant']['max'], region['ant']['mean']), (4, 2.5))
+
+    def test_recent_readings_wait_for_the_lag(self):
+        self.add_readings([5])
+        self.assertEqual(rollup(now=timezone.now() + timedelta(seconds=10)), 0)
+        self.assertEqual(self.summary(), [])
+        self.assertEqual(rollup(now=self.later), 1)
+
+    def test_histograms_merge_into_percentiles(self):
+        # 0..99 spread over two days
+        self.add_readings(range(0, 100, 2), day=date(2024, 3, 1))
+        self.add_readings(range(1, 100, 2), day=date(2024, 3, 2))
+        self.assertEqual(rollup(now=self.later), 100)
+        [region] = self.summary()
+        self.assertEqual((region['readings'], region['ant']['max'], region['ant']['mean']), (100, 99, 49.5))
+        self.assertEqual((region['ant']['p50'], region['ant']['p90']), (50.0, 90.0))
+        self.assertEqual(sum(region['ant']['histogram']), 100)
+        days = self.summary(by_day=True)
+        self.assertEqual([(day['day'], day['readings']) for day in days],
+                         [(date(2024, 3, 1), 50), (date(2024, 3, 2), 50)])
+
+
+@has_databases('shard1', 'shard2')
+@override_settings(DATABASE_SHARDS=SHARDS, SHARD_MAP_TTL=0, AGGREGATE_ROLLUP_LAG=60)
+class ShardedRollupTests(TestCase):
+    databases = configured('default', 'shard1', 'shard2')
+
+    def setUp(self):
+        reserve_id_range('shard1')
+        self.later = timezone.now() + timedelta(minutes=5)
+
+    def test_rows_copied_in_from_other_shards_are_skipped(self):
+        farmer = create_farmer('shard-farmer', shard='shard1', farm_location='Hills')
+        with using_shard('shard1'):
+            device = create_device(farmer, 'pi-9', 'key-9')
+            SensorData.objects.create(device=device, temperature=20, humidity=50, ant_count=1)
+            # A reading moved in from shard2 keeps shard2's primary key
+            SensorData.objects.create(pk=shard_id_range('shard2')[0] + 1, device=device,
+                                      temperature=20, humidity=50, ant_count=1)
+        self.assertEqual(rollup('shard1', now=self.later), 1)
+        self.assertEqual(rollup('shard1', now=self.later), 0)
+
+
+@override_settings(DEVICE_HEARTBEAT_INTERVAL=60, DEVICE_OFFLINE_AFTER=3600)
+class DeviceHeartbeatTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.device = create_device(create_farmer())
+
+    def submit(self, payload):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/api/device-data/{self.device.device_id}/', payload,
+                                    content_type='application/json', HTTP_AUTHORIZATION='key-1')
+
+    def status_alerts(self, alert_type):
+        return AlertLog.objects.filter(device=self.device, alert_type=alert_type)
+
+    def test_heartbeats_are_coalesced(self):
+        now = timezone.now()
+        self.assertTrue(record_heartbeat(self.device, now=now))
+        self.assertFalse(record_heartbeat(self.device, now=now + timedelta(seconds=30)))
+        # Another worker holding a stale copy of the device row
+        self.assertFalse(record_heartbeat(Device.objects.get(pk=self.device.pk), now=now + timedelta(seconds=30)))
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.last_seen, now)
+
+    def test_rejected_submission_is_no_heartbeat(self):
+        self.assertEqual(self.submit({'temperature': 'hot'}).status_code, 400)
+        self.device.refresh_from_db()
+        self.assertIsNone(self.device.last_seen)
+        self.assertEqual(self.device.health_state, Device.HEALTH_UNKNOWN)
+
+    def test_offline_and_online_transitions(self):
+        self.submit(reading())
+        Device.objects.filter(pk=self.device.pk).update(last_seen=timezone.now() - timedelta(hours=2))
+        cache.clear()
+        result = check_device_health()
+        self.assertEqual([d.pk for d in result['offline']], [self.device.pk])
+        self.assertEqual(self.status_alerts(DEVICE_OFFLINE_ALERT).count(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(f'/api/device-data/{self.device.device_id}/', reading(),
+                                        content_type='application/json', HTTP_AUTHORIZATION='key-1')
+        self.assertEqual(response.status_code, 201)
+        # The online email waits for the commit
+        self.assertEqual(len(mail.outbox), 1)
+        for callback in callbacks:
+            callback()
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.health_state, Device.HEALTH_ONLINE)
+        self.assertEqual(self.status_alerts(DEVICE_ONLINE_ALERT).count(), 1)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(check_device_health(), {'offline': [], 'online': []})
+
+    def test_status_alert_without_readings(self):
+        Device.objects.filter(pk=self.device.pk).update(
+            last_seen=timezone.now() - timedelta(hours=2), health_state=Device.HEALTH_ONLINE
+        )
+        check_device_health()
+        alert = self.status_alerts(DEVICE_OFFLINE_ALERT).get()
+        self.assertIsNone(alert.sensor_data)
+        self.client.force_login(self.device.farmer.user)
+        alerts = self.client.get('/api/alerts/').json()['results']
+        self.assertEqual([a['alert_type'] for a in alerts], [DEVICE_OFFLINE_ALERT])
+
+
+class LoadTestFleetTests(LiveServerTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_reports_percentiles_and_error_counts(self):
+        out = StringIO()
+        call_command('loadtest_fleet', base_url=self.live_server_url, farmers=1, devices=3, duration=1,
+                     workers=1, interval=0.5, pollers=1, poll_interval=0.5, offline_probability=0,
+                     stdout=out)
+        report = out.getvalue()
+        header = next(line for line in report.splitlines() if line.startswith('endpoint'))
+        self.assertEqual(header.split()[3:], ['p50', 'ms', 'p95', 'ms', 'p99', 'ms', 'errors', '429s'])
+        row = next(line for line in report.splitlines() if line.startswith('device data '))
+        requests, _, *_, errors, throttled = row[len('device data'):].split()
+        self.assertGreaterEqual(int(requests), 3)
+        self.assertEqual((errors, throttled), ('0.0%', '0'))
+        self.assertEqual(SensorData.objects.count(), int(requests))
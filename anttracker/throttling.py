@@ -0,0 +1,209 @@
+"""
+Token-bucket throttling and priority-aware load shedding.
+
+Buckets and the load-shedding in-flight counter live in the default cache so
+every worker process shares them. That only holds for a shared backend
+(Redis, Memcached): with the default LocMemCache each process has its own
+buckets and its own counter.
+Rates use the DRF ``DEFAULT_THROTTLE_RATES`` format (``'120/min'``): the
+number is the bucket capacity (burst) and it refills evenly over the
+period. Throttled requests get DRF's 429 with ``Retry-After``.
+
+A bucket is read and written under a short per-bucket lock taken with
+``cache.add``, so concurrent requests for one device cannot spend the same
+token twice. The lock holds a random token and is only released by the
+request that took it, so a request that outlived BUCKET_LOCK_TIMEOUT cannot
+drop a lock another request has since taken. Device buckets are keyed by the authenticated device, so
+requests with unknown credentials never get a bucket of their own.
+"""
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from .provisioning import request_device
+
+
+THROTTLE_COUNTER_PREFIX = 'throttled_requests'
+THROTTLE_SCOPES = ('device', 'dashboard', 'shed')
+
+# Seconds a request waits for a bucket another request is updating, and
+# seconds after which a lock left by a crashed process expires
+BUCKET_LOCK_WAIT = 0.1
+BUCKET_LOCK_TIMEOUT = 1
+
+IN_FLIGHT_KEY = 'load_shed_in_flight'
+
+
+def count_throttled(scope):
+    """Increment the shared counter of rejected requests for a scope"""
+    key = f'{THROTTLE_COUNTER_PREFIX}:{scope}'
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+
+def throttle_counters():
+    """Return rejected-request counters for every scope"""
+    counters = cache.get_many([f'{THROTTLE_COUNTER_PREFIX}:{scope}' for scope in THROTTLE_SCOPES])
+    return {scope: counters.get(f'{THROTTLE_COUNTER_PREFIX}:{scope}', 0) for scope in THROTTLE_SCOPES}
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Cache-backed token bucket keyed by whatever get_cache_key returns"""
+    scope = None
+    cache_format = 'throttle_bucket:%(scope)s:%(ident)s'
+
+    def __init__(self):
+        self.capacity, self.refill_rate = self.parse_rate(self.get_rate())
+        self.wait_seconds = None
+
+    def get_rate(self):
+        return api_settings.DEFAULT_THROTTLE_RATES.get(self.scope)
+
+    def parse_rate(self, rate):
+        """Turn '120/min' into (capacity, tokens per second)"""
+        if rate is None:
+            return None, None
+        num, period = rate.split('/')
+        duration = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+        return int(num), int(num) / duration
+
+    def get_cache_key(self, request, view):
+        raise NotImplementedError('.get_cache_key() must be overridden')
+
+    def allow_request(self, request, view):
+        if self.capacity is None:
+            return True
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+
+        token = self.acquire(key)
+        if token is None:
+            # Too many concurrent requests for one bucket
+            self.wait_seconds = 1 / self.refill_rate
+            count_throttled(self.scope)
+            return False
+        try:
+            now = time.time()
+            tokens, updated = cache.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.refill_rate)
+            if tokens < 1:
+                self.wait_seconds = (1 - tokens) / self.refill_rate
+                cache.set(key, (tokens, now), self.bucket_timeout())
+                count_throttled(self.scope)
+                return False
+            cache.set(key, (tokens - 1, now), self.bucket_timeout())
+            return True
+        finally:
+            self.release(key, token)
+
+    def acquire(self, key):
+        """Take the bucket's lock, waiting up to BUCKET_LOCK_WAIT seconds; return its token or None"""
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + BUCKET_LOCK_WAIT
+        while not cache.add(f'{key}:lock', token, BUCKET_LOCK_TIMEOUT):
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.002)
+        return token
+
+    def release(self, key, token):
+        """Drop the bucket's lock unless it expired and another request has taken it"""
+        if cache.get(f'{key}:lock') == token:
+            cache.delete(f'{key}:lock')
+
+    def bucket_timeout(self):
+        # An idle bucket is full again after this long, so it can expire
+        return int(self.capacity / self.refill_rate) + 1
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class DeviceRateThrottle(TokenBucketThrottle):
+    """Per-device bucket for data submission, keyed by the authenticated device"""
+    scope = 'device'
+
+    def get_cache_key(self, request, view):
+        # The device ID comes from the URL or, for /api/device-sensor-data/, the payload
+        device_id = view.kwargs.get('device_id')
+        if device_id is None and hasattr(request.data, 'get'):
+            device_id = request.data.get('device_id')
+        # Requests that fail authentication get 401 from the view and spend no tokens
+        device = request_device(request, device_id)
+        if device is None:
+            return None
+        return self.cache_format % {'scope': self.scope, 'ident': device.pk}
+
+
+class FarmerRateThrottle(TokenBucketThrottle):
+    """Per-user bucket for dashboard and listing endpoints"""
+    scope = 'dashboard'
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            ident = request.user.pk
+        else:
+            ident = self.get_ident(request)
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+
+class LoadSheddingMiddleware:
+    """
+    Reject low-priority requests early when the workers are saturated.
+
+    Device ingest is high priority and is only shed at LOAD_SHED_MAX_IN_FLIGHT;
+    everything else under /api/ is shed once LOAD_SHED_LOW_PRIORITY_IN_FLIGHT
+    requests are already in progress, so overloaded dashboards cannot starve ingest.
+
+    The in-flight count is a counter in the default cache, shared by every
+    worker process (per process with LocMemCache). It expires after
+    LOAD_SHED_COUNTER_TIMEOUT seconds so increments left by a killed worker
+    cannot shed traffic forever.
+    """
+    HIGH_PRIORITY_PREFIXES = ('/api/device-data/', '/api/device-sensor-data/')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not request.path.startswith('/api/'):
+            return self.get_response(request)
+
+        high_priority = request.path.startswith(self.HIGH_PRIORITY_PREFIXES)
+        limit = getattr(settings, 'LOAD_SHED_MAX_IN_FLIGHT', 64) if high_priority \
+            else getattr(settings, 'LOAD_SHED_LOW_PRIORITY_IN_FLIGHT', 32)
+        if self.enter() > limit:
+            self.leave()
+            count_throttled('shed')
+            response = JsonResponse({'error': 'Server is busy, please retry shortly'}, status=503)
+            response['Retry-After'] = str(getattr(settings, 'LOAD_SHED_RETRY_AFTER', 1))
+            return response
+
+        try:
+            return self.get_response(request)
+        finally:
+            self.leave()
+
+    def enter(self):
+        """Count this request as in flight and return the new total"""
+        try:
+            return cache.incr(IN_FLIGHT_KEY)
+        except ValueError:
+            cache.add(IN_FLIGHT_KEY, 0, getattr(settings, 'LOAD_SHED_COUNTER_TIMEOUT', 300))
+            return cache.incr(IN_FLIGHT_KEY)
+
+    def leave(self):
+        try:
+            cache.decr(IN_FLIGHT_KEY)
+        except ValueError:
+            # The counter expired while this request was running
+            pass
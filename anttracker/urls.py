@@ -20,8 +20,15 @@ urlpatterns = [
     
     # Device management endpoints
     path('devices/', views.DeviceListView.as_view(), name='device-list'),
+    path('devices/health/', views.device_health, name='device-health'),
+    path('devices/bulk/', views.device_bulk_provision, name='device-bulk-provision'),
+    path('devices/rotate-keys/', views.device_rotate_keys, name='device-rotate-keys'),
     path('devices/<int:pk>/', views.DeviceDetailView.as_view(), name='device-detail'),
     
+    # Alert rule endpoints
+    path('alert-rules/', views.AlertRuleListView.as_view(), name='alert-rule-list'),
+    path('alert-rules/<int:pk>/', views.AlertRuleDetailView.as_view(), name='alert-rule-detail'),
+    
     # Device data submission endpoint (for Raspberry Pi)
     path('device-data/<str:device_id>/', views.device_data_submission, name='device-data-submission'),
     
@@ -33,4 +40,8 @@ urlpatterns = [
     path('dashboard/', views.FarmerDashboardView.as_view(), name='farmer-dashboard'),
     path('sensor-data/', views.SensorDataListView.as_view(), name='sensor-data-list'),
     path('alerts/', views.AlertLogListView.as_view(), name='alert-log-list'),
+    
+    # Operations endpoints
+    path('throttling/', views.throttling_stats, name='throttling-stats'),
+    path('fleet/regions/', views.regional_aggregates, name='regional-aggregates'),
 ]
@@ -1,17 +1,34 @@
 from django.shortcuts import render
 from rest_framework import generics, status, permissions
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
+from django.conf import settings
 from django.contrib.auth import authenticate, login
-from django.utils.crypto import get_random_string
-from django.db.models import Q, Avg, Max
+from django.db.models import Count, Q
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from datetime import timedelta
-from .models import Farmer, Device, SensorData, AlertLog
+from .aggregates import regional_summary
+from .dashboard import (
+    dashboard_payload, dashboard_queryset, parse_since, profile_payload, sensor_data_queryset
+)
+from .db_routers import ReplicaReadMixin
+from .heartbeat import record_heartbeat, fleet_health
+from .idempotency import drop_duplicates
+from .ingest import IngestBufferFull, get_buffer, write_behind_enabled
+from .metrics import INGEST_READINGS, INGEST_DUPLICATES
+from .reevaluation import schedule_reevaluation
+from .provisioning import (
+    generate_api_key, max_key_grace_period, parse_device_csv, provision_devices, request_device, rotate_keys,
+    taken_device_ids
+)
+from .throttling import DeviceRateThrottle, FarmerRateThrottle, throttle_counters
+from .models import Farmer, Device, SensorData, AlertLog, AlertRule
 from .serializers import (
     FarmerSerializer, DeviceSerializer, SensorDataSerializer, 
-    DeviceDataSubmissionSerializer, AlertLogSerializer, FarmerRegistrationSerializer
+    DeviceDataSubmissionSerializer, AlertLogSerializer, FarmerRegistrationSerializer,
+    AlertRuleSerializer, DeviceProvisionSerializer
 )
 
 
@@ -84,7 +101,9 @@ class DeviceListView(generics.ListCreateAPIView):
         """Return devices for the authenticated farmer"""
         try:
             farmer = self.request.user.farmer
-            return Device.objects.filter(farmer=farmer)
+            return Device.objects.filter(farmer=farmer).select_related('farmer__user').annotate(
+                sensor_data_total=Count('sensor_data')
+            )
         except Farmer.DoesNotExist:
             return Device.objects.none()
     
@@ -92,10 +111,120 @@ class DeviceListView(generics.ListCreateAPIView):
         """Create device for the authenticated farmer"""
         farmer = self.request.user.farmer
         # Generate unique API key
-        api_key = get_random_string(32)
+        api_key = generate_api_key()
         serializer.save(farmer=farmer, api_key=api_key)
 
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def device_bulk_provision(request):
+    """API view for creating many devices at once from a JSON list or a CSV upload"""
+    try:
+        farmer = request.user.farmer
+    except Farmer.DoesNotExist:
+        return Response({
+            'error': 'Farmer profile not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    upload = request.FILES.get('file')
+    if upload is not None:
+        try:
+            rows = parse_device_csv(upload)
+        except (ValueError, UnicodeDecodeError) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    elif isinstance(request.data, list):
+        rows = request.data
+    else:
+        return Response({
+            'error': 'Send a JSON list of devices or a CSV file upload named "file"'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    max_devices = getattr(settings, 'DEVICE_PROVISION_MAX', 5000)
+    if not rows or len(rows) > max_devices:
+        return Response({
+            'error': f'Provision between 1 and {max_devices} devices per request'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    serializer = DeviceProvisionSerializer(data=rows, many=True)
+    if not serializer.is_valid():
+        return Response({'errors': serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+    
+    taken = taken_device_ids([row['device_id'] for row in serializer.validated_data])
+    if taken:
+        return Response({
+            'error': 'Device ID(s) already exist or repeat in this request',
+            'device_ids': sorted(taken)
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    devices = provision_devices(farmer, serializer.validated_data)
+    return Response({
+        'message': f'{len(devices)} devices provisioned',
+        'count': len(devices),
+        'devices': [
+            {'device_id': d.device_id, 'device_name': d.device_name, 'api_key': d.api_key}
+            for d in devices
+        ]
+    }, status=status.HTTP_201_CREATED)
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def device_rotate_keys(request):
+    """API view for rotating API keys of some or all of the farmer's devices"""
+    try:
+        farmer = request.user.farmer
+    except Farmer.DoesNotExist:
+        return Response({
+            'error': 'Farmer profile not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    devices = Device.objects.filter(farmer=farmer)
+    device_ids = request.data.get('device_ids')
+    if device_ids is not None:
+        if not isinstance(device_ids, list):
+            return Response({'error': 'device_ids must be a list'}, status=status.HTTP_400_BAD_REQUEST)
+        devices = devices.filter(device_id__in=device_ids)
+    
+    grace = request.data.get('grace_period_seconds')
+    if grace is not None:
+        try:
+            grace = int(grace)
+        except (TypeError, ValueError, OverflowError):
+            return Response({
+                'error': 'grace_period_seconds must be an integer'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 <= grace <= max_key_grace_period():
+            return Response({
+                'error': f'grace_period_seconds must be between 0 and {max_key_grace_period()}'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        grace = timedelta(seconds=grace)
+    
+    rotated = rotate_keys(devices, grace=grace)
+    return Response({
+        'message': f'{len(rotated)} device keys rotated',
+        'count': len(rotated),
+        'devices': [
+            {'device_id': d.device_id, 'api_key': d.api_key,
+             'previous_api_key_expires_at': d.previous_api_key_expires_at}
+            for d in rotated
+        ]
+    })
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def device_health(request):
+    """API view for fleet health of the farmer's devices"""
+    try:
+        farmer = request.user.farmer
+    except Farmer.DoesNotExist:
+        return Response({
+            'error': 'Farmer profile not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    return Response(fleet_health(Device.objects.filter(farmer=farmer, is_active=True)))
+
+
 class DeviceDetailView(generics.RetrieveUpdateDestroyAPIView):
     """API view for device detail operations"""
     serializer_class = DeviceSerializer
@@ -105,13 +234,48 @@ class DeviceDetailView(generics.RetrieveUpdateDestroyAPIView):
         """Return devices for the authenticated farmer"""
         try:
             farmer = self.request.user.farmer
-            return Device.objects.filter(farmer=farmer)
+            return Device.objects.filter(farmer=farmer).select_related('farmer__user').annotate(
+                sensor_data_total=Count('sensor_data')
+            )
         except Farmer.DoesNotExist:
             return Device.objects.none()
 
 
+class AlertRuleListView(generics.ListCreateAPIView):
+    """API view for listing and creating alert rules"""
+    serializer_class = AlertRuleSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def get_queryset(self):
+        """Return alert rules for the authenticated farmer"""
+        try:
+            farmer = self.request.user.farmer
+            return AlertRule.objects.filter(farmer=farmer).select_related('device')
+        except Farmer.DoesNotExist:
+            return AlertRule.objects.none()
+    
+    def perform_create(self, serializer):
+        """Create alert rule for the authenticated farmer"""
+        serializer.save(farmer=self.request.user.farmer)
+
+
+class AlertRuleDetailView(generics.RetrieveUpdateDestroyAPIView):
+    """API view for alert rule detail operations"""
+    serializer_class = AlertRuleSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def get_queryset(self):
+        """Return alert rules for the authenticated farmer"""
+        try:
+            farmer = self.request.user.farmer
+            return AlertRule.objects.filter(farmer=farmer).select_related('device')
+        except Farmer.DoesNotExist:
+            return AlertRule.objects.none()
+
+
 @api_view(['POST'])
 @permission_classes([permissions.AllowAny])
+@throttle_classes([DeviceRateThrottle])
 def device_data_submission(request, device_id):
     """API view for device data submission (used by Raspberry Pi)"""
     api_key = request.headers.get('Authorization')
@@ -121,20 +285,52 @@ def device_data_submission(request, device_id):
             'error': 'API key is required'
         }, status=status.HTTP_401_UNAUTHORIZED)
     
-    # Remove 'Bearer ' prefix if present
-    if api_key.startswith('Bearer '):
-        api_key = api_key[7:]
-    
-    try:
-        device = Device.objects.get(device_id=device_id, api_key=api_key, is_active=True)
-    except Device.DoesNotExist:
+    device = request_device(request, device_id)
+    if device is None:
         return Response({
             'error': 'Invalid device ID or API key'
         }, status=status.HTTP_401_UNAUTHORIZED)
     
+    response = submit_device_data(request, device)
+    # Only accepted submissions count as the device reporting
+    if response.status_code < 400:
+        record_heartbeat(device)
+    return response
+
+
+def submit_device_data(request, device):
+    """Store one reading or a list of readings submitted by an authenticated device"""
+    if write_behind_enabled():
+        return _queue_device_data(request, device)
+    
+    # Devices may submit a list of buffered readings in one request
+    if isinstance(request.data, list):
+        serializer = DeviceDataSubmissionSerializer(data=request.data, many=True, context={'device': device})
+        if serializer.is_valid():
+            readings = serializer.save()
+            INGEST_READINGS.inc(device.device_id, amount=len(readings))
+            INGEST_DUPLICATES.inc(device.device_id, amount=serializer.duplicates)
+            return Response({
+                'message': 'Data submitted successfully',
+                'count': len(readings),
+                'duplicates': serializer.duplicates,
+                'data_ids': [reading.id for reading in readings]
+            }, status=status.HTTP_201_CREATED if readings else status.HTTP_200_OK)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
     serializer = DeviceDataSubmissionSerializer(data=request.data, context={'device': device})
     if serializer.is_valid():
         sensor_data = serializer.save()
+        if serializer.duplicate:
+            # Retried submission: acknowledge with the stored reading, write nothing
+            INGEST_DUPLICATES.inc(device.device_id)
+            return Response({
+                'message': 'Duplicate submission ignored',
+                'duplicate': True,
+                'data_id': sensor_data.id,
+                'timestamp': sensor_data.timestamp
+            }, status=status.HTTP_200_OK)
+        INGEST_READINGS.inc(device.device_id)
         return Response({
             'message': 'Data submitted successfully',
             'data_id': sensor_data.id,
@@ -144,142 +340,105 @@ def device_data_submission(request, device_id):
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class FarmerDashboardView(generics.ListAPIView):
+def _queue_device_data(request, device):
+    """Validate readings and hand them to the write-behind buffer"""
+    many = isinstance(request.data, list)
+    serializer = DeviceDataSubmissionSerializer(data=request.data, many=many, context={'device': device})
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    items = serializer.validated_data if many else [serializer.validated_data]
+    items, duplicates = drop_duplicates(device.pk, items, lambda item: item.get('seq'))
+    readings = [SensorData(device=device, **item) for item in items]
+    try:
+        get_buffer().submit(readings)
+    except IngestBufferFull:
+        response = Response({
+            'error': 'Server is busy, please retry shortly'
+        }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        response['Retry-After'] = '1'
+        return response
+    
+    # Sequences are recorded by the buffer once the rows commit
+    INGEST_READINGS.inc(device.device_id, amount=len(readings))
+    INGEST_DUPLICATES.inc(device.device_id, amount=duplicates)
+    return Response({
+        'message': 'Data accepted',
+        'count': len(readings),
+        'duplicates': duplicates,
+    }, status=status.HTTP_202_ACCEPTED if readings else status.HTTP_200_OK)
+
+
+class FarmerDashboardView(ReplicaReadMixin, generics.ListAPIView):
     """API view for farmer dashboard data"""
     serializer_class = SensorDataSerializer
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [FarmerRateThrottle]
     
     def get_queryset(self):
         """Return recent sensor data for farmer's devices"""
         try:
             farmer = self.request.user.farmer
-            queryset = SensorData.objects.filter(device__farmer=farmer)
-            
-            # Check for date filtering
-            start_date = self.request.query_params.get('start_date')
-            end_date = self.request.query_params.get('end_date')
-            
-            if start_date:
-                queryset = queryset.filter(timestamp__date__gte=start_date)
-            if end_date:
-                queryset = queryset.filter(timestamp__date__lte=end_date)
-            
-            # If no date filter, get data from last 24 hours by default
-            if not start_date and not end_date:
-                yesterday = timezone.now() - timedelta(hours=24)
-                queryset = queryset.filter(timestamp__gte=yesterday)
-            
-            return queryset.order_by('-timestamp')
+            return dashboard_queryset(
+                farmer,
+                start_date=self.request.query_params.get('start_date'),
+                end_date=self.request.query_params.get('end_date'),
+            )
         except Farmer.DoesNotExist:
             return SensorData.objects.none()
     
     def list(self, request, *args, **kwargs):
         """Return dashboard data with summary statistics"""
-        queryset = self.get_queryset()
-        
-        # Limit sensor data to last 100 records for performance
-        limited_queryset = queryset[:100]
-        serializer = self.get_serializer(limited_queryset, many=True)
-        
-        # Calculate summary statistics
-        farmer = request.user.farmer
-        devices = Device.objects.filter(farmer=farmer)
-        total_devices = devices.count()
-        
-        # Active devices = devices that have sent data in last 24 hours
-        yesterday = timezone.now() - timedelta(hours=24)
-        active_devices = devices.filter(
-            sensor_data__timestamp__gte=yesterday
-        ).distinct().count()
-        
-        # Calculate average temperature from current queryset (respects date filter)
-        if queryset.exists():
-            avg_temperature = queryset.aggregate(
-                avg_temp=Avg('temperature')
-            )['avg_temp'] or 0
-            avg_humidity = queryset.aggregate(
-                avg_hum=Avg('humidity')
-            )['avg_hum'] or 0
-            max_ant_count = queryset.aggregate(
-                max_ants=Max('ant_count')
-            )['max_ants'] or 0
-        else:
-            avg_temperature = 0
-            avg_humidity = 0
-            max_ant_count = 0
-        
-        # Recent alerts = sensor readings with ant count above threshold in current period
-        recent_alerts = queryset.filter(
-            ant_count__gt=farmer.ant_threshold_limit
-        ).count()
-        
-        # Get latest data for each device
-        latest_data = {}
-        for device in devices:
-            latest_sensor_data = device.sensor_data.first()
-            if latest_sensor_data:
-                latest_data[device.device_name] = {
-                    'timestamp': latest_sensor_data.timestamp,
-                    'ant_count': latest_sensor_data.ant_count,
-                    'temperature': latest_sensor_data.temperature,
-                    'humidity': latest_sensor_data.humidity
-                }
+        try:
+            farmer = request.user.farmer
+        except Farmer.DoesNotExist:
+            return Response({
+                'error': 'Farmer profile not found'
+            }, status=status.HTTP_404_NOT_FOUND)
         
-        return Response({
-            'sensor_data': serializer.data,
-            'summary': {
-                'total_devices': total_devices,
-                'active_devices': active_devices,
-                'recent_alerts': recent_alerts,
-                'avg_temperature': round(avg_temperature, 1),
-                'avg_humidity': round(avg_humidity, 1),
-                'max_ant_count': max_ant_count,
-                'latest_data': latest_data
-            }
-        })
+        return Response(dashboard_payload(
+            farmer,
+            start_date=request.query_params.get('start_date'),
+            end_date=request.query_params.get('end_date'),
+            since=parse_since(request.query_params.get('since')),
+        ))
 
 
-class SensorDataListView(generics.ListAPIView):
+class SensorDataListView(ReplicaReadMixin, generics.ListAPIView):
     """API view for listing sensor data"""
     serializer_class = SensorDataSerializer
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [FarmerRateThrottle]
     
     def get_queryset(self):
         """Return sensor data for farmer's devices"""
         try:
             farmer = self.request.user.farmer
-            queryset = SensorData.objects.filter(device__farmer=farmer)
-            
-            # Filter by device if specified
-            device_id = self.request.query_params.get('device_id')
-            if device_id:
-                queryset = queryset.filter(device__device_id=device_id)
-            
-            # Filter by date range if specified
-            start_date = self.request.query_params.get('start_date')
-            end_date = self.request.query_params.get('end_date')
-            if start_date:
-                queryset = queryset.filter(timestamp__date__gte=start_date)
-            if end_date:
-                queryset = queryset.filter(timestamp__date__lte=end_date)
-            
-            return queryset.order_by('-timestamp')
+            params = self.request.query_params
+            return sensor_data_queryset(
+                farmer,
+                device_id=params.get('device_id'),
+                start_date=params.get('start_date'),
+                end_date=params.get('end_date'),
+                since=parse_since(params.get('since')),
+            )
         except Farmer.DoesNotExist:
             return SensorData.objects.none()
 
 
-class AlertLogListView(generics.ListAPIView):
+class AlertLogListView(ReplicaReadMixin, generics.ListAPIView):
     """API view for listing alert logs"""
     serializer_class = AlertLogSerializer
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [FarmerRateThrottle]
     
     def get_queryset(self):
         """Return alert logs for farmer's devices"""
         try:
             farmer = self.request.user.farmer
             return AlertLog.objects.filter(
-                sensor_data__device__farmer=farmer
-            ).order_by('-sent_at')
+                device__farmer=farmer
+            ).select_related('device').order_by('-sent_at')
         except Farmer.DoesNotExist:
             return AlertLog.objects.none()
 
@@ -290,8 +449,7 @@ def farmer_profile(request):
     """API view for farmer profile"""
     try:
         farmer = request.user.farmer
-        serializer = FarmerSerializer(farmer)
-        return Response(serializer.data)
+        return Response(profile_payload(farmer))
     except Farmer.DoesNotExist:
         return Response({
             'error': 'Farmer profile not found'
@@ -304,15 +462,60 @@ def update_farmer_profile(request):
     """API view for updating farmer profile"""
     try:
         farmer = request.user.farmer
+        old_threshold = farmer.ant_threshold_limit
         serializer = FarmerSerializer(farmer, data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save()
-            return Response({
+            response = {
                 'message': 'Profile updated successfully',
                 'farmer': serializer.data
-            })
+            }
+            # Record the alerts stored readings would raise under the new threshold
+            if farmer.ant_threshold_limit != old_threshold:
+                job = schedule_reevaluation(
+                    farmer, reason=f'ant_threshold_limit {old_threshold} -> {farmer.ant_threshold_limit}'
+                )
+                response['alert_reevaluation'] = job.pk
+            return Response(response)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     except Farmer.DoesNotExist:
         return Response({
             'error': 'Farmer profile not found'
         }, status=status.HTTP_404_NOT_FOUND)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def regional_aggregates(request):
+    """API view for fleet-wide pest statistics per farm location (staff only)"""
+    def query_date(name):
+        """The date in a query parameter, None when it is not a valid date"""
+        try:
+            return parse_date(request.query_params[name])
+        except ValueError:
+            # Well formed but impossible, such as 2024-13-45
+            return None
+
+    end = query_date('end') if 'end' in request.query_params else timezone.localdate()
+    start = None
+    if end is not None:
+        start = query_date('start') if 'start' in request.query_params else end - timedelta(days=29)
+    if start is None or end is None or start > end:
+        return Response({
+            'error': 'start and end must be dates (YYYY-MM-DD) with start <= end'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    interval = request.query_params.get('interval', 'total')
+    if interval not in ('total', 'day'):
+        return Response({
+            'error': "interval must be 'total' or 'day'"
+        }, status=status.HTTP_400_BAD_REQUEST)
+    return Response(regional_summary(
+        start, end, region=request.query_params.get('region'), by_day=interval == 'day'
+    ))
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def throttling_stats(request):
+    """API view for counters of throttled and shed requests (staff only)"""
+    return Response({'throttled_requests': throttle_counters()})